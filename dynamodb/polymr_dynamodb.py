@@ -1,19 +1,22 @@
 import time
+import random
 import operator
+import threading
 import concurrent.futures
 from array import array
-from itertools import repeat
-from itertools import count as counter
 from concurrent.futures import FIRST_COMPLETED
 from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
 
 import polymr.storage
 from polymr.storage import dumps
-from toolz import count
 from toolz import partition_all
 from boto.dynamodb2.fields import HashKey, RangeKey
 from boto.exception import JSONResponseError
 from boto.dynamodb2.exceptions import ItemNotFound
+from boto.dynamodb2.exceptions import ProvisionedThroughputExceededException
+from boto.dynamodb2.items import Item
+from boto.dynamodb2.layer1 import DynamoDBConnection
 from boto.dynamodb2.table import Table
 from boto.dynamodb2.types import NUMBER
 from boto.dynamodb2.types import BINARY
@@ -32,19 +35,77 @@ class BackendError(EnvironmentError):
     pass
 
 
+class Throttle(object):
+    """Adapts the number of concurrent requests to throttling responses.
+
+    The limit grows by one after each unthrottled request and is halved
+    whenever DynamoDB pushes back.
+
+    :param maximum: The largest number of concurrent requests allowed
+    :type maximum: int
+    """
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self._lock = threading.Lock()
+
+    def succeeded(self):
+        with self._lock:
+            self.limit = min(self.maximum, self.limit + 1)
+
+    def throttled(self):
+        with self._lock:
+            self.limit = max(1, self.limit // 2)
+
+
+class _ItemBuffer(list):
+    # One batch_write_item request can't put the same key twice, e.g. the
+    # pk item of two records sharing a pk, so a later put replaces an
+    # earlier one as it would in the table: the last idx wins.
+    def __init__(self):
+        super().__init__()
+        self._positions = {}
+
+    def put_item(self, data, overwrite=False):
+        key = (data['primary'], data['secondary'])
+        pos = self._positions.get(key)
+        if pos is None:
+            self._positions[key] = len(self)
+            self.append(data)
+        else:
+            self[pos] = data
+
+
+def _backoff(attempt, base=0.05, cap=5.0):
+    time.sleep(random.uniform(0, min(cap, base * (1 << attempt))))
+
+
 class DynamoDBBackend(polymr.storage.LevelDBBackend):
+    concurrent_writes = True
     BLOCK_SIZE = 1024*399
     SCHEMA = [HashKey('primary', data_type=BINARY),
               RangeKey('secondary', data_type=NUMBER)]
 
+    MAX_BATCH_GET = 100
+    MAX_BATCH_WRITE = 25
+    MAX_RETRIES = 10
+
     def __init__(self, table_name=None,
                  create_if_missing=True,
                  featurizer_name=None,
-                 consistent=False):
+                 consistent=False,
+                 threads=1,
+                 endpoint=None):
         self.consistent = consistent
         self.table_name = table_name
+        self.threads = threads
+        self.endpoint = endpoint
+        self._local = threading.local()
+        self._executor = None
+        if threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=threads)
         try:
-            self.table = Table(self.table_name, schema=self.SCHEMA)
+            self.table = self._new_table()
             self.table.describe()
         except JSONResponseError as e:
             if 'not found' in e.message and create_if_missing:
@@ -61,11 +122,30 @@ class DynamoDBBackend(polymr.storage.LevelDBBackend):
             self.featurizer_name = name
         self._check_dbstats()
 
+    def _connection(self):
+        if self.endpoint is None:
+            return None
+        host, port = self.endpoint
+        return DynamoDBConnection(host=host, port=port, is_secure=False)
+
+    def _new_table(self):
+        return Table(self.table_name, schema=self.SCHEMA,
+                     connection=self._connection())
+
+    def _table(self):
+        if threading.current_thread() is threading.main_thread():
+            return self.table
+        table = getattr(self._local, 'table', None)
+        if table is None:
+            table = self._local.table = self._new_table()
+        return table
+
     def create(self):
         self.table = Table.create(
             self.table_name, 
             schema=self.SCHEMA,
-            throughput=dict(read=25, write=2000)
+            throughput=dict(read=25, write=2000),
+            connection=self._connection()
         )
         for _ in range(100):
             try:
@@ -82,7 +162,71 @@ class DynamoDBBackend(polymr.storage.LevelDBBackend):
     
     @classmethod
     def from_urlparsed(cls, parsed, featurizer_name=None):
-        return cls(parsed.path.split('/')[-1], featurizer_name=featurizer_name)
+        params = dict(parse_qsl(parsed.query))
+        endpoint = None
+        if parsed.port is not None:
+            endpoint = (parsed.hostname, parsed.port)
+        return cls(parsed.path.split('/')[-1], featurizer_name=featurizer_name,
+                   consistent=params.get('consistent') == 'true',
+                   threads=int(params.get('threads', 1)),
+                   endpoint=endpoint)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _map(self, func, iterable):
+        if self._executor is None:
+            return map(func, iterable)
+        return self._executor.map(func, iterable)
+
+    def _batch_get(self, keys):
+        keys = list(keys)
+        table = self._table()
+        items = []
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                res = table._batch_get(keys, consistent=self.consistent)
+            except ProvisionedThroughputExceededException:
+                _backoff(attempt)
+                continue
+            items.extend(res['results'])
+            keys = res['unprocessed_keys']
+            if not keys:
+                return items
+            _backoff(attempt)
+        raise BackendError("Gave up on %i unprocessed keys" % len(keys))
+
+    def _batch_write(self, table, datas):
+        """Put items, retrying unprocessed ones with backoff.
+
+        :returns: The number of times DynamoDB throttled the writes
+        :rtype: int
+        """
+        throttled = 0
+        for chunk in partition_all(self.MAX_BATCH_WRITE, datas):
+            requests = [{'PutRequest': {'Item': Item(table, data=d)
+                                        .prepare_full()}}
+                        for d in chunk]
+            for attempt in range(self.MAX_RETRIES):
+                try:
+                    resp = table.connection.batch_write_item(
+                        {self.table_name: requests})
+                except ProvisionedThroughputExceededException:
+                    throttled += 1
+                    _backoff(attempt)
+                    continue
+                requests = resp.get('UnprocessedItems', {}).get(
+                    self.table_name, [])
+                if not requests:
+                    break
+                throttled += 1
+                _backoff(attempt)
+            else:
+                raise BackendError(
+                    "Gave up on %i unprocessed items" % len(requests))
+        return throttled
 
     def get_featurizer_name(self):
         item = self.table.get_item(primary=b'Featurizer', secondary=0,
@@ -110,19 +254,21 @@ class DynamoDBBackend(polymr.storage.LevelDBBackend):
     def update_freqs(self, toks_cnts):
         self.save_freqs(dict(toks_cnts))
 
-    def save_freqs(self, freqs_dict):
-        chunks = partition_all(25, freqs_dict.items())
-        for chunk in chunks:
-            with self.table.batch_write() as batch:
-                for tok, freq in chunk:
-                    batch.put_item(data={'primary': b'freq:'+tok,
-                                         'freq': freq, 'secondary': 0}, 
-                                   overwrite=True)
+    def save_freqs(self, freqs_dict, chunk_size=25, threads=None):
+        def _save(chunk, table, i):
+            datas = [{'primary': b'freq:'+tok, 'freq': freq, 'secondary': 0}
+                     for tok, freq in chunk]
+            return i, len(datas), self._batch_write(table, datas)
+
+        chunks = partition_all(chunk_size, freqs_dict.items())
+        return self._save_chunks(_save, chunks, threads)
 
     def find_least_frequent_tokens(self, toks, r, k=None):
-        keys=[{'primary': b'freq:'+tok, 'secondary': 0} for tok in toks]
+        keys = [{'primary': b'freq:'+tok, 'secondary': 0} for tok in toks]
+        chunks = partition_all(self.MAX_BATCH_GET, keys)
         toks_freqs = [(item['primary'][len('freq:'):], int(item['freq']))
-                      for item in self.table.batch_get(keys=keys)]
+                      for items in self._map(self._batch_get, chunks)
+                      for item in items]
         total = 0
         ret = []
         for i, (tok, freq) in enumerate(sorted(toks_freqs, key=snd)):
@@ -146,12 +292,16 @@ class DynamoDBBackend(polymr.storage.LevelDBBackend):
                                   'secondary': 0}, overwrite=True)
 
     def _load_token_blob(self, name):
-        items = self.table.query_2(primary__eq=name or b'null')
+        items = self._table().query_2(primary__eq=name or b'null',
+                                      consistent=self.consistent)
         blob = bytearray()
         for item in items:
             blob.extend(item['bytes'])
         return blob
 
+    def get_tokens(self, names):
+        return map(self._get_token, self._map(self._load_token_blob, names))
+
     def save_token(self, name, record_ids, batch=None):
         saver = batch or self.table
         blob = array("L", record_ids).tobytes() 
@@ -161,84 +311,144 @@ class DynamoDBBackend(polymr.storage.LevelDBBackend):
 
     def _save_multithreaded(self, saver_func, chunks, threads):
         tot = 0
-        tables = [Table(self.table_name, schema=self.SCHEMA) for _ in range(threads)]
+        throttle = Throttle(threads)
+        tables = [self._new_table() for _ in range(threads)]
+        free = list(range(threads))
+        not_done = set()
+        chunks = iter(chunks)
+        exhausted = False
         with ThreadPoolExecutor(max_workers=threads) as executor:
-            not_done = set(executor.submit(saver_func, chunk, tables[i], i)
-                           for i, chunk in zip(range(threads), chunks))
             while True:
+                while not exhausted and len(not_done) < throttle.limit:
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    i = free.pop()
+                    not_done.add(
+                        executor.submit(saver_func, chunk, tables[i], i))
+                if not not_done:
+                    return tot
                 done, not_done = concurrent.futures.wait(
                     not_done, return_when=FIRST_COMPLETED)
                 for future in done:
-                    i, cnt = future.result()
+                    i, cnt, throttled = future.result()
                     tot += cnt
-                    try:
-                        chunk = next(chunks)
-                    except StopIteration:
-                        for future in concurrent.futures.as_completed(not_done):
-                            _, cnt = future.result()
-                            tot += cnt
-                        return tot
-                    not_done.add(executor.submit(saver_func, chunk, tables[i], i))
+                    free.append(i)
+                    if throttled:
+                        throttle.throttled()
+                    else:
+                        throttle.succeeded()
+
+    def _save_chunks(self, saver_func, chunks, threads=None):
+        threads = threads or self.threads
+        if threads > 1:
+            return self._save_multithreaded(saver_func, chunks, threads)
+        return sum(saver_func(chunk, self.table, 0)[1] for chunk in chunks)
 
-    def save_tokens(self, names_ids, chunk_size=25, threads=1):
+    def save_tokens(self, names_ids, chunk_size=25, threads=None):
         def _save(chunk, table, i):
-            with table.batch_write() as batch:
-                for name, record_ids in chunk:
-                    self.save_token(name, record_ids, batch=batch)
-            return i, 0
+            batch = _ItemBuffer()
+            for name, record_ids in chunk:
+                self.save_token(name, record_ids, batch=batch)
+            return i, len(chunk), self._batch_write(table, batch)
 
         chunks = partition_all(chunk_size, names_ids)
-        if threads > 1:
-            return self._save_multithreaded(_save, chunks, threads)
-        else:
-            return count(map(_save, chunks, repeat(self.table), repeat(0)))
+        return self._save_chunks(_save, chunks, threads)
 
     def _load_record_blob(self, idx):
-        item = self.table.get_item(primary=array("L", (idx,)).tobytes(), secondary=0,
+        item = self._table().get_item(primary=array("L", (idx,)).tobytes(), secondary=0,
                                    consistent=self.consistent)
         if item is None or 'bytes' not in item:
             raise KeyError
         return item['bytes']
 
     def get_records(self, idxs):
-        items = self.table.batch_get(
-            keys=[{'primary': array("L", (idx,)).tobytes(), 'secondary': 0}
-                  for idx in idxs]
-        )
-        for item in items:
-            blob = item['bytes']
+        keys = [array("L", (idx,)).tobytes() for idx in idxs]
+        chunks = partition_all(
+            self.MAX_BATCH_GET,
+            ({'primary': key, 'secondary': 0} for key in keys))
+        blobs = {bytes(item['primary']): item['bytes']
+                 for items in self._map(self._batch_get, chunks)
+                 for item in items}
+        for key in keys:
+            blob = blobs.get(key)
             if blob is None:
                 raise KeyError
             yield self._get_record(blob)
 
+    def get_rownum(self, pk):
+        try:
+            item = self._table().get_item(primary=self._pk_key(pk),
+                                          secondary=0,
+                                          consistent=self.consistent)
+        except ItemNotFound:
+            raise KeyError
+        return int(item['idx'])
+
+    def get_rownums(self, pks):
+        keys = [self._pk_key(pk) for pk in pks]
+        chunks = partition_all(
+            self.MAX_BATCH_GET,
+            ({'primary': key, 'secondary': 0} for key in keys))
+        idxs = {bytes(item['primary']): int(item['idx'])
+                for items in self._map(self._batch_get, chunks)
+                for item in items}
+        return [idxs.get(key) for key in keys]
+
+    def _delete_pk(self, pk, idx):
+        try:
+            if self.get_rownum(pk) == idx:
+                self.table.delete_item(primary=self._pk_key(pk),
+                                       secondary=0)
+        except KeyError:
+            pass
+
     def save_record(self, rec, idx=None, save_rowcount=True, batch=None):
-        idx = self.get_rowcount() + 1 if idx is None else idx
+        idx = self.get_rowcount() if idx is None else idx
         saver = batch or self.table
         saver.put_item(data={'primary': array("L", (idx,)).tobytes(), 
                              'secondary': 0, 'bytes': dumps(rec)}, 
                        overwrite=True)
+        if rec.pk:
+            saver.put_item(data={'primary': self._pk_key(rec.pk),
+                                 'secondary': 0, 'idx': idx},
+                           overwrite=True)
         if save_rowcount is True:
-            self.save_rowcount(idx)
+            self.save_rowcount(idx + 1)
         return idx
 
-    def save_records(self, idx_recs, record_db=None, chunk_size=25, threads=1):
+    def save_records(self, idx_recs, record_db=None, chunk_size=25,
+                     threads=None):
         def _save(chunk, table, i):
-            cnt = counter()
-            with table.batch_write() as batch:
-                for idx, rec in chunk:
-                    self.save_record(rec, idx=idx, save_rowcount=False, 
-                                     batch=batch)
-                    next(cnt)
-            return i, next(cnt)
+            batch = _ItemBuffer()
+            for idx, rec in chunk:
+                self.save_record(rec, idx=idx, save_rowcount=False,
+                                 batch=batch)
+            return i, len(chunk), self._batch_write(table, batch)
 
         chunks = partition_all(chunk_size, idx_recs)
-        if threads > 1:
-            return self._save_multithreaded(_save, chunks, threads)
-        else:
-            return count(map(_save, chunks, repeat(self.table), repeat(0)))
+        return self._save_chunks(_save, chunks, threads)
+
+    def _load_deleted(self):
+        deleted = polymr.storage.Tombstones()
+        for item in self._table().query_2(primary__eq=b'Deleted',
+                                          consistent=self.consistent):
+            deleted.add(int(item['secondary']))
+        return deleted
+
+    def _put_tombstone(self, idx):
+        self.table.put_item(data={'primary': b'Deleted', 'secondary': idx},
+                            overwrite=True)
+
+    get_sizes = polymr.storage.AbstractBackend.get_sizes
+    save_sizes = polymr.storage.AbstractBackend.save_sizes
 
     def delete_record(self, idx):
+        self._unlink_pk(idx)
         self.table.delete_item(primary=array("L", (idx,)).tobytes(), secondary=0)
+        self._tombstone(idx)
 
 
 polymr.storage.backends['dynamodb'] = DynamoDBBackend
@@ -1,9 +1,17 @@
+import os
 import random
 import unittest
+from unittest import skipIf
+
+from boto.dynamodb2.types import Dynamizer
 
 from polymr.record import Record
 import polymr_dynamodb
 
+ENVVAR = "POLYMR_DYNAMODB_LOCAL"
+LOCAL = os.environ.get(ENVVAR, False)
+should_skip_test = not bool(LOCAL)
+
 
 class TestDynamoDBBackend(unittest.TestCase):
 
@@ -42,3 +50,88 @@ class TestDynamoDBBackend(unittest.TestCase):
         self.assertEqual(r1.pk, r1_db.pk)
         self.assertEqual(r2.fields, r2_db.fields)
         self.assertEqual(r2.pk, r2_db.pk)
+
+    def test_get_set_tokens_records_bulk(self):
+        db = self.db
+        toks_ids = [(b"tok"+str(i).encode(), list(range(i, i+3)))
+                    for i in range(60)]
+        db.save_tokens(toks_ids)
+        rngs = list(db.get_tokens([tok for tok, _ in toks_ids]))
+        self.assertEqual([ids for _, ids in toks_ids], list(map(list, rngs)))
+        recs = [Record([str(i), "foo"], str(i), []) for i in range(150)]
+        cnt = db.save_records(enumerate(recs))
+        self.assertEqual(cnt, 150)
+        idxs = list(reversed(range(150)))
+        got = list(db.get_records(idxs))
+        self.assertEqual([recs[i].pk for i in idxs], [r.pk for r in got])
+
+
+@skipIf(should_skip_test, ENVVAR+" not defined")
+class TestDynamoDBBackendLocalThreaded(TestDynamoDBBackend):
+
+    def setUp(self):
+        host, port = LOCAL.split(":")
+        self.db = polymr_dynamodb.DynamoDBBackend(
+            "polymr_dynamodb_test_{}".format(random.randint(0, 1<<19)),
+            consistent=True, create_if_missing=True, threads=4,
+            endpoint=(host, int(port)))
+
+    def tearDown(self):
+        self.db.destroy()
+        self.db.close()
+
+
+class FakeConnection(object):
+    def __init__(self, n_unprocessed):
+        self.n_unprocessed = n_unprocessed
+        self.calls = []
+
+    def batch_write_item(self, request_items):
+        self.calls.append(request_items)
+        (name, requests), = request_items.items()
+        if len(self.calls) <= self.n_unprocessed:
+            return {'UnprocessedItems': {name: requests[1:]}}
+        return {}
+
+
+class FakeTable(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self._dynamizer = Dynamizer()
+
+
+class TestThrottling(unittest.TestCase):
+
+    def test_throttle(self):
+        throttle = polymr_dynamodb.Throttle(8)
+        throttle.throttled()
+        self.assertEqual(throttle.limit, 4)
+        for _ in range(3):
+            throttle.throttled()
+        self.assertEqual(throttle.limit, 1)
+        for _ in range(20):
+            throttle.succeeded()
+        self.assertEqual(throttle.limit, 8)
+
+    def test_duplicate_pks_in_a_batch(self):
+        db = polymr_dynamodb.DynamoDBBackend.__new__(
+            polymr_dynamodb.DynamoDBBackend)
+        batch = polymr_dynamodb._ItemBuffer()
+        for idx, pk in enumerate(["a", "b", "a"]):
+            db.save_record(Record(["x"], pk, []), idx=idx,
+                           save_rowcount=False, batch=batch)
+        keys = [(d['primary'], d['secondary']) for d in batch]
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(len(batch), 5)
+        self.assertEqual([d['idx'] for d in batch if 'idx' in d], [2, 1])
+
+    def test_batch_write_retries_unprocessed(self):
+        db = polymr_dynamodb.DynamoDBBackend.__new__(
+            polymr_dynamodb.DynamoDBBackend)
+        db.table_name = "fake"
+        conn = FakeConnection(n_unprocessed=2)
+        datas = [{'primary': b'x', 'secondary': i} for i in range(3)]
+        throttled = db._batch_write(FakeTable(conn), datas)
+        self.assertEqual(throttled, 2)
+        self.assertEqual([len(c["fake"]) for c in conn.calls], [3, 2, 1])
+
@@ -2,10 +2,19 @@ import sys
 import argparse
 
 from .index import CLI as indexcli
+from .compact import CLI as compactcli
+from .dedup import CLI as dedupcli
+from .link import CLI as linkcli
+from .storage import CLI as copycli
+from .snapshot import ExportCLI as exportcli
+from .snapshot import ImportCLI as importcli
 from .query import CLI as querycli
+from .serve import CLI as servecli
+from .serve import ClientCLI as clientcli
 from .query import Index
 
-subcommands = [indexcli, querycli]
+subcommands = [indexcli, querycli, compactcli, copycli, exportcli,
+               importcli, dedupcli, linkcli, servecli, clientcli]
 
 Index  # pyflakes
 
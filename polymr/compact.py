@@ -0,0 +1,100 @@
+import logging
+from array import array
+from bisect import bisect_left
+
+from toolz import partition_all
+
+from . import index
+from . import storage
+
+logger = logging.getLogger(__name__)
+
+
+def _live_records(backend, dead, sizes, featurizer_name):
+    # ids skipped by scan_records are dead: deleted, or missing records
+    expected = 0
+    batches = partition_all(index.RECORD_BATCH_SIZE, backend.scan_records())
+    for batch in batches:
+        idxs_fields = []
+        for idx, rec in batch:
+            dead.extend(range(expected, idx))
+            expected = idx + 1
+            idxs_fields.append((idx - len(dead), rec.fields))
+        sizes.update(featurizer_name, idxs_fields)
+        for _, rec in batch:
+            yield rec
+    dead.extend(range(expected, backend.get_rowcount()))
+
+
+def _remap(ids, dead):
+    # The new id of a live record is its old id less the number of dead
+    # ids below it.
+    ret = array("L")
+    for idx in sorted(ids):
+        pos = bisect_left(dead, idx)
+        if pos == len(dead) or dead[pos] != idx:
+            ret.append(idx - pos)
+    return ret
+
+
+def _remapped_tokens(backend, dead, freqs, chunk_size):
+    toks = backend.get_freqs().keys()
+    for chunk in partition_all(chunk_size, toks):
+        for tok, ids in zip(chunk, backend.get_tokens(chunk)):
+            ids = _remap(ids, dead)
+            if ids:
+                freqs[tok] = len(ids)
+                yield tok, ids
+
+
+def compact(backend_from, backend_to, chunk_size=1000):
+    """Copy an index, leaving out deleted records. Record ids are
+    renumbered densely, deleted ids are removed from posting lists,
+    tokens left with no records are dropped and frequencies and record
+    sizes are rebuilt.
+    """
+    rowcount = backend_from.get_rowcount()
+    dead = []
+    sizes = storage.RecordSizes()
+    featurizer_name = backend_from.get_featurizer_name()
+    with backend_to.bulk_load():
+        logger.info("Copying live records")
+        n_live = backend_to.save_records(
+            enumerate(_live_records(backend_from, dead, sizes,
+                                    featurizer_name)))
+        backend_to.save_rowcount(n_live)
+        backend_to.save_sizes(sizes)
+        logger.info("Kept %i of %i records", n_live, rowcount)
+
+        logger.info("Rewriting posting lists")
+        freqs = storage.empty_freqs(featurizer_name)
+        backend_to.save_tokens(_remapped_tokens(backend_from, dead, freqs,
+                                                chunk_size))
+        backend_to.save_freqs(freqs)
+        backend_to.save_featurizer_name(featurizer_name)
+    logger.info("Compaction complete")
+
+
+class CLI:
+
+    name = "compact"
+
+    arguments = [
+        storage.backend_arg,
+        (["-o", "--output"], {
+            "type": str,
+            "help": "URL of the storage backend to write the compacted "
+                    "index to",
+            "required": True
+        }),
+    ]
+
+    @staticmethod
+    def hook(parser, args):
+        backend_from = storage.parse_url(args.backend)
+        backend_to = storage.parse_url(args.output)
+        try:
+            compact(backend_from, backend_to)
+        finally:
+            backend_from.close()
+            backend_to.close()
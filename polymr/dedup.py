@@ -0,0 +1,187 @@
+"""Find all pairs of near duplicate records, within one index or between
+two.
+
+Records are compared by the Jaccard distance between their index
+tokens, as in ``Index.search_threshold``. Each record of the probed
+index is blocked on its rarest stored tokens: only records sharing one
+of them are candidates, and those the length and positional filters
+rule out are never fetched. Probes are split into id ranges handled by
+worker processes, and pairs are written out as each range finishes, so
+the pair set is never held in memory.
+"""
+import csv
+import sys
+import logging
+import contextlib
+import multiprocessing
+from collections import Counter
+from collections import defaultdict
+
+from toolz import partition_all
+
+from . import query
+from . import storage
+from . import featurizers
+from .util import jaccard
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+FIELDS = ["rownum", "pk", "other_rownum", "other_pk", "distance"]
+
+_joiner = None
+
+
+class _Joiner:
+
+    def __init__(self, probe, target=None):
+        self.probe = probe
+        self.self_join = target is None
+        self.index = query.Index(probe if target is None else target)
+        self.featurizer_name = probe.featurizer_name
+        if self.index.backend.featurizer_name != self.featurizer_name:
+            raise ValueError("Both indexes must use the same featurizer, "
+                             "not %r and %r"
+                             % (self.featurizer_name,
+                                self.index.backend.featurizer_name))
+
+    def pairs(self, start, stop, max_distance):
+        t = 1 - max_distance
+        probes = list(self.probe.scan_records(start=start, stop=stop))
+        probe_toks = featurizers.featurize_many(
+            self.featurizer_name, (rec.fields for _, rec in probes))
+        prefixes = [self.index._prefix(toks, t) for toks in probe_toks]
+        # probes in a range share many rare tokens; read each list once
+        names = sorted({tok for prefix, _ in prefixes for tok in prefix})
+        postings = dict(zip(names, self.index.backend.get_tokens(names)))
+        wanted = defaultdict(list)
+        for (idx, _), toks, (prefix, rest) in zip(probes, probe_toks,
+                                                  prefixes):
+            shared = Counter()
+            for tok in prefix:
+                shared.update(postings[tok])
+            if self.self_join:
+                # each pair once, from its lower id
+                shared = {other: n for other, n in shared.items()
+                          if other > idx}
+            for other in self.index._filter_candidates(len(toks), shared,
+                                                       rest, t):
+                wanted[other].append(idx)
+        by_idx = {idx: (rec, toks) for (idx, rec), toks
+                  in zip(probes, probe_toks)}
+        ret = []
+        for chunk in partition_all(query.VERIFY_BATCH_SIZE, sorted(wanted)):
+            records = list(self.index.backend.get_records(chunk))
+            others = featurizers.featurize_many(
+                self.featurizer_name, (rec.fields for rec in records))
+            for other, other_rec, other_toks in zip(chunk, records, others):
+                for idx in wanted[other]:
+                    rec, toks = by_idx[idx]
+                    distance = jaccard(toks, other_toks)
+                    if distance <= max_distance + query._EPSILON:
+                        ret.append((idx, rec.pk, other, other_rec.pk,
+                                    distance))
+        ret.sort()
+        return ret
+
+
+def _init_worker(url, other_url):
+    global _joiner
+    _joiner = _Joiner(storage.parse_url(url),
+                      storage.parse_url(other_url) if other_url else None)
+
+
+def _join_range(args):
+    start, stop, max_distance = args
+    return _joiner.pairs(start, stop, max_distance)
+
+
+def dedup(url, f, max_distance, other_url=None, processes=1,
+          chunk_size=CHUNK_SIZE):
+    """Write every pair of records within Jaccard distance
+    ``max_distance`` of each other to the text file ``f`` as CSV, one
+    ``FIELDS`` row per pair. With ``other_url``, pairs are between a
+    record of the index at ``url`` and one of the other index, otherwise
+    between two records of the same index, lower id first.
+
+    Id ranges of ``chunk_size`` records are spread over ``processes``
+    workers when the backends allow several processes to open them.
+
+    :returns: The number of pairs written
+    :rtype: int
+    """
+    if not 0 <= max_distance < 1:
+        raise ValueError("max_distance must be at least 0 and less than 1, "
+                         "not %r" % max_distance)
+    backends = [storage.parse_url(u) for u in filter(None, (url, other_url))]
+    rowcount = backends[0].get_rowcount()
+    if processes > 1 and not all(b.concurrent_writes for b in backends):
+        logger.info("Backend can't be opened by several processes; "
+                    "finding pairs in one")
+        processes = 1
+    ranges = [(start, min(start + chunk_size, rowcount), max_distance)
+              for start in range(0, rowcount, chunk_size)]
+    writer = csv.writer(f)
+    writer.writerow(FIELDS)
+    n_pairs = 0
+    progress = storage._Throughput("records", rowcount, verb="Probed")
+    with contextlib.ExitStack() as stack:
+        for b in backends:
+            stack.callback(b.close)
+        if processes > 1:
+            pool = stack.enter_context(multiprocessing.Pool(
+                processes, _init_worker, (url, other_url)))
+            results = pool.imap(_join_range, ranges)
+        else:
+            joiner = _Joiner(*backends)
+            results = (joiner.pairs(*r) for r in ranges)
+        for (start, stop, _), pairs in zip(ranges, results):
+            writer.writerows(pairs)
+            n_pairs += len(pairs)
+            progress.add(stop - start)
+    logger.info("Found %i pairs", n_pairs)
+    return n_pairs
+
+
+class CLI:
+
+    name = "dedup"
+
+    arguments = [
+        storage.backend_arg,
+        (["--other"], {
+            "help": ("URL of a second index. Pairs are found between the "
+                     "two instead of within the first")
+        }),
+        (["-d", "--max-distance"], {
+            "type": float,
+            "help": "Pair records within this Jaccard distance",
+            "default": 0.2
+        }),
+        (["-o", "--output"], {
+            "help": "CSV file to write pairs to. Defaults to stdout"
+        }),
+        (["-n", "--parallel"], {
+            "type": int,
+            "default": 1,
+            "help": "Number of worker processes"
+        }),
+        (["--chunksize"], {
+            "type": int,
+            "default": CHUNK_SIZE,
+            "help": "Number of records each worker probes at a time"
+        }),
+    ]
+
+    @staticmethod
+    def hook(parser, args):
+        if args.output is None:
+            f = sys.stdout
+        else:
+            f = open(args.output, "w", newline="")
+        try:
+            dedup(args.backend, f, args.max_distance, other_url=args.other,
+                  processes=args.parallel, chunk_size=args.chunksize)
+        finally:
+            if f is not sys.stdout:
+                f.close()
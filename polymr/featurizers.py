@@ -1,7 +1,15 @@
+from zlib import crc32 as _crc32
 from zlib import compress as _compress
+from functools import lru_cache
+from collections import defaultdict
 
 from . import util
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 def featurize_compress(rec):
     fs = set()
@@ -43,6 +51,243 @@ def featurize_k2(rec):
     return fs
 
 
+# Attribute values repeat a lot (states, cities, common names), so the
+# features of the most recent distinct values are memoized.
+MEMO_SIZE = 1 << 16
+
+
+def _encode(attr):
+    return attr.encode()
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def _encode_compressed(attr):
+    return _compress(attr.encode())[2:]
+
+
+# Featurizers that take the k-grams of each attribute after encoding it
+# one way or another, so their tokens can be packed into integers:
+# name -> (encode, k)
+packable = dict(k4=(_encode, 4),
+                k3=(_encode, 3),
+                k2=(_encode, 2),
+                compress=(_encode_compressed, 3),
+                compress_k4=(_encode_compressed, 4),
+                default=(_encode_compressed, 3))
+
+_SHORT = 1 << 63
+
+
+def pack_ngrams(blobs, owners, k):
+    """Find the k-grams of many byte strings at once, each packed big
+    endian into a uint64 so they sort like the bytes they came from.
+    As in ``util.ngrams``, a string shorter than ``k`` is one token; it's
+    tagged with the top bit and its length. ``k`` must be below 8.
+
+    :param blobs: The strings
+    :type blobs: list of bytes
+
+    :param owners: The id each string belongs to
+    :type owners: numpy.ndarray
+
+    :returns: The distinct (token, owner) pairs, sorted by token then
+      owner, as two arrays
+    :rtype: tuple of numpy.ndarray
+    """
+    lens = np.fromiter(map(len, blobs), np.int64, len(blobs))
+    buf = np.frombuffer(b"".join(blobs), np.uint8).astype(np.uint64)
+    n = max(len(buf) - k + 1, 0)
+    toks = buf[:n].copy()
+    for j in range(1, k):
+        toks <<= np.uint64(8)
+        toks |= buf[j:n + j]
+    # drop the windows that run past the end of their string
+    blob_of = np.repeat(np.arange(len(blobs)), lens)[:n]
+    starts = np.cumsum(lens) - lens
+    ok = np.arange(n) - starts[blob_of] <= lens[blob_of] - k
+    toks, ids = toks[ok], owners[blob_of[ok]]
+    short = np.flatnonzero(lens < k)
+    if len(short):
+        tagged = [_SHORT | len(blobs[i]) << 56
+                  | int.from_bytes(blobs[i], "big") for i in short]
+        toks = np.concatenate([toks, np.array(tagged, np.uint64)])
+        ids = np.concatenate([ids, owners[short]])
+    return _distinct_pairs(toks, ids)
+
+
+def _distinct_pairs(toks, ids):
+    order = np.lexsort((ids, toks))
+    toks, ids = toks[order], ids[order]
+    keep = np.ones(len(toks), bool)
+    keep[1:] = (toks[1:] != toks[:-1]) | (ids[1:] != ids[:-1])
+    return toks[keep], ids[keep]
+
+
+def _spread(toks, vids, owners_of, counts):
+    # Turn (token, value) pairs into (token, record) pairs, one for each
+    # record holding the value. owners_of lists the records holding each
+    # value, grouped by value; counts is the size of each group.
+    reps = counts[vids]
+    starts = np.cumsum(counts) - counts
+    offsets = np.arange(reps.sum()) - np.repeat(np.cumsum(reps) - reps, reps)
+    return (np.repeat(toks, reps),
+            owners_of[np.repeat(starts[vids], reps) + offsets])
+
+
+def unpack_token(tok, k):
+    """The bytes a token from ``pack_ngrams`` was packed from"""
+    tok = int(tok)
+    if tok & _SHORT:
+        size = tok >> 56 & 0x7f
+        return (tok & ((1 << 56) - 1)).to_bytes(size, "big")
+    return tok.to_bytes(k, "big")
+
+
+_memos = {}
+
+
+def attr_features(featurizer_name):
+    """A memoized function giving the features of one attribute value.
+    A record's features are the union of its attributes' features.
+
+    :raises KeyError: If the name isn't a featurizer
+    """
+    try:
+        return _memos[featurizer_name]
+    except KeyError:
+        pass
+    features = get(featurizer_name)
+
+    @lru_cache(maxsize=MEMO_SIZE)
+    def features_of(attr):
+        return frozenset(features([attr]))
+
+    _memos[featurizer_name] = features_of
+    return features_of
+
+
+def featurize_many(featurizer_name, fields_list):
+    """Featurize a batch of records, reusing the features of attribute
+    values seen recently instead of computing them again.
+
+    :param fields_list: The fields of each record
+    :type fields_list: iterable of list of str
+
+    :returns: The features of each record
+    :rtype: list of frozenset of bytes
+    """
+    features_of = attr_features(featurizer_name)
+    return [frozenset().union(*map(features_of, fields))
+            for fields in fields_list]
+
+
+def tokmap(featurizer_name, idxs_fields):
+    """Featurize many records, mapping each token to the ids of the
+    records that have it. Packable featurizers run vectorized over the
+    whole batch when numpy is installed, finding the n-grams of each
+    distinct attribute value once.
+
+    :param idxs_fields: The record id, fields pairs
+    :type idxs_fields: iterable of (int, list of str) pairs
+
+    :rtype: dict of bytes to list of int
+    """
+    base, bits = parse_name(featurizer_name)
+    if bits:
+        return _hash_tokmap(tokmap(base, idxs_fields), bits)
+    if np is None or featurizer_name not in packable:
+        idxs_fields = list(idxs_fields)
+        batch = featurize_many(featurizer_name,
+                               (fields for _, fields in idxs_fields))
+        ret = defaultdict(list)
+        for (i, _), toks in zip(idxs_fields, batch):
+            for tok in toks:
+                ret[tok].append(i)
+        return ret
+    encode, k = packable[featurizer_name]
+    values, vids, owners = {}, [], []
+    for i, fields in idxs_fields:
+        for attr in fields:
+            vids.append(values.setdefault(attr, len(values)))
+        owners.extend([i] * len(fields))
+    vids = np.array(vids, np.int64)
+    by_value = np.argsort(vids, kind="stable")
+    toks, tvids = pack_ngrams(list(map(encode, values)),
+                              np.arange(len(values)), k)
+    toks, ids = _distinct_pairs(*_spread(
+        toks, tvids, np.array(owners, np.int64)[by_value],
+        np.bincount(vids, minlength=len(values))))
+    bounds = np.flatnonzero(toks[1:] != toks[:-1]) + 1
+    firsts = toks[np.concatenate([[0], bounds])] if len(toks) else toks
+    return {unpack_token(tok, k): group.tolist()
+            for tok, group in zip(firsts.tolist(), np.split(ids, bounds))}
+
+
+HASH_BITS_MIN = 8
+HASH_BITS_MAX = 28
+
+
+def parse_name(featurizer_name):
+    """Split a featurizer name into the name of the featurizer making the
+    tokens and, for a hashed name like ``default:h20``, the bit width of
+    the token ids. The width is ``None`` for other names.
+
+    :raises KeyError: If the name isn't a featurizer
+    """
+    base, sep, suffix = featurizer_name.partition(":")
+    if base not in all:
+        raise KeyError(featurizer_name)
+    if not sep:
+        return base, None
+    if not (suffix[:1] == "h" and suffix[1:].isdigit()
+            and HASH_BITS_MIN <= int(suffix[1:]) <= HASH_BITS_MAX):
+        raise KeyError(featurizer_name)
+    return base, int(suffix[1:])
+
+
+def token_id(tok, bits):
+    """The id a token hashes to in a ``bits`` wide token space, as four
+    big endian bytes"""
+    return (_crc32(tok) & ((1 << bits) - 1)).to_bytes(4, "big")
+
+
+def hashed(features, bits):
+    """Wrap a featurizer so it makes token ids instead of tokens. Tokens
+    that hash to the same id become one token, so an index trades some
+    precision for a vocabulary that is a flat array of ``2 ** bits``
+    frequencies and token keys of a fixed four bytes.
+    """
+    def featurize_hashed(rec):
+        return {token_id(tok, bits) for tok in features(rec)}
+    return featurize_hashed
+
+
+def _hash_tokmap(tokmap, bits):
+    ret = {}
+    collided = set()
+    for tok, ids in tokmap.items():
+        tid = token_id(tok, bits)
+        if tid in ret:
+            ret[tid].extend(ids)
+            collided.add(tid)
+        else:
+            ret[tid] = list(ids)
+    for tid in collided:
+        ret[tid] = sorted(set(ret[tid]))
+    return ret
+
+
+def get(featurizer_name):
+    """The featurizer named ``featurizer_name``, which may be hashed
+
+    :raises KeyError: If the name isn't a featurizer
+    """
+    base, bits = parse_name(featurizer_name)
+    if bits:
+        return hashed(all[base], bits)
+    return all[base]
+
+
 all = dict(k4=featurize_k4,
            k3=featurize_k3,
            k2=featurize_k2,
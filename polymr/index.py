@@ -1,24 +1,30 @@
 import os
 import sys
+import gzip
+import queue
+import struct
 import logging
+import threading
 import multiprocessing
 import contextlib
+from array import array
+from collections import Counter
+from bisect import bisect_right
+from functools import partial
 from tempfile import NamedTemporaryFile
-from gzip import GzipFile as CompressedFile
 from heapq import merge as _merge
-from base64 import b64encode
-from base64 import b64decode
+from heapq import nlargest
 from itertools import groupby
 from itertools import repeat
 from itertools import chain
-from collections import defaultdict
+from itertools import islice
 from operator import itemgetter
 
 from toolz import partition_all
-from toolz.dicttoolz import merge_with
 
 from . import storage
 from . import record
+from . import score
 from . import util
 from . import featurizers
 
@@ -28,71 +34,273 @@ cat = chain.from_iterable
 
 logger = logging.getLogger(__name__)
 
+RUN_BUFSIZE = 1 << 20
+MERGE_FANIN = 256
+SKETCH_SIZE = 1 << 16
+RECORD_BATCH_SIZE = 5000
+RECORD_QUEUE_SIZE = 8
+# Records featurized up front to choose the partitions' split points
+SPLIT_SAMPLE_SIZE = 10000
+run_codecs = ("none", "gzip")
 
-def _ef_worker(args):
-    chunk, featurizer_name = args
-    features = featurizers.all[featurizer_name]
-    ksets = [(i, features(rec.fields)) for i, rec in chunk]
-    d = defaultdict(list)
-    for i, kset in ksets:
-        for kmer in kset:
-            d[b64encode(kmer)].append(i)
-    kmer_is = [(kmer.decode(), ",".join(map(str, sorted(rset))))
-               for kmer, rset in d.items()]
-    tmpfile = NamedTemporaryFile(dir=".", suffix="polymr_tmp_chunk.txt.gz",
-                                 delete=False)
-    fname = tmpfile.name
-    with CompressedFile(fileobj=tmpfile, mode='w') as f:
-        for kmer, ids in sorted(kmer_is):
-            data = "|".join((kmer, ids))+"\n"
-            f.write(data.encode())
-    return fname
+# Each run file entry is a header (token length, number of ids, array
+# typecode of the ids), followed by the raw token bytes and the packed,
+# ascending record ids.
+_RUN_HEADER = struct.Struct("<HIc")
 
 
-def _initializer(tmpdir):
-    if not os.path.exists(tmpdir):
-        os.mkdir(tmpdir)
-    os.chdir(tmpdir)
+def _open_run(fname, mode, codec="none"):
+    if codec == "gzip":
+        return gzip.open(fname, mode, compresslevel=1)
+    return open(fname, mode, buffering=RUN_BUFSIZE)
 
 
-def _tmpparse_split(fobj):
-    for line in fobj:
-        kmer, ids = line.strip().split(b"|")
-        ids = list(map(int, ids.decode().split(',')))
-        yield kmer, ids
+def _tmpname():
+    with NamedTemporaryFile(dir=".", suffix="polymr_tmp_chunk.run",
+                            delete=False) as f:
+        return f.name
 
 
-def _tmpparse(fobj):
-    for line in fobj:
-        kmer, ids = line.strip().split(b"|")
+def _write_run_entry(f, kmer, ids):
+    typecode = b'I' if ids[-1] < (1 << 32) else b'L'
+    f.write(_RUN_HEADER.pack(len(kmer), len(ids), typecode))
+    f.write(kmer)
+    f.write(array(typecode.decode(), ids).tobytes())
+
+
+def _read_run(f):
+    read = f.read
+    unpack = _RUN_HEADER.unpack
+    size = _RUN_HEADER.size
+    while True:
+        header = read(size)
+        if not header:
+            return
+        klen, n, typecode = unpack(header)
+        kmer = read(klen)
+        ids = array(typecode.decode())
+        ids.frombytes(read(n * ids.itemsize))
         yield kmer, ids
 
 
-def _merge_tmpfiles(fnames):
-    tmpout = NamedTemporaryFile(dir='.', suffix="polymr_tmp_chunk.txt.gz",
-                                delete=False)
+def _merge_runs(fileobjs):
+    kmer_ids = _merge(*map(_read_run, fileobjs), key=fst)
+    for kmer, kmer_chunks in groupby(kmer_ids, key=fst):
+        chunks = list(map(snd, kmer_chunks))
+        if len(chunks) == 1:
+            yield kmer, chunks[0]
+        else:
+            yield kmer, sorted(cat(chunks))
+
+
+class _HeavyHitters:
+    """Weighted Misra-Gries summary.
+
+    Counts never exceed the true frequency of a token, so a token whose
+    count is above a threshold is certainly above it.
+    """
+
+    def __init__(self, size=SKETCH_SIZE):
+        self.size = size
+        self.counts = {}
+
+    def update(self, toks_cnts):
+        counts = self.counts
+        for tok, cnt in toks_cnts:
+            counts[tok] = counts.get(tok, 0) + cnt
+        if len(counts) > self.size:
+            cut = nlargest(self.size + 1, counts.values())[-1]
+            self.counts = {tok: cnt - cut for tok, cnt in counts.items()
+                           if cnt > cut}
+
+    def over(self, threshold):
+        return {tok for tok, cnt in self.counts.items() if cnt > threshold}
+
+
+def _max_df_count(max_df, rowcount):
+    if max_df is None:
+        return None
+    if isinstance(max_df, float):
+        if rowcount is None:
+            return None
+        return int(max_df * rowcount)
+    return max_df
+
+
+def _split_points(kmers, nparts):
+    """The tokens at which to cut the token space so each of ``nparts``
+    partitions gets about as many of ``kmers``, a sample of the tokens
+    to be partitioned. There are fewer when the sample is too small.
+    """
+    kmers = sorted(set(kmers))
+    return sorted({kmers[len(kmers) * i // nparts]
+                   for i in range(1, nparts)}) if kmers else []
+
+
+def _partition_of(kmer, splits):
+    # Range partitioning keeps partitions contiguous in token order, so
+    # concatenating them in order is still sorted.
+    return bisect_right(splits, kmer)
+
+
+_sketch = None
+_toobig = set()
+
+
+def _prune(d, max_df):
+    global _sketch
+    if _sketch is None:
+        _sketch = _HeavyHitters()
+    _sketch.update((kmer, len(ids)) for kmer, ids in d.items())
+    found = {kmer for kmer, ids in d.items() if len(ids) > max_df}
+    found |= _sketch.over(max_df)
+    new = found - _toobig
+    _toobig.update(new)
+    return {kmer for kmer in d if kmer in _toobig}, new
+
+
+def _ef_worker(args):
+    (chunk_no, chunk), featurizer_name, codec, splits, max_df = args
+    d = featurizers.tokmap(featurizer_name, chunk)
+    n_tokens = Counter(cat(d.values()))
+    sizes = [(idx, n_tokens[idx], score.sizes(fields))
+             for idx, fields in chunk]
+    drop, new_toobig = set(), set()
+    if max_df is not None:
+        drop, new_toobig = _prune(d, max_df)
+    fnames = [None] * (len(splits) + 1)
+    with contextlib.ExitStack() as stack:
+        for kmer, ids in sorted(d.items()):
+            if kmer in drop:
+                continue
+            part = _partition_of(kmer, splits)
+            if fnames[part] is None:
+                fnames[part] = _tmpname()
+                f = stack.enter_context(
+                    _open_run(fnames[part], 'wb', codec))
+            _write_run_entry(f, kmer, ids)
+    return chunk_no, fnames, new_toobig, sizes
+
+
+def _initializer(tmpdir):
+    if not os.path.exists(tmpdir):
+        os.mkdir(tmpdir)
+    os.chdir(tmpdir)
+
+
+def _merge_tmpfiles(fnames, codec="none", max_df=None, toobig=None,
+                    remove=True):
+    outname = _tmpname()
     freqs = {}
+    if toobig is None:
+        toobig = set()
     with contextlib.ExitStack() as stack:
-        fileobjs = [stack.enter_context(CompressedFile(fname, 'r'))
+        fileobjs = [stack.enter_context(_open_run(fname, 'rb', codec))
                     for fname in fnames]
-        with CompressedFile(fileobj=tmpout, mode='w') as outf:
-            kmer_ids = _merge(*map(_tmpparse, fileobjs), key=fst)
-            for kmer, ids in kmer_ids:
+        with _open_run(outname, 'wb', codec) as outf:
+            for kmer, ids in _merge_runs(fileobjs):
+                if kmer in toobig:
+                    continue
+                if max_df is not None and len(ids) > max_df:
+                    # Counts from a partial merge only grow, so the
+                    # token can be dropped for good.
+                    toobig.add(kmer)
+                    continue
                 freqs[kmer] = len(ids)
-                outf.write(b"|".join((kmer, ids))+b"\n")
+                _write_run_entry(outf, kmer, ids)
+    if remove:
+        for fname in fnames:
+            os.remove(fname)
+    return outname, freqs
+
+
+def _merge_partition(part_fnames_toobig, codec="none", max_df=None):
+    part, fnames, toobig = part_fnames_toobig
+    # the partition's own runs are removed by the caller once the merge
+    # has been checkpointed
+    remove = False
+    while len(fnames) > MERGE_FANIN:
+        fnames = [_merge_tmpfiles(group, codec, max_df, toobig, remove)[0]
+                  for group in partition_all(MERGE_FANIN, fnames)]
+        remove = True
+    tmpname, freqs = _merge_tmpfiles(fnames, codec, max_df, toobig, remove)
+    return part, tmpname, freqs, len(toobig)
+
+
+def _merge_and_save_partition(part_fnames_toobig, codec, backend_url,
+                              max_df=None):
+    part, tmpname, freqs, n_toobig = _merge_partition(part_fnames_toobig,
+                                                      codec, max_df)
+    backend = storage.parse_url(backend_url)
+    try:
+        if freqs:
+            backend.save_freqs(freqs)
+            backend.save_tokens(_readfeatures([tmpname], set(), codec))
+    finally:
+        backend.close()
+    os.remove(tmpname)
+    return part, len(freqs), n_toobig
+
+
+def _readfeatures(tmpnames, toobig, codec="none"):
+    for tmpname in tmpnames:
+        with _open_run(tmpname, 'rb', codec) as f:
+            for kmer, ids in _read_run(f):
+                if kmer not in toobig:
+                    yield kmer, ids
+
+
+def _peek(iterable, n):
+    # The first n items and an iterator over all of them. An error
+    # reading the first few is raised again when the iterator gets to it.
+    it = iter(iterable)
+    head = []
+    try:
+        for item in islice(it, n):
+            head.append(item)
+    except Exception as e:
+        error = e
+
+        def _rest():
+            raise error
+            yield
+        return head, chain(head, _rest())
+    return head, chain(head, it)
+
+
+def _until_error(iterable, errors):
+    # Stops cleanly on an error so the chunks already handed to the pool
+    # can finish and be checkpointed before the error is raised.
+    try:
+        yield from iterable
+    except Exception as e:
+        errors.append(e)
+
+
+def _run_freqs(tmpname, codec="none"):
+    with _open_run(tmpname, 'rb', codec) as f:
+        return {kmer: len(ids) for kmer, ids in _read_run(f)}
+
+
+def _remove_all(fnames):
     for fname in fnames:
-        os.remove(fname)
-    return tmpout.name, freqs
+        if os.path.exists(fname):
+            os.remove(fname)
 
 
-def _mergefeatures(tmpnames, toobig):
-    with contextlib.ExitStack() as stack:
-        fileobjs = [stack.enter_context(CompressedFile(fname, 'r'))
-                    for fname in tmpnames]
-        kmer_ids = _merge(*map(_tmpparse_split, fileobjs), key=fst)
-        kmer_ids = iter(x for x in kmer_ids if x[0] not in toobig)
-        for kmer, kmer_chunks in groupby(kmer_ids, key=fst):
-            yield kmer, list(cat(map(snd, kmer_chunks)))
+def _parse_featurizer(s):
+    try:
+        featurizers.parse_name(s)
+    except KeyError:
+        raise ValueError(s)
+    return s
+
+
+def _parse_max_df(s):
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
 
 
 def records(input_records, backend):
@@ -100,39 +308,237 @@ def records(input_records, backend):
     backend.save_rowcount(rowcount)
 
 
-def _parse_and_save_records(input_records, backend):
-    batches = partition_all(5000, enumerate(input_records))
+class _RecordWriter:
+    """Saves batches of records on background threads.
+
+    The queue is bounded so a slow backend holds back parsing instead of
+    buffering the whole input in memory.
+    """
+
+    def __init__(self, backend, nthreads=1, maxsize=RECORD_QUEUE_SIZE):
+        self.backend = backend
+        self.rowcount = 0
+        self.saved = []
+        self.error = None
+        self._q = queue.Queue(maxsize)
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(nthreads)]
+        for t in self._threads:
+            t.start()
+
+    def _run(self):
+        for idxs_recs in iter(self._q.get, None):
+            # keep draining after a failure so put() never blocks forever
+            if self.error is not None:
+                continue
+            try:
+                self.backend.save_records(idxs_recs)
+            except BaseException as e:
+                self.error = e
+            else:
+                self.saved.append(fst(idxs_recs[0]))
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, idxs_recs):
+        self._check()
+        self._q.put(idxs_recs)
+        self.rowcount += len(idxs_recs)
+
+    def skip(self, idxs_recs):
+        self.rowcount += len(idxs_recs)
+
+    def close(self):
+        for _ in self._threads:
+            self._q.put(None)
+        for t in self._threads:
+            t.join()
+        self._check()
+
+
+def _parse_and_save_records(input_records, writer, skip=frozenset()):
+    batches = partition_all(RECORD_BATCH_SIZE, enumerate(input_records))
     for idxs_recs in batches:
-        backend.save_records(idxs_recs)
-        for i, rec in idxs_recs:
-            yield i, rec._replace(data=[])
-    backend.save_rowcount(i + 1)
+        if fst(idxs_recs[0]) in skip:
+            writer.skip(idxs_recs)
+        else:
+            writer.put(idxs_recs)
+        yield from ((i, rec.fields) for i, rec in idxs_recs)
+
+
+def _chunks_to_do(chunks, done_chunks, sizes, featurizer_name):
+    for chunk_no, chunk in chunks:
+        if sizes.width is None:
+            # as wide as the first record's row, whichever chunk is
+            # featurized first
+            sizes.width = len(snd(chunk[0])) + 1
+        if chunk_no in done_chunks:
+            # the sizes found by the workers before the build stopped
+            # weren't kept
+            sizes.update(featurizer_name, chunk)
+        else:
+            yield chunk_no, chunk
 
 
 def create(input_records, nproc, chunksize, backend,
-           tmpdir="/tmp", featurizer_name='default'):
-    pool = multiprocessing.Pool(nproc, _initializer, (tmpdir,))
-    recs = _parse_and_save_records(input_records, backend)
-    chunks = partition_all(chunksize, recs)
-    tmpnames = pool.imap_unordered(
-        _ef_worker, zip(chunks, repeat(featurizer_name)), chunksize=1)
-    tmpnames = list(tmpnames)
-    tmpchunks = partition_all(len(tmpnames)//nproc + 1, tmpnames)
-    tmpnames_minifreqs = pool.imap_unordered(
-        _merge_tmpfiles, tmpchunks, chunksize=1)
-    tmpnames, minifreqs = zip(*list(tmpnames_minifreqs))
-    tokfreqs = merge_with(sum, minifreqs)
-    toobig = set()
-    backend.save_freqs({b64decode(k): v for k, v in tokfreqs.items() if k not in toobig})
-    del tokfreqs
-    tokens = _mergefeatures(tmpnames, toobig)
-    for name, ids in tokens:
-        backend.save_token(b64decode(name), ids)
-    for tmpname in tmpnames:
-        os.remove(tmpname)
+           tmpdir="/tmp", featurizer_name='default', run_codec='none',
+           backend_url=None, max_df=None, record_writers=1,
+           manifest=None, resume=False):
+    """Index ``input_records`` into ``backend``.
+
+    Tokens found in more than ``max_df`` records are not indexed. An
+    int is an absolute number of records, a float a fraction of the
+    rowcount. Workers drop such tokens as soon as they can be sure of
+    it; a fraction can only be resolved that early when
+    ``input_records`` has a length.
+
+    Records are saved by ``record_writers`` threads while the workers
+    featurize them.
+
+    Progress is checkpointed to the ``manifest`` file if one is given.
+    With ``resume``, a build that was interrupted picks up from its
+    manifest; ``input_records`` must be the same input as before. The
+    backend's writes must be durable and safe to repeat, so not a
+    RocksDB bulk load.
+
+    :raises ValueError: If a manifest is given for a backend without
+      durable writes
+    """
+    if manifest is not None and not backend.durable_writes:
+        raise ValueError("Can't checkpoint this build: the backend's "
+                         "writes aren't durable as they're made, so a "
+                         "resumed build would miss some of them")
+    params = {"chunksize": chunksize, "nparts": nproc,
+              "featurizer": featurizer_name, "run_codec": run_codec,
+              "max_df": max_df, "record_batch_size": RECORD_BATCH_SIZE}
+    manifest = util.Manifest(manifest, params, resume, chunks={},
+                             record_batches=[], merged={}, saved={},
+                             splits=None)
+    if manifest.state["done"]:
+        logger.info("Index build already complete")
+        return
+    with backend.bulk_load(), \
+            multiprocessing.Pool(nproc, _initializer, (tmpdir,)) as pool:
+        _create(pool, input_records, nproc, chunksize, backend,
+                featurizer_name, run_codec, backend_url, max_df,
+                record_writers, manifest)
+
+
+def _create(pool, input_records, nproc, chunksize, backend,
+            featurizer_name, run_codec, backend_url, max_df,
+            record_writers, manifest):
+    state = manifest.state
+    try:
+        early_max_df = _max_df_count(max_df, len(input_records))
+    except TypeError:
+        early_max_df = _max_df_count(max_df, None)
+    if state.get("splits") is None:
+        # a resumed build partitions its runs as the first attempt did
+        sample, input_records = _peek(input_records, SPLIT_SAMPLE_SIZE)
+        splits = []
+        if nproc > 1:
+            splits = _split_points(featurizers.tokmap(
+                featurizer_name,
+                ((i, rec.fields) for i, rec in enumerate(sample))), nproc)
+        state["splits"] = [kmer.hex() for kmer in splits]
+    splits = [bytes.fromhex(kmer) for kmer in state["splits"]]
+    done_chunks = set(map(int, state["chunks"]))
+    if done_chunks:
+        logger.info("Resuming after %i finished chunks", len(done_chunks))
+    writer = _RecordWriter(backend, record_writers)
+    sizes = storage.RecordSizes()
+    errors = []
+    try:
+        recs = _parse_and_save_records(input_records, writer,
+                                       set(state["record_batches"]))
+        chunks = _chunks_to_do(enumerate(partition_all(chunksize, recs)),
+                               done_chunks, sizes, featurizer_name)
+        chunks = _until_error(chunks, errors)
+        runs = pool.imap_unordered(
+            _ef_worker,
+            zip(chunks, repeat(featurizer_name), repeat(run_codec),
+                repeat(splits), repeat(early_max_df)),
+            chunksize=1)
+        for chunk_no, fnames, new_toobig, chunk_sizes in runs:
+            for idx, n_tokens, attr_sizes in chunk_sizes:
+                sizes.set(idx, n_tokens, attr_sizes)
+            state["chunks"][str(chunk_no)] = {
+                "runs": fnames,
+                "toobig": [kmer.hex() for kmer in new_toobig]
+            }
+            state["record_batches"] = sorted(
+                set(state["record_batches"]).union(list(writer.saved)))
+            manifest.save()
+        if errors:
+            raise errors[0]
+    finally:
+        writer.close()
+    state["record_batches"] = sorted(
+        set(state["record_batches"]).union(writer.saved))
+    manifest.save()
+    backend.save_rowcount(writer.rowcount)
+    backend.save_sizes(sizes)
+    del sizes
+    chunk_runs = list(state["chunks"].values())
+    toobig = {bytes.fromhex(kmer) for c in chunk_runs for kmer in c["toobig"]}
+    max_df = _max_df_count(max_df, writer.rowcount)
+    partitions, part_runs = [], {}
+    finished = set(state["merged"]).union(state["saved"])
+    for part, fnames in enumerate(zip(*(c["runs"] for c in chunk_runs))):
+        part_runs[part] = list(filter(None, fnames))
+        if str(part) in finished:
+            _remove_all(part_runs[part])
+            continue
+        part_toobig = {kmer for kmer in toobig
+                       if _partition_of(kmer, splits) == part}
+        partitions.append((part, part_runs[part], part_toobig))
+    del toobig
+    if backend_url is not None and backend.concurrent_writes:
+        saver = partial(_merge_and_save_partition, codec=run_codec,
+                        backend_url=backend_url, max_df=max_df)
+        for part, n_toks, n_toobig in pool.imap_unordered(
+                saver, partitions, chunksize=1):
+            state["saved"][str(part)] = [n_toks, n_toobig]
+            manifest.save()
+            _remove_all(part_runs[part])
+        n_toks = sum(map(fst, state["saved"].values()))
+        n_toobig = sum(map(snd, state["saved"].values()))
+        logger.info("Saved %i tokens from %i partitions",
+                    n_toks, len(state["saved"]))
+        tmpnames = []
+    else:
+        minifreqs = {}
+        merger = partial(_merge_partition, codec=run_codec, max_df=max_df)
+        for part, tmpname, freqs, n_toobig in pool.imap(
+                merger, partitions, chunksize=1):
+            state["merged"][str(part)] = [tmpname, n_toobig]
+            manifest.save()
+            _remove_all(part_runs[part])
+            minifreqs[part] = freqs
+        merged = sorted((int(part), tmpname, n) for part, (tmpname, n)
+                        in state["merged"].items())
+        tmpnames = [tmpname for _, tmpname, _ in merged]
+        n_toobig = sum(n for _, _, n in merged)
+        tokfreqs = storage.empty_freqs(featurizer_name)
+        for part, tmpname, _ in merged:
+            freqs = minifreqs.pop(part, None)
+            if freqs is None:
+                freqs = _run_freqs(tmpname, run_codec)
+            tokfreqs.update(freqs)
+        backend.save_freqs(tokfreqs)
+        del tokfreqs
+        tokens = _readfeatures(tmpnames, set(), run_codec)
+        backend.save_tokens(tokens)
+    if max_df is not None:
+        logger.info("Dropped %i tokens found in more than %i records",
+                    n_toobig, max_df)
     backend.save_featurizer_name(featurizer_name)
-    pool.close()
-    pool.join()
+    backend.featurizer_name = featurizer_name
+    state["done"] = True
+    manifest.save()
+    _remove_all(tmpnames)
 
 
 class CLI:
@@ -173,9 +579,39 @@ class CLI:
             "default": 50000
         }),
         (["--featurizer"], {
-            "help": "The featurizer to use when indexing records",
+            "help": ("The featurizer to use when indexing records: one "
+                     "of %s. Append :hN, N from %i to %i, to hash tokens "
+                     "into N bit ids." % (", ".join(featurizers.all),
+                                          featurizers.HASH_BITS_MIN,
+                                          featurizers.HASH_BITS_MAX)),
             "default": 'default',
-            "choices": featurizers.all
+            "type": _parse_featurizer
+        }),
+        (["--max-df"], {
+            "help": ("Don't index tokens found in more than this many "
+                     "records. A fraction is relative to the number of "
+                     "records."),
+            "type": _parse_max_df,
+            "default": None
+        }),
+        (["--record-writers"], {
+            "help": "Number of threads saving records during the build",
+            "type": int,
+            "default": 1
+        }),
+        (["--manifest"], {
+            "help": ("Record build progress in this file so an "
+                     "interrupted build can be resumed")
+        }),
+        (["--resume"], {
+            "help": ("Resume the build recorded in --manifest, skipping "
+                     "the work already done. The input must be the same."),
+            "action": "store_true"
+        }),
+        (["--run-codec"], {
+            "help": "Compression for temporary run files",
+            "default": 'none',
+            "choices": run_codecs
         }),
     ]
 
@@ -188,6 +624,11 @@ class CLI:
             parser.print_help()
             sys.exit(1)
 
+        if args.resume and args.manifest is None:
+            print("--resume requires --manifest", file=sys.stderr)
+            parser.print_help()
+            sys.exit(1)
+
         record_parser = record.readers[args.reader]
         backend = storage.parse_url(args.backend)
         with util.openfile(args.input or sys.stdin) as inp:
@@ -199,4 +640,10 @@ class CLI:
             )
             return create(recs, args.parallel, args.chunksize,
                           backend, tmpdir=args.tmpdir,
-                          featurizer_name=args.featurizer)
+                          featurizer_name=args.featurizer,
+                          run_codec=args.run_codec,
+                          backend_url=args.backend,
+                          max_df=args.max_df,
+                          record_writers=args.record_writers,
+                          manifest=args.manifest,
+                          resume=args.resume)
@@ -0,0 +1,163 @@
+"""Search an index for every record of a file, writing the best matches
+of each as they're found.
+
+Queries are read from the input as the workers of a ``ParallelIndex``
+free up and each result is written out as soon as the ones before it
+are, so neither the input nor the output is ever held in memory.
+"""
+import csv
+import sys
+import json
+import logging
+from collections import deque
+
+from . import query
+from . import record
+from . import storage
+from . import util
+from .query import defaults
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("jsonl", "csv")
+FIELDS = ["query_pk", "rank", "pk", "score", "rownum"]
+
+
+def link(index, records, f, fmt="jsonl", limit=defaults.limit,
+         r=defaults.r, n=defaults.n, k=defaults.k):
+    """Search ``index`` for the fields of each of ``records``, writing
+    the results to the text file ``f`` in input order.
+
+    As ``jsonl``, each line is an object with the query's ``pk`` and
+    ``fields`` and either its ``results``, as from ``Index.search``, or
+    the ``error`` that failed it. As ``csv``, there's one ``FIELDS`` row
+    per result; failed queries are only logged.
+
+    :param index: The index to search
+    :type index: ParallelIndex
+
+    :param records: The queries
+    :type records: iterable of Record
+
+    :returns: The number of queries searched and the number that failed
+    :rtype: tuple of int
+    """
+    if fmt not in FORMATS:
+        raise ValueError("fmt must be one of %s, not %r"
+                         % (", ".join(FORMATS), fmt))
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+    # the queries handed to the index but not yet answered
+    pending = deque()
+
+    def _fields():
+        for rec in records:
+            pending.append(rec)
+            yield rec.fields
+
+    n_failed = 0
+    progress = storage._Throughput("queries", None, verb="Matched")
+    for result in index.searchmany(_fields(), limit=limit, r=r, n=n, k=k):
+        rec = pending.popleft()
+        if isinstance(result, Exception):
+            logger.warning("Query %r failed: %s", rec.pk, result)
+            n_failed += 1
+        if fmt == "csv":
+            if not isinstance(result, Exception):
+                writer.writerows(
+                    (rec.pk, rank, hit["pk"], hit["score"], hit["rownum"])
+                    for rank, hit in enumerate(result, 1))
+        elif isinstance(result, Exception):
+            f.write(json.dumps({"pk": rec.pk, "fields": rec.fields,
+                                "error": str(result)},
+                               default=util.json_default) + "\n")
+        else:
+            f.write(json.dumps({"pk": rec.pk, "fields": rec.fields,
+                                "results": result},
+                               default=util.json_default) + "\n")
+        progress.add(1)
+    logger.info("Matched %i queries, %i failed", progress.done, n_failed)
+    return progress.done, n_failed
+
+
+class CLI:
+
+    name = "link"
+
+    arguments = [
+        storage.backend_arg,
+        (["-i", "--input"], {
+            "help": "Records to search for. Defaults to stdin"
+        }),
+        (["-r", "--reader"], {
+            "help": "How to parse input. Defaults to csv.",
+            "choices": record.readers,
+            "default": "csv"
+        }),
+        (["--primary-key"], {
+            "type": int,
+            "default": -1,
+            "help": "Base 0 index of primary key in input data"}),
+        (["--search-idxs"], {
+            "type": str,
+            "help": ("Comma separated list of base 0 indices of "
+                     "attributes to search with.")}),
+        (["-o", "--output"], {
+            "help": "File to write results to. Defaults to stdout"
+        }),
+        (["--format"], {
+            "help": "How to write results. Defaults to jsonl.",
+            "choices": FORMATS,
+            "default": "jsonl"
+        }),
+        (["-n", "--parallel"], {
+            "type": int,
+            "default": 1,
+            "help": "Number of worker processes"
+        }),
+        (["--seeds"], {
+            "type": int,
+            "help": "The number of record votes to tally.",
+            "default": defaults.r}),
+        (["--search-space"], {
+            "type": int,
+            "help": ("The number of seed records to search through "
+                     "for best matches"),
+            "default": defaults.n}),
+        (["-l", "--limit"], {
+            "type": int,
+            "help": "The number of search results for each record",
+            "default": defaults.limit
+        }),
+    ]
+
+    @staticmethod
+    def hook(parser, args):
+        try:
+            sidxs = list(map(int, args.search_idxs.split(",")))
+        except AttributeError:
+            print("Error parsing --search-idxs", file=sys.stderr)
+            parser.print_help()
+            sys.exit(1)
+
+        record_parser = record.readers[args.reader]
+        index = query.ParallelIndex(args.backend, max(args.parallel, 1))
+        if args.output is None:
+            out = sys.stdout
+        else:
+            out = open(args.output, "w", newline="")
+        try:
+            with util.openfile(args.input or sys.stdin) as inp:
+                recs = record_parser(
+                    inp,
+                    searched_fields_idxs=sidxs,
+                    pk_field_idx=args.primary_key,
+                    include_data=False
+                )
+                link(index, recs, out, fmt=args.format, limit=args.limit,
+                     k=args.seeds, n=args.search_space)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+            index.backend.close()
@@ -1,9 +1,13 @@
+import sys
 import json
+import math
 import queue
 import logging
 import traceback
 import multiprocessing
+from heapq import heappush
 from heapq import nsmallest
+from heapq import heapreplace
 from collections import Counter
 from collections import OrderedDict
 from collections import defaultdict
@@ -12,15 +16,28 @@ from itertools import zip_longest
 from itertools import cycle
 from operator import itemgetter
 
+from toolz import partition_all
+
 from . import score
 from . import storage
 from . import featurizers
+from .util import jaccard
+from .util import json_default
 
 
 first = itemgetter(0)
 logger = logging.getLogger(__name__)
 cat = chain.from_iterable
 
+# Candidates are fetched in batches of this many, in order of their
+# score bound, when the index has record sizes.
+BOUND_BATCH_SIZE = 64
+# Slack for rounding when comparing a bound to a score
+_EPSILON = 1e-9
+# Threshold searches fetch the candidates left after filtering in
+# batches of this many
+VERIFY_BATCH_SIZE = 1000
+
 
 class defaults:
     n = 600
@@ -33,55 +50,212 @@ class Index(object):
     def __init__(self, backend):
         self.backend = backend
         self.rowcount = self.backend.get_rowcount()
-        self.featurizer = featurizers.all[self.backend.featurizer_name]
+        self.featurizer = featurizers.get(self.backend.featurizer_name)
+        self.sizes = self.backend.get_sizes()
 
     def _search(self, query, r, n, k):
         toks = self.featurizer(query)
-        toks = self.backend.find_least_frequent_tokens(toks, r, k)
-        r_map = Counter()
-        for i, tok in enumerate(toks, 1):
-            rng = self.backend.get_token(tok)
-            r_map.update(rng)
-        top_ids = map(first, r_map.most_common(n))
-        return list(top_ids)
+        return self.backend.search_candidates(toks, r, n, k)
 
     def _scored_records(self, record_ids, orig_query,
-                        extract_func=score.features, score_func=score.hit):
+                        extract_func=score.features, score_func=score.hit,
+                        records=None):
+        if records is None:
+            records = self.backend.get_records(record_ids)
         orig_features = extract_func(orig_query)
-        for rownum, r in zip(record_ids, self.backend.get_records(record_ids)):
+        for rownum, r in zip(record_ids, records):
             s = score_func(orig_features, extract_func(r.fields))
             yield s, rownum, r
 
+    def _bounded_scored_records(self, record_ids, query, limit):
+        # Fetch and score candidates from the lowest score bound up,
+        # stopping once no bound can beat the limit-th best score. The
+        # heap holds the best so far, worst on top; ties go to the
+        # candidate that came first, as with nsmallest.
+        query_sizes = score.sizes(query)
+        orig_features = score.features(query)
+        bounds = sorted(
+            (score.hit_bound(query_sizes, self.sizes.attrs(idx)), pos, idx)
+            for pos, idx in enumerate(record_ids))
+        best = []
+        for batch in partition_all(BOUND_BATCH_SIZE, bounds):
+            if len(best) == limit:
+                worst = -best[0][0] + _EPSILON
+                batch = [b for b in batch if b[0] <= worst]
+                if not batch:
+                    break
+            records = self.backend.get_records([idx for _, _, idx in batch])
+            for (_, pos, idx), rec in zip(batch, records):
+                s = score.hit(orig_features, score.features(rec.fields))
+                item = (-s, -pos, idx, rec)
+                if len(best) < limit:
+                    heappush(best, item)
+                elif item[:2] > best[0][:2]:
+                    heapreplace(best, item)
+        return [(-s, idx, rec) for s, _, idx, rec in sorted(best,
+                                                            reverse=True)]
+
     def search(self, query, limit=defaults.limit, r=defaults.r, n=defaults.n,
                k=None, extract_func=score.features, score_func=score.hit):
-        record_ids = self._search(query, r, n, k)
-        scores_records = self._scored_records(
-            record_ids, query, extract_func, score_func)
+        toks = self.featurizer(query)
+        if (self.sizes is not None and limit > 0
+                and extract_func is score.features
+                and score_func is score.hit):
+            record_ids = self.backend.search_candidates(toks, r, n, k)
+            best = self._bounded_scored_records(record_ids, query, limit)
+        else:
+            record_ids, records = self.backend.search_candidate_records(
+                toks, r, n, k)
+            scores_records = self._scored_records(
+                record_ids, query, extract_func, score_func, records)
+            best = nsmallest(limit, scores_records, key=first)
+        return [
+            {"fields": rec.fields, "pk": rec.pk, "score": s,
+             "data": rec.data, "rownum": rownum}
+            for s, rownum, rec in best
+        ]
+
+    def searchbatch(self, queries, limit=defaults.limit, r=defaults.r,
+                    n=defaults.n, k=None):
+        """Search for each of ``queries`` at once, finding what ``search``
+        would for each. The backend is read twice for the whole batch:
+        once for the posting lists of every query's tokens and once for
+        every candidate record, so tokens and records the queries share
+        are read only once.
+
+        :returns: The results of each query, in order
+        :rtype: list of list of dict
+        """
+        queries = list(queries)
+        toks_list = featurizers.featurize_many(
+            self.backend.featurizer_name, queries)
+        candidates = self.backend.search_candidates_many(toks_list, r, n, k)
+        idxs = sorted(set(cat(candidates)))
+        records = dict(zip(idxs, self.backend.get_records(idxs)))
+        ret = []
+        for query, record_ids in zip(queries, candidates):
+            scores_records = self._scored_records(
+                record_ids, query,
+                records=[records[idx] for idx in record_ids])
+            ret.append([
+                {"fields": rec.fields, "pk": rec.pk, "score": s,
+                 "data": rec.data, "rownum": rownum}
+                for s, rownum, rec in nsmallest(limit, scores_records,
+                                                key=first)
+            ])
+        return ret
+
+    def _prefix(self, toks, t):
+        # A record at least t similar to the query shares at least
+        # t * len(toks) of its tokens, so it has one of any
+        # len(toks) - ceil(t * len(toks)) + 1 of them. Those are taken
+        # from the rarest, tokens no record has first. Returns the ones
+        # with records to read, and how many query tokens follow them.
+        known = self.backend.find_least_frequent_tokens(toks, sys.maxsize)
+        n_unknown = len(toks) - len(known)
+        n_prefix = len(toks) - math.ceil(t * len(toks) - _EPSILON) + 1
+        return known[:max(n_prefix - n_unknown, 0)], len(toks) - n_prefix
+
+    def _filter_candidates(self, n_toks, shared, rest, t):
+        # shared counts the prefix tokens each record has
+        deleted = self.backend.get_deleted()
+        ret = []
+        for idx, n_shared in shared.items():
+            if idx in deleted:
+                continue
+            n_rec = self.sizes.tokens(idx) if self.sizes is not None else 0
+            if n_rec and n_rec < score.MAX_SIZE:
+                # length filter: the sizes alone bound the similarity
+                if not (t * n_toks - _EPSILON <= n_rec
+                        <= n_toks / t + _EPSILON):
+                    continue
+                need = t * (n_toks + n_rec) / (1 + t)
+                most = min(n_shared + rest, n_rec)
+            else:
+                need, most = t * n_toks, n_shared + rest
+            # positional filter: past the prefix, the record can share
+            # at most the rest of the query's tokens
+            if most >= need - _EPSILON:
+                ret.append(idx)
+        return sorted(ret)
+
+    def _prefix_candidates(self, toks, t):
+        prefix, rest = self._prefix(toks, t)
+        shared = Counter()
+        for ids in self.backend.get_tokens(prefix):
+            shared.update(ids)
+        return self._filter_candidates(len(toks), shared, rest, t)
+
+    def search_threshold(self, query, max_distance):
+        """Find every record within Jaccard distance ``max_distance`` of
+        ``query``, comparing the featurizer's tokens of each.
+
+        Unlike ``search``, nothing is missed. Ordered from the rarest, a
+        close enough record must share one of the query's first few
+        tokens, so only their records are read. Those ruled out by the
+        number of tokens they share there, or by their own number of
+        tokens, are dropped; the rest are fetched and checked. Tokens
+        left out of the index by ``max_df`` can't be read, so the
+        guarantee needs an index built without it.
+
+        :param max_distance: At least 0 and less than 1
+        :type max_distance: float
+
+        :returns: The records, closest first
+        :rtype: list of dict
+        """
+        if not 0 <= max_distance < 1:
+            raise ValueError("max_distance must be at least 0 and less "
+                             "than 1, not %r" % max_distance)
+        toks = set(self.featurizer(query))
+        if not toks:
+            return []
+        candidates = self._prefix_candidates(toks, 1 - max_distance)
+        hits = []
+        for chunk in partition_all(VERIFY_BATCH_SIZE, candidates):
+            records = list(self.backend.get_records(chunk))
+            rec_toks = featurizers.featurize_many(
+                self.backend.featurizer_name,
+                (rec.fields for rec in records))
+            for idx, rec, other in zip(chunk, records, rec_toks):
+                distance = jaccard(toks, other)
+                if distance <= max_distance + _EPSILON:
+                    hits.append((distance, idx, rec))
         return [
             {"fields": rec.fields, "pk": rec.pk, "score": s,
              "data": rec.data, "rownum": rownum}
-            for s, rownum, rec in nsmallest(limit, scores_records, key=first)
+            for s, rownum, rec in sorted(hits, key=lambda h: h[:2])
         ]
 
     def _save_records(self, records, idxs=[]):
         completed = []
+        created = []
         for rec, i in zip_longest(records, idxs):
             try:
-                idx = (self.backend.save_record(rec) if i is None
-                       else self.backend.update_record(rec, i))
+                if i is None:
+                    idx = self.backend.save_record(rec)
+                    created.append(idx)
+                else:
+                    idx = self.backend.update_record(rec, i)
             except:
-                for idx in completed:
+                for idx in created:
                     self.backend.delete_record(idx)
                 raise
             completed.append(idx)
-        self.backend.increment_rowcount(len(completed))
+        self._update_sizes(completed, records)
         return completed
 
+    def _update_sizes(self, idxs, records):
+        if self.sizes is None:
+            return
+        self.sizes.update(self.backend.featurizer_name,
+                          zip(idxs, (rec.fields for rec in records)))
+        self.backend.save_sizes(self.sizes, idxs)
+
     def _update_tokens(self, tokmap, freq_update):
         for tok in tokmap.keys():
             idxs = tokmap[tok]
-            self.backend.update_token(tok, idxs)
-            freq_update[tok] = len(idxs)
+            freq_update[tok] = self.backend.update_token(tok, idxs)
 
     def _update_tokens_and_freqs(self, tokmap):
         freq_update = {}
@@ -95,11 +269,69 @@ class Index(object):
 
     def add(self, records, idxs=[]):
         idxs = list(self._save_records(records, idxs))
+        tokmap = featurizers.tokmap(
+            self.backend.featurizer_name,
+            zip(idxs, (rec.fields for rec in records)))
+        self._update_tokens_and_freqs(tokmap)
+        return idxs
+
+    def _drop_tokens_and_freqs(self, tokmap):
+        freq_update = {}
+        for tok, idxs in tokmap.items():
+            freq_update[tok] = self.backend.drop_records_from_token(tok, idxs)
+        self.backend.update_freqs(freq_update.items())
+
+    def get_by_pk(self, pk):
+        """Get the record saved with a primary key.
+
+        :raises KeyError: If no record has that primary key
+        """
+        rownum = self.backend.get_rownum(pk)
+        rec = self.backend.get_record(rownum)
+        if rec.pk != pk:
+            raise KeyError(pk)
+        return {"fields": rec.fields, "pk": rec.pk, "data": rec.data,
+                "rownum": rownum}
+
+    def upsert(self, records):
+        """Add records, replacing in place any record already saved with
+        the same primary key. When several of ``records`` share a primary
+        key, the last one wins. Records without a primary key are always
+        added.
+
+        :returns: The record ids, one for each distinct primary key,
+          then one for each record without a primary key
+        :rtype: list of int
+        """
+        by_pk = OrderedDict()
+        no_pk = []
+        for rec in records:
+            if rec.pk is None or rec.pk == "":
+                no_pk.append(rec)
+                continue
+            by_pk.pop(rec.pk, None)
+            by_pk[rec.pk] = rec
+        records = list(by_pk.values()) + no_pk
+        idxs = self.backend.get_rownums(list(by_pk)) + [None] * len(no_pk)
+        existing = [idx for idx in idxs if idx is not None]
+        name = self.backend.featurizer_name
+        old_toks = dict(zip(existing, featurizers.featurize_many(
+            name, (rec.fields for rec
+                   in self.backend.get_records(existing)))))
+        idxs = self._save_records(records, idxs)
         tokmap = defaultdict(list)
-        for idx, rec in zip(idxs, records):
-            for tok in self.featurizer(rec.fields):
+        stale = defaultdict(list)
+        new_toks = featurizers.featurize_many(
+            name, (rec.fields for rec in records))
+        for idx, toks in zip(idxs, new_toks):
+            old = old_toks.get(idx, frozenset())
+            for tok in toks - old:
                 tokmap[tok].append(idx)
+            for tok in old - toks:
+                stale[tok].append(idx)
         self._update_tokens_and_freqs(tokmap)
+        if stale:
+            self._drop_tokens_and_freqs(stale)
         return idxs
 
     def close(self):
@@ -180,7 +412,8 @@ class ParallelIndex(Index):
         self.n_workers = n_workers
         self.backend = storage.backends[parsed.scheme].from_urlparsed(parsed)
         self.worker_rot8 = cycle(range(n_workers))
-        self.featurizer = featurizers.all[self.backend.featurizer_name]
+        self.featurizer = featurizers.get(self.backend.featurizer_name)
+        self.sizes = self.backend.get_sizes()
         self.started = False
 
     def _startup_workers(self):
@@ -214,7 +447,9 @@ class ParallelIndex(Index):
                         extract_func=score.features, score_func=score.hit):
         which_worker = next(self.worker_rot8)
         orig_features = extract_func(query)
-        blobs = [(i, self.backend._load_record_blob(i)) for i in record_ids]
+        deleted = self.backend.get_deleted()
+        blobs = [(i, self.backend._load_record_blob(i)) for i in record_ids
+                 if i not in deleted]
         self.work_qs[which_worker].put(
             (query_id, 'score_records',
              [orig_features, limit, blobs, extract_func, score_func])
@@ -241,56 +476,67 @@ class ParallelIndex(Index):
         finally:
             self.close(close_backend=False)
 
-    def _fill_work_queues(self, r, n, k):
+    def _fill_work_queues(self, r, n, k, send_later):
+        # Results held back for an earlier query count as in progress,
+        # so a slow query can't let the finished ones pile up.
         n_filled = 0
-        while len(self.in_progress) < len(self.workers)*3 and self.to_do:
-            query_id, query = self.to_do.popitem(last=False)
+        while (len(self.in_progress) + len(send_later)
+               < len(self.workers)*3 and self.to_do is not None):
+            try:
+                query_id, query = next(self.to_do)
+            except StopIteration:
+                self.to_do = None
+                break
             self._search(query_id, query, r, n, k)
             self.in_progress[query_id] = query
             n_filled += 1
         logger.debug("Added %i tasks to work queues", n_filled)
 
     def _searchmany(self, queries, limit, r, n, k, extract_func, score_func):
-        self.to_do = OrderedDict(enumerate(queries))
+        self.to_do = enumerate(queries)
         self.in_progress = {}
         send_later = {}  # query_id : search results
         n_sent = 0
         while any((self.in_progress, self.to_do, send_later)):
-            self._fill_work_queues(r, n, k)
+            self._fill_work_queues(r, n, k, send_later)
+            if not self.in_progress:
+                # the queries ran out and every one has been sent
+                break
             try:
                 query_id, meth, ret = self.result_q.get()
             except queue.Empty:
                 logger.debug("Result q empty.")
                 continue
+            if query_id not in self.in_progress:
+                continue  # an earlier part of this query failed
             if isinstance(ret, Exception):
                 logger.warning("Hit exception while processing query %i: %s",
                                query_id, ret)
                 send_later[query_id] = ret
                 del self.in_progress[query_id]
-                continue
-            if meth == 'count_tokens':
+            elif meth == 'count_tokens':
                 logger.debug('count_tokens completed for query %s', query_id)
-                query = queries[query_id]
+                query = self.in_progress[query_id]
                 self._scored_records(query_id, ret, query, limit,
                                      extract_func, score_func)
-                self.in_progress[query_id] = query
             elif meth == 'score_records':
                 logger.debug('score_records completed for query %s', query_id)
-                send_later[query_id] = ret
+                send_later[query_id] = self._format_resultset(ret)
                 del self.in_progress[query_id]
-                while n_sent in send_later:
-                    logger.debug('Sending resultset %s', n_sent)
-                    yield self._format_resultset(send_later.pop(n_sent))
-                    logger.info("Completed query %i", n_sent)
-                    logger.debug((self.in_progress, self.to_do, send_later))
-                    logger.debug(
-                        "Any left to do? %s",
-                        any((self.in_progress, self.to_do, send_later)))
-                    n_sent += 1
+            while n_sent in send_later:
+                logger.debug('Sending resultset %s', n_sent)
+                yield send_later.pop(n_sent)
+                logger.info("Completed query %i", n_sent)
+                n_sent += 1
 
     def searchmany(self, queries, limit=defaults.limit, r=defaults.r,
                    n=defaults.n, k=defaults.k,
                    extract_func=score.features, score_func=score.hit):
+        """Search for each of ``queries``, yielding the results in the
+        same order. Queries are read from the iterable as workers free
+        up, so it can be a stream. A query that fails yields its
+        exception instead.
+        """
         self.started = self._startup_workers()
         try:
             for result in self._searchmany(queries, limit, r, n, k,
@@ -334,6 +580,11 @@ class CLI:
             "type": int,
             "help": "The number of search results to return",
             "default": defaults.limit
+        }),
+        (["--max-distance"], {
+            "type": float,
+            "help": ("Return every record within this Jaccard distance "
+                     "of the term's tokens instead of the best matches")
         })
     ]
 
@@ -341,8 +592,11 @@ class CLI:
     def hook(parser, args):
         backend = storage.parse_url(args.backend)
         index = Index(backend)
-        results = index.search(
-            args.term,
-            limit=args.limit, k=args.seeds, n=args.search_space
-        )
-        print(json.dumps(results, indent=2))
+        if args.max_distance is not None:
+            results = index.search_threshold(args.term, args.max_distance)
+        else:
+            results = index.search(
+                args.term,
+                limit=args.limit, k=args.seeds, n=args.search_space
+            )
+        print(json.dumps(results, indent=2, default=json_default))
@@ -1,7 +1,13 @@
+from functools import lru_cache
+from itertools import takewhile
+
 from .util import avg
 from .util import jaccard
 from .util import ngrams
 
+# the largest size RecordSizes keeps; larger ones are saved as this
+MAX_SIZE = 0xffff
+
 
 def features(record):
     return [set(ngrams(attr, k=2, step=1)) for attr in record]
@@ -9,3 +15,25 @@ def features(record):
 
 def hit(query_features, result_features):
     return avg(list(map(jaccard, query_features, result_features)))
+
+
+@lru_cache(maxsize=1 << 16)
+def _attr_size(attr):
+    return len(set(ngrams(attr, k=2, step=1)))
+
+
+def sizes(record):
+    """The size of each attribute's ``features``"""
+    return [_attr_size(attr) for attr in record]
+
+
+def hit_bound(query_sizes, result_sizes):
+    """A lower bound on ``hit`` for records whose attributes have
+    ``features`` of these sizes. Two sets are no closer in Jaccard
+    distance than 1 - min/max of their sizes. A size of zero ends the
+    attributes of a result; one with none gets a bound of zero. A result
+    size of ``MAX_SIZE`` may have been capped, so it bounds nothing.
+    """
+    bounds = [0 if b >= MAX_SIZE else 1 - min(a, b) / max(a, b) for a, b
+              in zip(query_sizes, takewhile(bool, result_sizes))]
+    return avg(bounds) if bounds else 0
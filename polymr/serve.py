@@ -0,0 +1,443 @@
+"""Answer searches of an index over HTTP from one long running process.
+
+The index stays open between requests, so its token frequencies,
+record sizes and featurizer memos are loaded once and stay warm.
+Searches that arrive within ``WINDOW`` seconds of each other, or while
+the batch before them is running, are answered together by
+``Index.searchbatch``, which reads the tokens and records they share
+from the backend once.
+
+The server speaks just enough HTTP/1.1, on a TCP port or a Unix socket:
+
+``POST /search``
+    A JSON object with the ``query`` fields and optionally ``limit``,
+    ``r``, ``n`` and ``k`` as for ``Index.search``, or ``max_distance``
+    as for ``Index.search_threshold``. Answered with the list of
+    results.
+
+``GET /stats``
+    The number of queries answered and the batches they took.
+
+Errors are answered with a JSON object holding the ``error``.
+"""
+import json
+import socket
+import asyncio
+import logging
+import http.client
+from http import HTTPStatus
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import util
+from . import storage
+from .query import Index
+from .query import defaults
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = "localhost:8750"
+# Seconds to wait for more searches to batch with the first one
+WINDOW = 0.002
+MAX_BATCH = 64
+MAX_BODY = 1 << 20
+_SEARCH_PARAMS = ("limit", "r", "n", "k")
+
+
+def parse_address(address):
+    """Split a server address into its host and port. An address with
+    a slash in it is the path of a Unix socket, and its port is
+    ``None``.
+    """
+    if "/" in address:
+        return address, None
+    host, _, port = address.rpartition(":")
+    return host or "localhost", int(port)
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message=None):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+class Batcher:
+    """Gathers searches into batches for ``Index.searchbatch``. Batches
+    run one at a time on a single thread, so the index is never used by
+    two threads at once.
+    """
+
+    def __init__(self, index, window=WINDOW, max_batch=MAX_BATCH,
+                 loop=None):
+        self.index = index
+        self.loop = loop or asyncio.get_event_loop()
+        self.window = window
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = []
+        self.timer = None
+        self.running = False
+        self.n_queries = 0
+        self.n_batches = 0
+
+    async def search(self, query, limit=defaults.limit, r=defaults.r,
+                     n=defaults.n, k=defaults.k):
+        fut = asyncio.Future(loop=self.loop)
+        self.pending.append(((limit, r, n, k), query, fut))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.timer is None and not self.running:
+            self.timer = self.loop.call_later(
+                self.window, self._flush)
+        return await fut
+
+    async def search_threshold(self, query, max_distance):
+        return await self.loop.run_in_executor(
+            self.executor, self.index.search_threshold, query, max_distance)
+
+    def stats(self):
+        return {"queries": self.n_queries, "batches": self.n_batches,
+                "rowcount": self.index.rowcount}
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # a running batch flushes again when it's done
+        if self.running or not self.pending:
+            return
+        batch = self.pending[:self.max_batch]
+        del self.pending[:self.max_batch]
+        self.running = True
+        job = self.loop.run_in_executor(
+            self.executor, self._search_batch, batch)
+        job.add_done_callback(lambda job: self._done(batch, job))
+
+    def _search_batch(self, batch):
+        # Searches with the same parameters are batched together. A
+        # batch that fails fails each of its searches.
+        groups = defaultdict(list)
+        for pos, (params, _, _) in enumerate(batch):
+            groups[params].append(pos)
+        ret = [None] * len(batch)
+        for params, positions in groups.items():
+            try:
+                results = self.index.searchbatch(
+                    [batch[pos][1] for pos in positions], *params)
+            except Exception as e:
+                results = [e] * len(positions)
+            for pos, result in zip(positions, results):
+                ret[pos] = result
+        return ret
+
+    def _done(self, batch, job):
+        self.running = False
+        self.n_batches += 1
+        self.n_queries += len(batch)
+        for (_, _, fut), result in zip(batch, job.result()):
+            if fut.cancelled():
+                continue
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
+        self._flush()
+
+
+async def _read_request(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        size = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HTTPError(400, "Malformed Content-Length")
+    if size > MAX_BODY:
+        raise HTTPError(413)
+    body = await reader.readexactly(size)
+    return method, path, headers, body
+
+
+def _write_response(writer, status, payload, keep_alive):
+    body = json.dumps(payload, default=util.json_default).encode()
+    head = ["HTTP/1.1 %i %s" % (status, HTTPStatus(status).phrase),
+            "Content-Type: application/json",
+            "Content-Length: %i" % len(body)]
+    if not keep_alive:
+        head.append("Connection: close")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+
+
+def _search_args(body):
+    try:
+        req = json.loads(body)
+        query = req["query"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPError(400, "Expected a JSON object with a query")
+    if not (isinstance(query, list)
+            and all(isinstance(field, str) for field in query)):
+        raise HTTPError(400, "The query must be a list of strings")
+    if "max_distance" in req:
+        return query, req["max_distance"], None
+    params = {name: req[name] for name in _SEARCH_PARAMS if name in req}
+    for name, value in params.items():
+        if not (type(value) is int or (name == "k" and value is None)):
+            raise HTTPError(400, "%s must be an integer" % name)
+    return query, None, params
+
+
+class Server:
+    """Answers the HTTP requests of each connection in turn, keeping the
+    connection open until the client closes it."""
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                keep_alive = True
+                try:
+                    request = await _read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = (headers.get("connection", "").lower()
+                                  != "close")
+                    status, payload = 200, await self._dispatch(
+                        method, path, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                    keep_alive = keep_alive and e.status not in (400, 413)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break
+                except Exception as e:
+                    logger.exception("Failed to answer a request")
+                    status, payload = 500, {"error": str(e)}
+                _write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body):
+        if path == "/search":
+            if method != "POST":
+                raise HTTPError(405)
+            query, max_distance, params = _search_args(body)
+            if params is None:
+                try:
+                    return await self.batcher.search_threshold(
+                        query, max_distance)
+                except (ValueError, TypeError) as e:
+                    raise HTTPError(400, str(e))
+            return await self.batcher.search(query, **params)
+        if path == "/stats":
+            if method != "GET":
+                raise HTTPError(405)
+            return self.batcher.stats()
+        raise HTTPError(404)
+
+
+async def start(index, address=DEFAULT_ADDRESS, window=WINDOW,
+                max_batch=MAX_BATCH):
+    """Start answering searches of ``index`` at ``address``, a
+    ``host:port`` or the path of a Unix socket.
+
+    :rtype: asyncio.Server
+    """
+    handle = Server(Batcher(index, window, max_batch)).handle
+    host, port = parse_address(address)
+    if port is None:
+        server = await asyncio.start_unix_server(handle, path=host)
+    else:
+        server = await asyncio.start_server(handle, host, port)
+    logger.info("Serving %s on %s", index.backend.featurizer_name, address)
+    return server
+
+
+async def serve(index, address=DEFAULT_ADDRESS, window=WINDOW,
+                max_batch=MAX_BATCH):
+    """Answer searches of ``index`` at ``address`` until cancelled"""
+    server = await start(index, address, window, max_batch)
+    try:
+        await asyncio.Future()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class Client:
+    """Searches an index served by ``polymr serve``, over one connection
+    kept open between searches.
+
+    :param address: The server's ``host:port`` or Unix socket path
+    :type address: str
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        host, port = parse_address(address)
+        if port is None:
+            self.conn = _UnixHTTPConnection(host, timeout=timeout)
+        else:
+            self.conn = http.client.HTTPConnection(host, port,
+                                                   timeout=timeout)
+
+    def _request(self, method, path, payload=None):
+        body = None if payload is None else json.dumps(payload)
+        self.conn.request(method, path, body,
+                          {"Content-Type": "application/json"})
+        resp = self.conn.getresponse()
+        ret = json.loads(resp.read())
+        if resp.status == 400:
+            raise ValueError(ret["error"])
+        if resp.status != 200:
+            raise RuntimeError("Server answered %i: %s"
+                               % (resp.status, ret["error"]))
+        return ret
+
+    def search(self, query, limit=defaults.limit, r=defaults.r,
+               n=defaults.n, k=defaults.k):
+        """See ``Index.search``
+
+        :raises ValueError: If the server rejects the query
+        """
+        return self._request("POST", "/search",
+                             dict(query=list(query), limit=limit, r=r, n=n,
+                                  k=k))
+
+    def search_threshold(self, query, max_distance):
+        """See ``Index.search_threshold``
+
+        :raises ValueError: If the server rejects the query
+        """
+        return self._request("POST", "/search",
+                             dict(query=list(query),
+                                  max_distance=max_distance))
+
+    def stats(self):
+        return self._request("GET", "/stats")
+
+    def close(self):
+        self.conn.close()
+
+
+class CLI:
+
+    name = "serve"
+
+    arguments = [
+        storage.backend_arg,
+        (["-a", "--address"], {
+            "help": ("HOST:PORT to listen on, or the path of a Unix "
+                     "socket. Defaults to %s" % DEFAULT_ADDRESS),
+            "default": DEFAULT_ADDRESS
+        }),
+        (["--window"], {
+            "type": float,
+            "help": ("Milliseconds to wait for more searches to batch "
+                     "with the first one"),
+            "default": WINDOW * 1000
+        }),
+        (["--max-batch"], {
+            "type": int,
+            "help": "The most searches to answer in one batch",
+            "default": MAX_BATCH
+        }),
+    ]
+
+    @staticmethod
+    def hook(parser, args):
+        index = Index(storage.parse_url(args.backend))
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        task = loop.create_task(serve(index, args.address,
+                                      args.window / 1000, args.max_batch))
+        try:
+            loop.run_until_complete(task)
+        except KeyboardInterrupt:
+            task.cancel()
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+        finally:
+            loop.close()
+            index.close()
+
+
+class ClientCLI:
+
+    name = "client"
+
+    arguments = [
+        (["term"], {
+            "type": str,
+            "nargs": "+"
+        }),
+        (["-a", "--address"], {
+            "help": ("HOST:PORT or Unix socket path of the server. "
+                     "Defaults to %s" % DEFAULT_ADDRESS),
+            "default": DEFAULT_ADDRESS
+        }),
+        (["-r", "--seeds"], {
+            "type": int,
+            "help": "The number of record votes to tally.",
+            "default": defaults.r}),
+        (["-n", "--search-space"], {
+            "type": int,
+            "help": ("The number of seed records to search through "
+                     "for best matches"),
+            "default": defaults.n}),
+        (["-l", "--limit"], {
+            "type": int,
+            "help": "The number of search results to return",
+            "default": defaults.limit
+        }),
+        (["--max-distance"], {
+            "type": float,
+            "help": ("Return every record within this Jaccard distance "
+                     "of the term's tokens instead of the best matches")
+        })
+    ]
+
+    @staticmethod
+    def hook(parser, args):
+        client = Client(args.address)
+        try:
+            if args.max_distance is not None:
+                results = client.search_threshold(args.term,
+                                                  args.max_distance)
+            else:
+                results = client.search(args.term, limit=args.limit,
+                                        k=args.seeds, n=args.search_space)
+        finally:
+            client.close()
+        print(json.dumps(results, indent=2))
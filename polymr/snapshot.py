@@ -0,0 +1,202 @@
+"""Snapshots hold a whole index in one sequential file that can be
+restored into any backend.
+
+A snapshot starts with ``MAGIC`` and is followed by frames. Each frame
+is a one byte kind, the length and CRC32 of its payload, and the
+payload itself: a zlib compressed msgpack document. Postings are
+written as lists of gaps between record ids rather than as arrays, so
+the file does not depend on the byte order or word size of the machine
+that wrote it and small gaps pack into one byte. The last frame counts
+what came before it, so a truncated file is caught on import.
+"""
+import sys
+import zlib
+import struct
+import logging
+
+from toolz import partition_all
+
+from . import storage
+from .storage import dumps
+from .storage import loads
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"POLYMR-SNAPSHOT\x01"
+BATCH_SIZE = 5000
+_FRAME_HEADER = struct.Struct("<cII")
+
+META = b"M"
+RECORDS = b"R"
+TOKENS = b"T"
+FREQS = b"F"
+END = b"E"
+
+
+def _write_frame(f, kind, obj):
+    payload = zlib.compress(dumps(obj))
+    f.write(_FRAME_HEADER.pack(kind, len(payload), zlib.crc32(payload)))
+    f.write(payload)
+
+
+def _read_frames(f):
+    while True:
+        header = f.read(_FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            raise ValueError("Snapshot is truncated")
+        kind, size, crc = _FRAME_HEADER.unpack(header)
+        payload = f.read(size)
+        if len(payload) < size:
+            raise ValueError("Snapshot is truncated")
+        if zlib.crc32(payload) != crc:
+            raise ValueError("Snapshot is corrupt: checksum mismatch")
+        obj = loads(zlib.decompress(payload))
+        yield kind, obj
+        if kind == END:
+            return
+
+
+def _deltas(ids):
+    prev = 0
+    ret = []
+    for idx in ids:
+        ret.append(idx - prev)
+        prev = idx
+    return ret
+
+
+def _undeltas(deltas):
+    idx = 0
+    ret = []
+    for d in deltas:
+        idx += d
+        ret.append(idx)
+    return ret
+
+
+def export(backend, f, batch_size=BATCH_SIZE):
+    """Write every part of the index in ``backend`` to the binary file
+    ``f`` as a snapshot.
+    """
+    counts = {RECORDS: 0, TOKENS: 0, FREQS: 0}
+    f.write(MAGIC)
+    _write_frame(f, META, (backend.get_featurizer_name(),
+                           backend.get_rowcount(),
+                           list(backend.get_deleted())))
+    logger.info("Exporting records")
+    for batch in partition_all(batch_size, backend.scan_records()):
+        _write_frame(f, RECORDS, [(idx, dumps(rec)) for idx, rec in batch])
+        counts[RECORDS] += len(batch)
+    freqs = backend.get_freqs()
+    logger.info("Exporting %i tokens", len(freqs))
+    for names in partition_all(batch_size, sorted(freqs)):
+        postings = backend.get_tokens(names)
+        _write_frame(f, TOKENS, [(name, _deltas(ids))
+                                 for name, ids in zip(names, postings)])
+        counts[TOKENS] += len(names)
+    for batch in partition_all(batch_size, freqs.items()):
+        _write_frame(f, FREQS, list(batch))
+        counts[FREQS] += len(batch)
+    _write_frame(f, END, (counts[RECORDS], counts[TOKENS], counts[FREQS]))
+    logger.info("Exported %i records and %i tokens", counts[RECORDS],
+                counts[TOKENS])
+
+
+def import_(backend, f):
+    """Restore the snapshot in the binary file ``f`` into ``backend``.
+
+    :raises ValueError: If ``f`` is not a complete, intact snapshot
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a polymr snapshot")
+    counts = {RECORDS: 0, TOKENS: 0, FREQS: 0}
+    frames = _read_frames(f)
+    kind, meta = next(frames)
+    if kind != META:
+        raise ValueError("Snapshot is corrupt: no metadata")
+    featurizer_name, rowcount, deleted = meta
+    featurizer_name = featurizer_name.decode()
+    freqs = storage.empty_freqs(featurizer_name)
+    sizes = storage.RecordSizes()
+    with backend.bulk_load():
+        backend.save_featurizer_name(featurizer_name)
+        for kind, obj in frames:
+            if kind == RECORDS:
+                records = [(idx, storage.LevelDBBackend._get_record(blob))
+                           for idx, blob in obj]
+                sizes.update(featurizer_name,
+                             ((idx, rec.fields) for idx, rec in records))
+                backend.save_records(records)
+            elif kind == TOKENS:
+                backend.save_tokens((name, _undeltas(deltas))
+                                    for name, deltas in obj)
+            elif kind == FREQS:
+                freqs.update(obj)
+            elif kind == END:
+                expected = list(obj)
+                break
+            else:
+                raise ValueError("Snapshot is corrupt: unknown frame %r"
+                                 % kind)
+            counts[kind] += len(obj)
+        read = [counts[RECORDS], counts[TOKENS], counts[FREQS]]
+        if expected != read:
+            raise ValueError("Snapshot is corrupt: expected %r records, "
+                             "tokens and freqs, read %r" % (expected, read))
+        backend.save_freqs(freqs)
+        backend.save_sizes(sizes)
+        for idx in deleted:
+            backend.delete_record(idx)
+        backend.save_rowcount(rowcount)
+    logger.info("Imported %i records and %i tokens", counts[RECORDS],
+                counts[TOKENS])
+
+
+def _open(path, mode):
+    if path == "-":
+        return (sys.stdout if "w" in mode else sys.stdin).buffer
+    return open(path, mode)
+
+
+class ExportCLI:
+
+    name = "export"
+
+    arguments = [
+        storage.backend_arg,
+        (["-o", "--output"], {
+            "help": "Snapshot file to write, or - for stdout",
+            "required": True
+        }),
+    ]
+
+    @staticmethod
+    def hook(parser, args):
+        backend = storage.parse_url(args.backend)
+        try:
+            with _open(args.output, "wb") as f:
+                export(backend, f)
+        finally:
+            backend.close()
+
+
+class ImportCLI:
+
+    name = "import"
+
+    arguments = [
+        storage.backend_arg,
+        (["-i", "--input"], {
+            "help": "Snapshot file to read, or - for stdin",
+            "required": True
+        }),
+    ]
+
+    @staticmethod
+    def hook(parser, args):
+        backend = storage.parse_url(args.backend)
+        try:
+            with _open(args.input, "rb") as f:
+                import_(backend, f)
+        finally:
+            backend.close()
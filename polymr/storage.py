@@ -1,22 +1,34 @@
 import os
+import sys
+import time
+import zlib
+import queue
 import logging
+import threading
 import operator
+import contextlib
 from array import array
 from abc import ABCMeta
 from abc import abstractmethod
 from functools import partial
+from collections import Counter
 from collections import defaultdict
+from collections.abc import MutableMapping
 from itertools import count as counter
 from urllib.parse import urlparse
+from urllib.parse import parse_qsl
 
 import leveldb
 import msgpack
 from toolz import partition_all
 
+from . import util
+from . import score
+from . import featurizers
 from .record import Record
 
 logger = logging.getLogger(__name__)
-_isinfo = logger.isEnabledFor(logging.INFO)
+fst = operator.itemgetter(0)
 snd = operator.itemgetter(1)
 
 
@@ -28,9 +40,366 @@ def dumps(obj):
     return msgpack.packb(obj)
 
 
+class Tombstones(object):
+    """A bitmap of deleted record ids. Bits are ordered most significant
+    first within each byte, the same layout Redis uses for SETBIT.
+
+    :param blob: A bitmap to start from
+    :type blob: bytes
+    """
+    def __init__(self, blob=b""):
+        self.bits = bytearray(blob)
+
+    def add(self, idx):
+        byte = idx >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 0x80 >> (idx & 7)
+
+    def __contains__(self, idx):
+        byte = idx >> 3
+        return (byte < len(self.bits)
+                and bool(self.bits[byte] & (0x80 >> (idx & 7))))
+
+    def __iter__(self):
+        for byte, val in enumerate(self.bits):
+            if val:
+                for bit in range(8):
+                    if val & (0x80 >> bit):
+                        yield byte << 3 | bit
+
+    def __len__(self):
+        return sum(bin(val).count("1") for val in self.bits)
+
+    def __bool__(self):
+        return any(self.bits)
+
+    def tobytes(self):
+        return bytes(self.bits)
+
+
+class FlatFreqs(MutableMapping):
+    """Token frequencies of a hashed index, kept in a flat array indexed
+    by token id. A token with a count of zero is absent.
+
+    :param bits: The bit width of the token ids
+    :type bits: int
+    """
+    def __init__(self, bits, counts=None):
+        self.bits = bits
+        if counts is None:
+            counts = array("I", bytes(4 << bits))
+        self.counts = counts
+        self._len = len(counts) - counts.count(0)
+
+    def _slot(self, tok):
+        slot = int.from_bytes(tok, "big")
+        if len(tok) != 4 or slot >> self.bits:
+            raise KeyError(tok)
+        return slot
+
+    def __getitem__(self, tok):
+        cnt = self.counts[self._slot(tok)]
+        if not cnt:
+            raise KeyError(tok)
+        return cnt
+
+    def __setitem__(self, tok, cnt):
+        slot = self._slot(tok)
+        self._len += bool(cnt) - bool(self.counts[slot])
+        self.counts[slot] = cnt
+
+    def __delitem__(self, tok):
+        self[tok]
+        self[tok] = 0
+
+    def __iter__(self):
+        for slot, cnt in enumerate(self.counts):
+            if cnt:
+                yield slot.to_bytes(4, "big")
+
+    def __len__(self):
+        return self._len
+
+    def tobytes(self):
+        return self.counts.tobytes()
+
+    @classmethod
+    def frombytes(cls, blob):
+        counts = array("I")
+        counts.frombytes(blob)
+        return cls(len(counts).bit_length() - 1, counts)
+
+
+_FLAT_FREQS = b"\x00FlatFreqs"
+
+
+def empty_freqs(featurizer_name):
+    """A mapping to collect the token frequencies of an index built with
+    ``featurizer_name``: flat for hashed featurizers, a dict otherwise"""
+    _, bits = featurizers.parse_name(featurizer_name)
+    return FlatFreqs(bits) if bits else {}
+
+
+def dump_freqs(freqs):
+    """Serialize token frequencies for backends that save them whole"""
+    if isinstance(freqs, FlatFreqs):
+        return _FLAT_FREQS + zlib.compress(freqs.tobytes())
+    return dumps(freqs)
+
+
+def load_freqs(blob):
+    """Deserialize token frequencies saved by ``dump_freqs``"""
+    if blob.startswith(_FLAT_FREQS):
+        return FlatFreqs.frombytes(
+            zlib.decompress(blob[len(_FLAT_FREQS):]))
+    return defaultdict(int, loads(blob))
+
+
+class RecordSizes(object):
+    """Sizes of every record, kept in a flat array so searches can bound
+    scores without fetching records: the number of the record's index
+    tokens, then the size of each searched attribute's scoring features.
+    A size of zero is unknown, or marks an attribute the record doesn't
+    have. Sizes are capped at ``score.MAX_SIZE``.
+
+    The array is saved in chunks of ``SIZES_CHUNK`` records so updating
+    a few records rewrites only their chunks.
+    """
+    def __init__(self, width=None, counts=None):
+        self.width = width
+        self.counts = array("H") if counts is None else counts
+
+    def set(self, idx, n_tokens, attr_sizes):
+        if self.width is None:
+            self.width = len(attr_sizes) + 1
+        if len(attr_sizes) >= self.width:
+            attr_sizes = ()
+        end = (idx + 1) * self.width
+        if end > len(self.counts):
+            self.counts.extend(bytes(end - len(self.counts)))
+        row = [n_tokens] + list(attr_sizes)
+        self.counts[end - self.width:end] = array(
+            "H", [min(size, score.MAX_SIZE) for size in row]
+            + [0] * (self.width - len(row)))
+
+    def update(self, featurizer_name, idxs_fields):
+        """Find and set the sizes of records
+
+        :param idxs_fields: The record id, fields pairs
+        :type idxs_fields: iterable of (int, list of str) pairs
+        """
+        idxs_fields = list(idxs_fields)
+        batch = featurizers.featurize_many(
+            featurizer_name, (fields for _, fields in idxs_fields))
+        for (idx, fields), toks in zip(idxs_fields, batch):
+            self.set(idx, len(toks), score.sizes(fields))
+
+    def tokens(self, idx):
+        """The number of index tokens of a record, or zero if unknown"""
+        pos = idx * (self.width or 0)
+        return self.counts[pos] if pos < len(self.counts) else 0
+
+    def attrs(self, idx):
+        """The sizes of a record's attributes, zeros past the last"""
+        if self.width is None:
+            return self.counts[:0]
+        return self.counts[idx * self.width + 1:(idx + 1) * self.width]
+
+    def chunks(self, idxs=None):
+        """Serialize the chunks holding ``idxs``, or all of them
+
+        :rtype: iterator of (int, bytes) pairs
+        """
+        if self.width is None:
+            return
+        per_chunk = SIZES_CHUNK * self.width
+        n_chunks = -(-len(self.counts) // per_chunk)
+        if idxs is None:
+            chunk_nos = range(n_chunks)
+        else:
+            chunk_nos = sorted({idx // SIZES_CHUNK for idx in idxs})
+        for chunk_no in chunk_nos:
+            start = chunk_no * per_chunk
+            yield chunk_no, (self.width.to_bytes(2, "little")
+                             + self.counts[start:start + per_chunk].tobytes())
+
+    @classmethod
+    def fromchunks(cls, blobs):
+        """Load the consecutive chunks saved from ``chunks``"""
+        ret = cls()
+        for blob in blobs:
+            ret.width = int.from_bytes(blob[:2], "little")
+            ret.counts.frombytes(bytes(blob[2:]))
+        return ret
+
+
+COPY_BATCH_SIZE = 5000
+COPY_QUEUE_SIZE = 8
+COPY_REPORT_INTERVAL = 10
+_OFFSET_SIZE = array("L").itemsize
+_ID_SIZE = array("L").itemsize
+# With sorted keys, get_records sweeps an iterator over runs of at least
+# SWEEP_MIN_RUN wanted ids that are no more than SWEEP_MAX_GAP apart.
+SWEEP_MIN_RUN = 8
+SWEEP_MAX_GAP = 4
+SIZES_CHUNK = 1 << 16
+
+
+def _pack_block(blobs):
+    """Pack the record blobs of one block, ``None`` marking an empty slot,
+    behind a table of their offsets and compress the lot.
+    """
+    offsets = array("L", [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + (len(blob) if blob else 0))
+    body = b"".join(blob for blob in blobs if blob)
+    return zlib.compress(offsets.tobytes() + body)
+
+
+def _unpack_block(data, nslots):
+    offsets = array("L", data[:(nslots + 1) * _OFFSET_SIZE])
+    base = len(offsets) * _OFFSET_SIZE
+    return [data[base + start:base + end] if end > start else None
+            for start, end in zip(offsets, offsets[1:])]
+
+
+def _block_slot(data, nslots, slot):
+    # reads one record through the offset table, leaving the rest packed
+    start, end = array("L", data[slot * _OFFSET_SIZE:
+                                 (slot + 2) * _OFFSET_SIZE])
+    if start == end:
+        raise KeyError(slot)
+    base = (nslots + 1) * _OFFSET_SIZE
+    return data[base + start:base + end]
+
+
+def _dense_runs(ids, max_gap):
+    run = []
+    for idx in ids:
+        if run and idx - run[-1] > max_gap:
+            yield run
+            run = []
+        run.append(idx)
+    if run:
+        yield run
+
+
+class _Throughput:
+    """Logs the progress of a copy, or of another job working through
+    ``total`` items, at most every ``interval`` seconds. ``total`` is
+    ``None`` when the number of items isn't known up front."""
+
+    def __init__(self, what, total, interval=COPY_REPORT_INTERVAL,
+                 verb="Copied"):
+        self.what = what
+        self.verb = verb
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.started = self.reported = time.monotonic()
+
+    def add(self, n):
+        self.done += n
+        now = time.monotonic()
+        finished = self.total is not None and self.done >= self.total
+        if now - self.reported >= self.interval or finished:
+            self.reported = now
+            rate = self.done / max(now - self.started, 1e-9)
+            if self.total is None:
+                logger.info("%s %i %s (%.0f/s)", self.verb, self.done,
+                            self.what, rate)
+            else:
+                logger.info("%s %i of %i %s (%.0f/s)", self.verb,
+                            self.done, self.total, self.what, rate)
+
+
+def _copy_units(units, read, write, readers=1, writers=1, on_done=None):
+    """Copy each of ``units`` by passing ``read(unit)`` to ``write`` on
+    ``readers`` and ``writers`` threads. A bounded queue between them
+    keeps fast readers from buffering the whole index in memory.
+    ``on_done(unit, data)`` is called, one at a time, after each write.
+    """
+    todo = queue.Queue()
+    for unit in units:
+        todo.put(unit)
+    out = queue.Queue(COPY_QUEUE_SIZE)
+    lock = threading.Lock()
+    errors = []
+
+    def _read():
+        while not errors:
+            try:
+                unit = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                data = read(unit)
+            except BaseException as e:
+                errors.append(e)
+                return
+            out.put((unit, data))
+
+    def _write():
+        # keep draining after a failure so readers never block forever
+        for unit, data in iter(out.get, None):
+            if errors:
+                continue
+            try:
+                write(data)
+                if on_done is not None:
+                    with lock:
+                        on_done(unit, data)
+            except BaseException as e:
+                errors.append(e)
+
+    reader_threads = [threading.Thread(target=_read, daemon=True)
+                      for _ in range(readers)]
+    writer_threads = [threading.Thread(target=_write, daemon=True)
+                      for _ in range(writers)]
+    for t in reader_threads + writer_threads:
+        t.start()
+    for t in reader_threads:
+        t.join()
+    for _ in writer_threads:
+        out.put(None)
+    for t in writer_threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
 def copy(backend_from, backend_to, droptop=None,
          skip_copy_records=False, skip_copy_featurizer=False,
-         skip_copy_freqs=False, skip_copy_tokens=False, threads=None):
+         skip_copy_freqs=False, skip_copy_tokens=False, threads=None,
+         readers=1, writers=1, batch_size=COPY_BATCH_SIZE,
+         manifest=None, resume=False, backend_from_url=None,
+         backend_to_url=None):
+    """Copy an index from one backend to another.
+
+    Records are copied in id ranges and tokens in sorted ranges of
+    ``batch_size``, each read with one bulk read on one of ``readers``
+    threads and saved with one bulk write on one of ``writers`` threads.
+    Record ids and deletions are kept.
+
+    Finished ranges are checkpointed to the ``manifest`` file if one is
+    given, along with ``backend_from_url`` and ``backend_to_url``. With
+    ``resume``, an interrupted copy between the same backends skips the
+    ranges it had already saved. ``backend_to``'s writes must be durable
+    and safe to repeat, so not a RocksDB bulk load.
+
+    :raises ValueError: If a manifest is given without both URLs, or
+      for a ``backend_to`` without durable writes
+    """
+    if manifest is not None:
+        if backend_from_url is None or backend_to_url is None:
+            raise ValueError("Can't checkpoint this copy without the "
+                             "URLs of the backends it copies between")
+        if not backend_to.durable_writes:
+            raise ValueError("Can't checkpoint this copy: the output "
+                             "backend's writes aren't durable as they're "
+                             "made, so a resumed copy would miss some of "
+                             "them")
     logger.debug("Copying from %s to %s", backend_from, backend_to)
     if threads is not None:
         save_records = partial(backend_to.save_records, threads=threads)
@@ -38,12 +407,42 @@ def copy(backend_from, backend_to, droptop=None,
     else:
         save_records = backend_to.save_records
         save_tokens = backend_to.save_tokens
+    params = {"droptop": droptop, "batch_size": batch_size,
+              "skip_copy_records": skip_copy_records,
+              "skip_copy_tokens": skip_copy_tokens,
+              "backend_from": backend_from_url, "backend_to": backend_to_url}
+    manifest = util.Manifest(manifest, params, resume,
+                             record_batches=[], token_batches=[])
+    state = manifest.state
+    if state["done"]:
+        logger.info("Copy already complete")
+        return
+
+    def _done(key, progress):
+        def _on_done(unit, data):
+            state[key].append(unit)
+            manifest.save()
+            progress.add(len(data))
+        return _on_done
+
     if skip_copy_records is False:
         cnt = backend_from.get_rowcount()
-        recs = backend_from.get_records(range(0, cnt))
         logger.info("Copying %i records", cnt)
-        save_records(enumerate(recs))
-        backend_to.save_rowcount(backend_from.get_rowcount())
+        finished = set(state["record_batches"])
+        starts = [start for start in range(0, cnt, batch_size)
+                  if start not in finished]
+        _copy_units(
+            starts,
+            lambda start: list(backend_from.scan_records(
+                start=start, stop=min(start + batch_size, cnt))),
+            save_records, readers, writers,
+            _done("record_batches", _Throughput("records", cnt)))
+        for idx in backend_from.get_deleted():
+            backend_to.delete_record(idx)
+        backend_to.save_rowcount(cnt)
+        sizes = backend_from.get_sizes()
+        if sizes is not None:
+            backend_to.save_sizes(sizes)
     if skip_copy_freqs is False:
         logger.info("Copying frequencies")
     if any((skip_copy_freqs is False,
@@ -61,23 +460,34 @@ def copy(backend_from, backend_to, droptop=None,
         logger.info("Copying featurizer name")
         backend_to.save_featurizer_name(backend_from.get_featurizer_name())
 
-    def _rows():
-        for i, tok in enumerate(freqs):
-            idxs = backend_from.get_token(tok)
-            yield (tok, idxs)
-            if _isinfo:
-                n_bins = len(freqs) // 100
-                if (i % n_bins) == 0:
-                    logger.info("Feature copy %.2f%% complete",
-                                i / len(freqs) * 100)
-
     if skip_copy_tokens is False:
         logger.info("Copying features")
-        save_tokens(_rows())
+        toks = sorted(freqs)
+        finished = set(state["token_batches"])
+        starts = [start for start in range(0, len(toks), batch_size)
+                  if start not in finished]
+
+        def _read_tokens(start):
+            names = toks[start:start + batch_size]
+            return list(zip(names, backend_from.get_tokens(names)))
+
+        _copy_units(starts, _read_tokens, save_tokens, readers, writers,
+                    _done("token_batches", _Throughput("tokens", len(toks))))
+    state["done"] = True
+    manifest.save()
     logger.info("Copy complete")
 
 
 class AbstractBackend(metaclass=ABCMeta):
+    # Whether several processes may open the same backend URL and write
+    # to it at once, e.g. to save index partitions in parallel.
+    concurrent_writes = False
+    # Whether writes survive a crash once they return, and saving the
+    # same records or tokens again replaces them rather than adding to
+    # them. Builds can only be checkpointed to a manifest and resumed
+    # when both hold, as a resumed build redoes its unfinished batches.
+    durable_writes = True
+
     @classmethod
     @abstractmethod
     def from_urlparsed(cls, parsed):
@@ -87,6 +497,14 @@ class AbstractBackend(metaclass=ABCMeta):
     def close(self):
         ...
 
+    @contextlib.contextmanager
+    def bulk_load(self):
+        """Wraps a full index build. Backends with a write-optimized
+        loading mode can override this to finish the load on exit, e.g.
+        by compacting.
+        """
+        yield
+
     @abstractmethod
     def get_freqs(self):
         """Get a the freqeuency dict
@@ -149,6 +567,85 @@ class AbstractBackend(metaclass=ABCMeta):
         """
         ...
 
+    def get_tokens(self, names):
+        """Get the lists of records containing each of the named
+        tokens. Backends that can fetch many tokens concurrently should
+        override this.
+
+        :param names: The tokens to get
+        :type names: iterable of bytes
+
+        :returns: The lists of records, in the same order as ``names``
+        :rtype: iterable of list
+
+        """
+        return map(self.get_token, names)
+
+    def search_candidates(self, toks, r, n, k=None):
+        """Tally votes from the least frequent query tokens and return the
+        ids of the records with the most votes.
+
+        :param toks: The query's tokens
+        :type toks: iterable of bytes
+
+        :param r: The maximum number of record votes to tally
+        :type r: int
+
+        :param n: The number of record ids to return
+        :type n: int
+
+        :param k: The maximum number of tokens to use
+        :type k: int
+
+        :rtype: list of int
+        """
+        toks = self.find_least_frequent_tokens(toks, r, k)
+        r_map = Counter()
+        for rng in self.get_tokens(toks):
+            r_map.update(rng)
+        deleted = self.get_deleted()
+        if deleted:
+            for idx in [idx for idx in r_map if idx in deleted]:
+                del r_map[idx]
+        return list(map(fst, r_map.most_common(n)))
+
+    def search_candidates_many(self, toks_list, r, n, k=None):
+        """Like ``search_candidates``, for many queries at once. The
+        posting lists of all their tokens are read in one ``get_tokens``
+        call, so a token shared by several queries is read once.
+
+        :param toks_list: The tokens of each query
+        :type toks_list: iterable of iterable of bytes
+
+        :returns: The candidate record ids of each query, in order
+        :rtype: list of list of int
+        """
+        chosen = [self.find_least_frequent_tokens(toks, r, k)
+                  for toks in toks_list]
+        names = sorted({tok for toks in chosen for tok in toks})
+        postings = dict(zip(names, self.get_tokens(names)))
+        deleted = self.get_deleted()
+        ret = []
+        for toks in chosen:
+            r_map = Counter()
+            for tok in toks:
+                r_map.update(postings[tok])
+            if deleted:
+                for idx in [idx for idx in r_map if idx in deleted]:
+                    del r_map[idx]
+            ret.append(list(map(fst, r_map.most_common(n))))
+        return ret
+
+    def search_candidate_records(self, toks, r, n, k=None):
+        """Like ``search_candidates``, but also fetch the records.
+
+        :returns: The candidate record ids and an iterable of the
+          corresponding records
+        :rtype: tuple of (list of int, iterable of polymr.record.Record)
+        """
+        record_ids = self.search_candidates(toks, r, n, k)
+        return record_ids, self.get_records(record_ids)
+
     @abstractmethod
     def update_token(self, name, record_ids):
         """Update the list of record ids corresponding to a token.
@@ -159,6 +656,8 @@ class AbstractBackend(metaclass=ABCMeta):
         :param record_ids: The list of record ids containing the token
         :type record_ids: list of int
 
+        :returns: The number of records with the token now
+        :rtype: int
         """
         ...
 
@@ -172,6 +671,8 @@ class AbstractBackend(metaclass=ABCMeta):
         :param bad_record_ids: The record ids to remove
         :type bad_record_ids: list of int
 
+        :returns: The number of records left with the token
+        :rtype: int
         """
         ...
 
@@ -219,6 +720,33 @@ class AbstractBackend(metaclass=ABCMeta):
         """
         ...
 
+    def scan_records(self, chunk_size=1000, start=0, stop=None):
+        """Get every saved record with its id, in id order. Deleted ids
+        are skipped.
+
+        :param start: The first record id to get
+        :type start: int
+
+        :param stop: Stop before this record id. Defaults to the rowcount
+        :type stop: int
+
+        :rtype: iterator of (int, polymr.record.Record) pairs
+        """
+        deleted = self.get_deleted()
+        stop = self.get_rowcount() if stop is None else stop
+        for chunk in partition_all(chunk_size, range(start, stop)):
+            idxs = [idx for idx in chunk if idx not in deleted]
+            try:
+                yield from zip(idxs, list(self.get_records(idxs)))
+            except KeyError:
+                # a hole left without a tombstone, e.g. by an older delete
+                for idx in idxs:
+                    try:
+                        rec = self.get_record(idx)
+                    except KeyError:
+                        continue
+                    yield idx, rec
+
     @abstractmethod
     def save_record(self, rec):
         """Save records.
@@ -243,13 +771,124 @@ class AbstractBackend(metaclass=ABCMeta):
         """
         ...
 
+    @abstractmethod
+    def update_record(self, rec, idx):
+        """Replace the record saved under a record id
+
+        :param rec: The new record
+        :type rec: polymr.record.Record
+
+        :param idx: The id of the record to replace
+        :type idx: int
+
+        :returns: The record id
+        :rtype: int
+        """
+        ...
+
+    @abstractmethod
+    def delete_record(self, idx):
+        """Delete a record and its primary key entry. Backends that
+        leave the id in posting lists record it in ``get_deleted``.
+
+        :param idx: The id of the record to delete
+        :type idx: int
+        """
+        ...
+
+    def get_deleted(self):
+        """Get the ids of deleted records that may still be in posting
+        lists. They're skipped when tallying votes until the index is
+        compacted.
+
+        :rtype: polymr.storage.Tombstones
+        """
+        return Tombstones()
+
+    def get_sizes(self):
+        """Get the attribute sizes of every record, saved with
+        ``save_sizes``. Backends that don't keep sizes return ``None``,
+        and searches then score every candidate.
+
+        :rtype: polymr.storage.RecordSizes
+        """
+        return None
+
+    def save_sizes(self, sizes, idxs=None):
+        """Save the attribute sizes of records
+
+        :param sizes: The sizes of every record
+        :type sizes: polymr.storage.RecordSizes
+
+        :param idxs: Only save the sizes of these records
+        :type idxs: iterable of int
+        """
+        pass
+
+    @abstractmethod
+    def get_rownum(self, pk):
+        """Get the id of the record saved with a primary key. Saving,
+        updating and deleting records keeps the primary key index up to
+        date.
+
+        :param pk: The primary key
+        :type pk: str
+
+        :raises KeyError: If no record has that primary key
+
+        :rtype: int
+        """
+        ...
+
+    def get_rownums(self, pks):
+        """Get the ids of the records saved with each of the primary
+        keys. Backends that can look up many keys at once should
+        override this.
+
+        :param pks: The primary keys
+        :type pks: iterable of str
+
+        :returns: The record ids, in the same order as ``pks``, with
+          None for the keys no record has
+        :rtype: list
+        """
+        ret = []
+        for pk in pks:
+            try:
+                ret.append(self.get_rownum(pk))
+            except KeyError:
+                ret.append(None)
+        return ret
+
 
 class LevelDBBackend(AbstractBackend):
+    """Stores tokens and records in two LevelDB databases.
+
+    Each record is saved under its own key unless ``record_block`` is
+    set, in which case runs of ``record_block`` consecutive ids are
+    packed into one compressed block so fetching clustered candidates
+    costs one read per block. The layout is saved with the records and
+    can only be chosen while there are none; select it with
+    ``?record_block=64`` on the URL.
+
+    Record ids are encoded in native byte order unless ``sorted_keys``
+    is set (``?sorted_keys=true``). Big endian keys sort in id order, so
+    records can be read with range scans; use ``polymr copy`` to move an
+    existing index to that layout.
+    """
+    _deleted = None
+    record_block = 0
+    sorted_keys = False
+    _layout_keys = {"record_block": b"RecordBlock",
+                    "sorted_keys": b"SortedKeys"}
+
     def __init__(self, path=None,
                  create_if_missing=True,
                  featurizer_name=None,
                  feature_db=None,
-                 record_db=None):
+                 record_db=None,
+                 record_block=None,
+                 sorted_keys=False):
         self._freqs = None
         if feature_db is not None or record_db is not None:
             self.feature_db = feature_db
@@ -273,6 +912,23 @@ class LevelDBBackend(AbstractBackend):
                 name = 'default'
             self.featurizer_name = name
         self._check_dbstats()
+        self._init_layout(record_block=record_block, sorted_keys=sorted_keys)
+
+    def _init_layout(self, **requested):
+        for name, key in self._layout_keys.items():
+            try:
+                saved = loads(self._get_blob(key))
+            except KeyError:
+                saved = getattr(type(self), name)
+            want = requested.get(name)
+            if want and want != saved:
+                if saved or self.get_rowcount():
+                    raise ValueError("Records are already saved with "
+                                     "%s=%r" % (name, saved))
+                self._write_records([(key, dumps(want))])
+                saved = want
+            setattr(self, name, saved)
+        self._block_lock = threading.Lock()
 
     def get_featurizer_name(self):
         with open(os.path.join(self.path, "featurizer")) as f:
@@ -299,7 +955,10 @@ class LevelDBBackend(AbstractBackend):
 
     @classmethod
     def from_urlparsed(cls, parsed, featurizer_name=None):
-        return cls(parsed.path, featurizer_name=featurizer_name)
+        params = dict(parse_qsl(parsed.query))
+        return cls(parsed.path, featurizer_name=featurizer_name,
+                   record_block=int(params.get('record_block', 0)),
+                   sorted_keys=params.get('sorted_keys') == 'true')
 
     def close(self):
         del self.feature_db
@@ -325,7 +984,7 @@ class LevelDBBackend(AbstractBackend):
 
     def get_freqs(self):
         s = self.feature_db.Get("Freqs".encode())
-        return defaultdict(int, loads(s))
+        return load_freqs(s)
 
     def update_freqs(self, toks_cnts):
         if not self._freqs:
@@ -334,7 +993,7 @@ class LevelDBBackend(AbstractBackend):
         self.save_freqs(self._freqs)
 
     def save_freqs(self, freqs_dict):
-        self.feature_db.Put("Freqs".encode(), dumps(freqs_dict))
+        self.feature_db.Put("Freqs".encode(), dump_freqs(freqs_dict))
 
     def get_rowcount(self):
         return loads(self.record_db.Get("Rowcount".encode()))
@@ -362,13 +1021,15 @@ class LevelDBBackend(AbstractBackend):
             s = set(record_ids).union(self.get_token(name))
         except KeyError:
             # possible the token is new
-            s = []
-        self.save_token(name, s)
+            s = set(record_ids)
+        self.save_token(name, sorted(s))
+        return len(s)
 
     def drop_records_from_token(self, name, bad_record_ids):
         curidxs = self.get_token(name)
         to_keep = list(set(curidxs)-set(bad_record_ids))
         self.save_token(name, to_keep)
+        return len(to_keep)
 
     def save_token(self, name, record_ids):
         self.feature_db.Put(name, array("L", record_ids).tobytes())
@@ -388,40 +1049,269 @@ class LevelDBBackend(AbstractBackend):
         rec[1] = rec[1].decode()
         return Record._make(rec)
 
+    def _get_blob(self, key):
+        return self.record_db.Get(key)
+
+    def _get_blobs(self, keys):
+        ret = {}
+        for key in keys:
+            try:
+                ret[key] = self.record_db.Get(key)
+            except KeyError:
+                ret[key] = None
+        return ret
+
+    def _write_records(self, keys_blobs):
+        # a blob of None deletes the key
+        batch = leveldb.WriteBatch()
+        for key, blob in keys_blobs:
+            if blob is None:
+                batch.Delete(key)
+            else:
+                batch.Put(key, blob)
+        self.record_db.Write(batch)
+
+    def _iter_record_items(self, key_from, key_to):
+        return self.record_db.RangeIter(key_from, key_to)
+
+    def _id_bytes(self, idx):
+        if self.sorted_keys:
+            return idx.to_bytes(_ID_SIZE, "big")
+        return array("L", (idx,)).tobytes()
+
+    def _record_key(self, idx):
+        return self._id_bytes(idx)
+
+    def _block_key(self, block_no):
+        return b"blk:" + self._id_bytes(block_no)
+
+    def _get_id_blobs(self, ids, prefix=b""):
+        """Get the blobs saved under ``prefix`` and each of ``ids``. With
+        sorted keys, dense runs of ids are read with one range scan.
+
+        :returns: The blob of each id that was found
+        :rtype: dict
+        """
+        if not self.sorted_keys:
+            keys = [prefix + self._id_bytes(idx) for idx in ids]
+            blobs = self._get_blobs(keys)
+            return {idx: blobs[key] for idx, key in zip(ids, keys)
+                    if blobs[key] is not None}
+        ret = {}
+        for run in _dense_runs(sorted(set(ids)), SWEEP_MAX_GAP):
+            if len(run) < SWEEP_MIN_RUN:
+                keys = [prefix + self._id_bytes(idx) for idx in run]
+                blobs = self._get_blobs(keys)
+                ret.update((idx, blobs[key]) for idx, key in zip(run, keys)
+                           if blobs[key] is not None)
+                continue
+            items = self._iter_record_items(prefix + self._id_bytes(run[0]),
+                                            prefix + self._id_bytes(run[-1]))
+            for key, blob in items:
+                ret[int.from_bytes(key[len(prefix):], "big")] = blob
+        return ret
+
+    def _load_block_record_blob(self, idx):
+        block_no, slot = divmod(idx, self.record_block)
+        data = zlib.decompress(self._get_blob(self._block_key(block_no)))
+        return _block_slot(data, self.record_block, slot)
+
+    def _get_block_records(self, idxs, chunk_size=1000):
+        size = self.record_block
+        for chunk in partition_all(chunk_size, idxs):
+            blobs = self._get_id_blobs(list({idx // size for idx in chunk}),
+                                       b"blk:")
+            blocks = {}
+            for idx in chunk:
+                block_no, slot = divmod(idx, size)
+                if block_no not in blocks:
+                    if block_no not in blobs:
+                        raise KeyError(idx)
+                    blocks[block_no] = zlib.decompress(blobs[block_no])
+                yield self._get_record(
+                    _block_slot(blocks[block_no], size, slot))
+
+    def _merge_blocks(self, slots_blobs):
+        # Blocks only partly covered by slots_blobs keep their other
+        # records, so those are read back first.
+        size = self.record_block
+        partly = [self._block_key(block_no)
+                  for block_no, new in slots_blobs.items()
+                  if len(new) < size]
+        old = self._get_blobs(partly)
+        for block_no, new in slots_blobs.items():
+            key = self._block_key(block_no)
+            if old.get(key) is None:
+                blobs = [None] * size
+            else:
+                blobs = _unpack_block(zlib.decompress(old[key]), size)
+            for slot, blob in new.items():
+                blobs[slot] = blob
+            yield key, _pack_block(blobs) if any(blobs) else None
+
+    def _save_block_records(self, idx_recs, chunk_size=5000):
+        cnt = 0
+        for chunk in partition_all(chunk_size, idx_recs):
+            slots_blobs = defaultdict(dict)
+            keys_blobs = []
+            for idx, rec in chunk:
+                block_no, slot = divmod(idx, self.record_block)
+                slots_blobs[block_no][slot] = dumps(rec)
+                if rec.pk:
+                    keys_blobs.append((self._pk_key(rec.pk),
+                                       array("L", (idx,)).tobytes()))
+                cnt += 1
+            with self._block_lock:
+                keys_blobs.extend(self._merge_blocks(slots_blobs))
+                self._write_records(keys_blobs)
+        return cnt
+
+    def _delete_block_record(self, idx):
+        block_no, slot = divmod(idx, self.record_block)
+        with self._block_lock:
+            self._write_records(self._merge_blocks({block_no: {slot: None}}))
+
     def _load_record_blob(self, idx):
-        return self.record_db.Get(array("L", (idx,)).tobytes())
+        if self.record_block:
+            return self._load_block_record_blob(idx)
+        return self._get_blob(self._record_key(idx))
 
     def get_record(self, idx):
         blob = self._load_record_blob(idx)
         return self._get_record(blob)
 
-    def get_records(self, idxs):
-        for idx in idxs:
-            blob = self._load_record_blob(idx)
-            yield self._get_record(blob)
+    def get_records(self, idxs, chunk_size=1000):
+        if self.record_block:
+            yield from self._get_block_records(idxs, chunk_size)
+            return
+        for chunk in partition_all(chunk_size, idxs):
+            blobs = self._get_id_blobs(chunk)
+            for idx in chunk:
+                if idx not in blobs:
+                    raise KeyError(idx)
+                yield self._get_record(blobs[idx])
+
+    def scan_records(self, chunk_size=1000, start=0, stop=None):
+        if not self.sorted_keys:
+            yield from super().scan_records(chunk_size, start, stop)
+            return
+        last = (self.get_rowcount() if stop is None else stop) - 1
+        if last < start:
+            return
+        if not self.record_block:
+            items = self._iter_record_items(self._record_key(start),
+                                            self._record_key(last))
+            for key, blob in items:
+                yield int.from_bytes(key, "big"), self._get_record(blob)
+            return
+        size = self.record_block
+        items = self._iter_record_items(self._block_key(start // size),
+                                        self._block_key(last // size))
+        for key, data in items:
+            first = int.from_bytes(key[4:], "big") * size
+            blobs = _unpack_block(zlib.decompress(data), size)
+            for idx, blob in enumerate(blobs, first):
+                if blob is not None and start <= idx <= last:
+                    yield idx, self._get_record(blob)
+
+    @staticmethod
+    def _pk_key(pk):
+        return b"pk:" + str(pk).encode()
+
+    def get_rownum(self, pk):
+        return array("L", self.record_db.Get(self._pk_key(pk)))[0]
+
+    def _delete_pk(self, pk, idx):
+        try:
+            if self.get_rownum(pk) == idx:
+                self.record_db.Delete(self._pk_key(pk))
+        except KeyError:
+            pass
+
+    def _unlink_pk(self, idx, new_pk=None):
+        # drops the primary key entry of the record currently at idx
+        try:
+            old_pk = self.get_record(idx).pk
+        except KeyError:
+            return
+        if old_pk and old_pk != new_pk:
+            self._delete_pk(old_pk, idx)
 
     def save_record(self, rec, idx=None, save_rowcount=True):
-        idx = self.get_rowcount() + 1 if idx is None else idx
-        self.record_db.Put(array("L", (idx,)).tobytes(), dumps(rec))
+        idx = self.get_rowcount() if idx is None else idx
+        if self.record_block:
+            self._save_block_records([(idx, rec)])
+        else:
+            batch = leveldb.WriteBatch()
+            batch.Put(self._record_key(idx), dumps(rec))
+            if rec.pk:
+                batch.Put(self._pk_key(rec.pk), array("L", (idx,)).tobytes())
+            self.record_db.Write(batch)
         if save_rowcount is True:
-            self.save_rowcount(idx)
+            self.save_rowcount(idx + 1)
         return idx
 
-    update_record = save_record
+    def update_record(self, rec, idx):
+        self._unlink_pk(idx, rec.pk)
+        return self.save_record(rec, idx, save_rowcount=False)
 
     def save_records(self, idx_recs, record_db=None, chunk_size=5000):
+        if self.record_block:
+            return self._save_block_records(idx_recs, chunk_size)
         chunks = partition_all(chunk_size, idx_recs)
         cnt = counter()
         for chunk in chunks:
             batch = leveldb.WriteBatch()
             for idx, rec in chunk:
-                batch.Put(array("L", (idx,)).tobytes(), dumps(rec))
+                batch.Put(self._record_key(idx), dumps(rec))
+                if rec.pk:
+                    batch.Put(self._pk_key(rec.pk),
+                              array("L", (idx,)).tobytes())
                 next(cnt)
             self.record_db.Write(batch)
         return next(cnt)
 
+    def _load_deleted(self):
+        deleted = Tombstones()
+        keys = self.record_db.RangeIter(b"del:", b"del:" + b"\xff" * 8,
+                                        include_value=False)
+        for key in keys:
+            deleted.add(array("L", bytes(key[4:]))[0])
+        return deleted
+
+    def get_deleted(self):
+        if self._deleted is None:
+            self._deleted = self._load_deleted()
+        return self._deleted
+
+    def get_sizes(self):
+        blobs = []
+        for chunk_no in counter():
+            try:
+                blobs.append(self._get_blob(b"Sizes:%i" % chunk_no))
+            except KeyError:
+                break
+        return RecordSizes.fromchunks(blobs) if blobs else None
+
+    def save_sizes(self, sizes, idxs=None):
+        self._write_records((b"Sizes:%i" % chunk_no, blob)
+                            for chunk_no, blob in sizes.chunks(idxs))
+
+    def _put_tombstone(self, idx):
+        self.record_db.Put(b"del:" + array("L", (idx,)).tobytes(), b"")
+
+    def _tombstone(self, idx):
+        self._put_tombstone(idx)
+        if self._deleted is not None:
+            self._deleted.add(idx)
+
     def delete_record(self, idx):
-        self.record_db.Delete(array("L", (idx,)).tobytes())
+        self._unlink_pk(idx)
+        if self.record_block:
+            self._delete_block_record(idx)
+        else:
+            self.record_db.Delete(self._record_key(idx))
+        self._tombstone(idx)
 
 
 backends = {"leveldb": LevelDBBackend}
@@ -440,3 +1330,63 @@ backend_arg = (["-b", "--backend"], {
              "`leveldb://localhost/path/to/db'"),
     "required": True
 })
+
+
+class CLI:
+
+    name = "copy"
+
+    help = ("Copy an index to another backend, e.g. to move it to a new "
+            "record layout such as ?sorted_keys=true")
+
+    arguments = [
+        backend_arg,
+        (["-o", "--output"], {
+            "type": str,
+            "help": "URL of the storage backend to copy the index to",
+            "required": True
+        }),
+        (["--readers"], {
+            "type": int,
+            "default": 1,
+            "help": "Number of threads reading from --backend"
+        }),
+        (["--writers"], {
+            "type": int,
+            "default": 1,
+            "help": "Number of threads writing to --output"
+        }),
+        (["--batch-size"], {
+            "type": int,
+            "default": COPY_BATCH_SIZE,
+            "help": "Number of records or tokens to move at a time"
+        }),
+        (["--manifest"], {
+            "help": ("Record copy progress in this file so an "
+                     "interrupted copy can be resumed")
+        }),
+        (["--resume"], {
+            "help": ("Resume the copy recorded in --manifest, skipping "
+                     "the work already done"),
+            "action": "store_true"
+        }),
+    ]
+
+    @staticmethod
+    def hook(parser, args):
+        if args.resume and args.manifest is None:
+            print("--resume requires --manifest", file=sys.stderr)
+            parser.print_help()
+            sys.exit(1)
+        backend_from = parse_url(args.backend)
+        backend_to = parse_url(args.output)
+        try:
+            with backend_to.bulk_load():
+                copy(backend_from, backend_to, readers=args.readers,
+                     writers=args.writers, batch_size=args.batch_size,
+                     manifest=args.manifest, resume=args.resume,
+                     backend_from_url=args.backend,
+                     backend_to_url=args.output)
+        finally:
+            backend_from.close()
+            backend_to.close()
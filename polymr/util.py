@@ -1,3 +1,5 @@
+import os
+import json
 from heapq import merge as _merge
 
 KMER_SIZE = 3
@@ -21,6 +23,15 @@ def jaccard(a, b):
     return 1 - (float(n) / (len(a) + len(b) - n))
 
 
+def json_default(obj):
+    """For ``json.dumps``: records can come back from a backend with
+    their data as bytes, which are written as text."""
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", "replace")
+    raise TypeError("Object of type %s is not JSON serializable"
+                    % type(obj).__name__)
+
+
 def openfile(filename_or_handle, mode='r'):
     if type(filename_or_handle) is str:
         return open(filename_or_handle, mode)
@@ -46,3 +57,31 @@ def merge_to_range(ls):
             ret.append(x)
         prev = x
     return ret, compacted
+
+
+class Manifest:
+    """Progress of a long running job, saved as JSON after every step so
+    an interrupted run can be resumed.
+
+    Without a path nothing is saved, so nothing can be resumed.
+    """
+
+    def __init__(self, path, params, resume=False, **initial):
+        self.path = path
+        if resume and path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+            if self.state["params"] != params:
+                raise ValueError(
+                    "Can't resume from {}: it was written by a run with "
+                    "different parameters".format(path))
+        else:
+            self.state = dict(initial, params=params, done=False)
+
+    def save(self):
+        if self.path is None:
+            return
+        tmppath = self.path + ".tmp"
+        with open(tmppath, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmppath, self.path)
@@ -1,8 +1,15 @@
+import os
+import queue
 import operator
+import threading
+import contextlib
+from array import array
 from collections import defaultdict
 from itertools import chain
 from itertools import repeat
 from urllib.parse import urlunparse
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
 
 from toolz import partition_all
 import postgresql
@@ -16,15 +23,110 @@ from polymr.storage import AbstractBackend
 snd = operator.itemgetter(1)
 cat = chain.from_iterable
 
+# Advisory lock key taken while moving the record id sequence
+_ID_SEQ_LOCK = 0x706f6c79
+
+
+class CachedConnection(object):
+    """Wraps a connection, preparing each distinct statement only once.
+
+    :param conn: An open ``postgresql`` connection
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self._stmts = {}
+
+    def prepare(self, sql):
+        stmt = self._stmts.get(sql)
+        if stmt is None:
+            stmt = self._stmts[sql] = self.conn.prepare(sql)
+        return stmt
+
+    def __getattr__(self, attr):
+        return getattr(self.conn, attr)
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of at most ``size`` connections to ``url``.
+
+    Connections are opened lazily and each keeps its own cache of
+    prepared statements. The pool is reset after a fork so child
+    processes never share sockets with their parent. A pool made from
+    a connection rather than a URL can't open another, so it can't be
+    used once it's reset or closed.
+    """
+    def __init__(self, url=None, size=1, connection=None,
+                 connect=postgresql.open):
+        self.url = url
+        self.size = size
+        self.connect = connect
+        self._lock = threading.Lock()
+        self._reset()
+        if connection is not None:
+            self._add(connection)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._free = queue.LifoQueue()
+        self._all = []
+
+    def _add(self, conn):
+        conn = CachedConnection(conn)
+        self._all.append(conn)
+        self._free.put(conn)
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            try:
+                return self._free.get_nowait()
+            except queue.Empty:
+                pass
+            if self.url is None and not self._all:
+                raise RuntimeError(
+                    "This pool was made from a connection and has no "
+                    "connection left to use, either because it was "
+                    "closed or because the process forked. Open the "
+                    "backend from a URL instead.")
+            if len(self._all) < self.size and self.url is not None:
+                conn = CachedConnection(self.connect(self.url))
+                self._all.append(conn)
+                return conn
+        return self._free.get()
+
+    def _release(self, conn):
+        # a connection from before a close or fork isn't the pool's
+        # any more
+        with self._lock:
+            if any(c is conn for c in self._all):
+                self._free.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def close(self):
+        with self._lock:
+            conns, self._all = self._all, []
+            self._free = queue.LifoQueue()
+        for conn in conns:
+            conn.close()
+
 
 class PostgresBackend(AbstractBackend):
+    concurrent_writes = True
+
     def __init__(self, url_or_connection=None, create_if_missing=True,
-                 featurizer_name=None):
+                 featurizer_name=None, pool_size=1):
         if type(url_or_connection) is str:
-            url = url_or_connection
-            self._conn = postgresql.open(url)
+            self._pool = ConnectionPool(url_or_connection, size=pool_size)
         else:
-            self._conn = url_or_connection
+            self._pool = ConnectionPool(connection=url_or_connection)
         if create_if_missing is True and not self.exists():
             self.create()
         self.featurizer_name = featurizer_name
@@ -36,21 +138,26 @@ class PostgresBackend(AbstractBackend):
             self.featurizer_name = name
         self._check_dbstats()
 
+    def _connection(self):
+        return self._pool.connection()
+
     def exists(self):
         try:
-            self._conn.query.first("SELECT value FROM polymr_settings")
+            with self._connection() as conn:
+                conn.query.first("SELECT value FROM polymr_settings")
         except:
             return False
         return True
 
     def create(self):
-        self._create_settings()
-        self._create_records()
-        self._create_features()
-        self._create_feature_record_map()
-
-    def _create_settings(self):
-        self._conn.execute(
+        with self._connection() as conn:
+            self._create_settings(conn)
+            self._create_records(conn)
+            self._create_features(conn)
+            self._create_feature_record_map(conn)
+
+    def _create_settings(self, conn):
+        conn.execute(
             'CREATE TABLE IF NOT EXISTS polymr_settings ('
             ' name varchar(40) PRIMARY KEY,'
             ' value varchar(256),'
@@ -58,8 +165,8 @@ class PostgresBackend(AbstractBackend):
             ');'
         )
 
-    def _create_records(self):
-        self._conn.execute(
+    def _create_records(self, conn):
+        conn.execute(
             'CREATE TABLE IF NOT EXISTS polymr_records ('
             ' id serial PRIMARY KEY,'
             ' fields bytea,'
@@ -67,12 +174,19 @@ class PostgresBackend(AbstractBackend):
             ' data bytea'
             ');'
         )
-        self._conn.execute("ALTER SEQUENCE polymr_records_id_seq MINVALUE 0")
-        self._conn.execute("ALTER SEQUENCE polymr_records_id_seq"
-                           " RESTART WITH 0")
+        conn.execute("ALTER SEQUENCE polymr_records_id_seq MINVALUE 0")
+        conn.execute("ALTER SEQUENCE polymr_records_id_seq"
+                     " RESTART WITH 0")
+        self._create_records_pk_index(conn)
+
+    def _create_records_pk_index(self, conn):
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS polymr_records_pk_idx'
+            ' ON polymr_records USING btree (pk);'
+        )
 
-    def _create_features(self):
-        self._conn.execute(
+    def _create_features(self, conn):
+        conn.execute(
             'CREATE TABLE IF NOT EXISTS polymr_features ('
             ' id serial PRIMARY KEY,'
             ' tok bytea,'
@@ -81,41 +195,44 @@ class PostgresBackend(AbstractBackend):
             ');'
         )
 
-    def _create_feature_record_map(self, index=True):
-        self._conn.execute(
+    def _create_feature_record_map(self, conn, index=True):
+        conn.execute(
             'CREATE TABLE IF NOT EXISTS polymr_feature_record_map ('
             ' id_tok integer,'
             ' id_rec integer'
             ');'
         )
         if index is True:
-            self._create_feature_record_map_index()
+            self._create_feature_record_map_index(conn)
 
-    def _create_feature_record_map_index(self):
-        self._conn.execute(
+    def _create_feature_record_map_index(self, conn):
+        conn.execute(
             'CREATE INDEX IF NOT EXISTS polymr_feature_record_map_idx'
             ' ON polymr_feature_record_map USING btree (id_tok);'
         )
 
     def destroy(self):
-        self._conn.execute('DROP TABLE polymr_settings')
-        self._conn.execute('DROP TABLE polymr_records')
-        self._conn.execute('DROP TABLE polymr_features')
-        self._conn.execute('DROP TABLE polymr_feature_record_map')
+        with self._connection() as conn:
+            conn.execute('DROP TABLE polymr_settings')
+            conn.execute('DROP TABLE polymr_records')
+            conn.execute('DROP TABLE polymr_features')
+            conn.execute('DROP TABLE polymr_feature_record_map')
 
     def get_featurizer_name(self):
-        ress = self._conn.query.first("SELECT value FROM polymr_settings"
-                                      " WHERE name = 'featurizer'")
+        with self._connection() as conn:
+            ress = conn.query.first("SELECT value FROM polymr_settings"
+                                    " WHERE name = 'featurizer'")
         if not ress:
             raise KeyError
         return ress
 
     def save_featurizer_name(self, name):
-        stmt = self._conn.prepare(
-            'INSERT INTO polymr_settings VALUES ($1, $2)'
-            ' ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;'
-        )
-        stmt('featurizer', name)
+        with self._connection() as conn:
+            stmt = conn.prepare(
+                'INSERT INTO polymr_settings VALUES ($1, $2)'
+                ' ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value;'
+            )
+            stmt('featurizer', name)
 
     def _check_dbstats(self):
         if not self._has_freqs():
@@ -129,16 +246,21 @@ class PostgresBackend(AbstractBackend):
 
     @classmethod
     def from_urlparsed(cls, parsed, featurizer_name=None):
-        return cls(urlunparse(parsed), featurizer_name=featurizer_name)
+        params = dict(parse_qsl(parsed.query))
+        pool_size = int(params.pop('pool_size', 1))
+        parsed = parsed._replace(query=urlencode(params))
+        return cls(urlunparse(parsed), featurizer_name=featurizer_name,
+                   pool_size=pool_size)
 
     def close(self):
-        self._conn.close()
+        self._pool.close()
 
     def find_least_frequent_tokens(self, toks, r, k=None):
-        stmt = self._conn.prepare("SELECT tok, freq FROM polymr_features"
-                                  " WHERE tok = $1")
-        toks_freqs = sorted(filter(None, map(stmt.first, toks)),
-                            key=snd)
+        with self._connection() as conn:
+            stmt = conn.prepare("SELECT tok, freq FROM polymr_features"
+                                " WHERE tok = $1")
+            toks_freqs = sorted(filter(None, map(stmt.first, toks)),
+                                key=snd)
         ret = []
         total = 0
         for i, (tok, freq) in enumerate(toks_freqs):
@@ -151,27 +273,31 @@ class PostgresBackend(AbstractBackend):
         return ret
 
     def _has_freqs(self):
-        cnt = self._conn.query.first("SELECT COUNT(*) FROM polymr_features")
+        with self._connection() as conn:
+            cnt = conn.query.first("SELECT COUNT(*) FROM polymr_features")
         return cnt > 1
 
     def get_freqs(self):
-        stmt = self._conn.prepare('SELECT tok, freq FROM polymr_features')
-        return defaultdict(int, cat(stmt.chunks()))
+        with self._connection() as conn:
+            stmt = conn.prepare('SELECT tok, freq FROM polymr_features')
+            return defaultdict(int, cat(stmt.chunks()))
 
     def update_freqs(self, toks_cnts):
-        stmt = self._conn.prepare(
-            "INSERT INTO polymr_features VALUES (DEFAULT, $1, $2)"
-            " ON CONFLICT (tok) DO UPDATE SET freq = EXCLUDED.freq"
-        )
         chunks = partition_all(1000, toks_cnts)
-        with self._conn.xact():
-            stmt.load_chunks(chunks)
+        with self._connection() as conn:
+            stmt = conn.prepare(
+                "INSERT INTO polymr_features VALUES (DEFAULT, $1, $2)"
+                " ON CONFLICT (tok) DO UPDATE SET freq = EXCLUDED.freq"
+            )
+            with conn.xact():
+                stmt.load_chunks(chunks)
 
     def save_freqs(self, freqs_dict):
         return self.update_freqs(freqs_dict.items())
 
     def get_rowcount(self):
-        return self._conn.query.first("SELECT count(*) FROM polymr_records")
+        with self._connection() as conn:
+            return conn.query.first("SELECT count(*) FROM polymr_records")
 
     def increment_rowcount(self, cnt):
         pass
@@ -180,24 +306,37 @@ class PostgresBackend(AbstractBackend):
         pass
 
     def get_token(self, name):
-        stmt = self._conn.prepare(
-            'SELECT b.id_rec FROM polymr_features a'
-            ' LEFT JOIN polymr_feature_record_map b ON a.id = b.id_tok'
-            ' WHERE a.tok = $1'
-        )
-        return list(cat(cat(stmt.chunks(name))))
+        with self._connection() as conn:
+            stmt = conn.prepare(
+                'SELECT b.id_rec FROM polymr_features a'
+                ' JOIN polymr_feature_record_map b ON a.id = b.id_tok'
+                ' WHERE a.tok = $1'
+            )
+            return list(cat(cat(stmt.chunks(name))))
+
+    @staticmethod
+    def _get_token(blob):
+        return array("L", blob)
+
+    def _load_token_blob(self, name):
+        return array("L", self.get_token(name)).tobytes()
 
     def update_token(self, name, record_ids):
-        self.save_token(name, record_ids, False)
+        return self.save_token(name, record_ids, False)
 
     def drop_records_from_token(self, name, bad_record_ids):
-        delete = self._conn.prepare(
-            "DELETE FROM polymr_feature_record_map"
-            " WHERE id_tok in (SELECT id FROM polymr_features WHERE tok = $1)"
-            " AND id_rec = $2"
-        )
-        with self._conn.xact():
-            delete.load_rows(zip(repeat(name), bad_record_ids))
+        with self._connection() as conn:
+            freq = conn.prepare(
+                "WITH dropped AS ("
+                " DELETE FROM polymr_feature_record_map"
+                " WHERE id_tok in"
+                " (SELECT id FROM polymr_features WHERE tok = $1)"
+                " AND id_rec = ANY($2::integer[]) RETURNING id_rec)"
+                " UPDATE polymr_features"
+                " SET freq = freq - (SELECT count(*) FROM dropped)"
+                " WHERE tok = $1 RETURNING freq"
+            ).first(name, list(bad_record_ids))
+        return freq or 0
 
     def save_token(self, name, record_ids, compacted=False):
         if compacted is False:
@@ -205,96 +344,214 @@ class PostgresBackend(AbstractBackend):
         else:
             record_id_len = sum(1 if type(i) is int else i[1] - i[0] + 1
                                 for i in record_ids)
-        tok_id = self._conn.prepare(
-            "INSERT INTO polymr_features AS a VALUES (DEFAULT, $1, $2)"
-            " ON CONFLICT (tok) DO UPDATE SET freq = a.freq + EXCLUDED.freq"
-            " RETURNING id"
-        ).first(name, record_id_len)
-        stmt = self._conn.prepare(
-            'INSERT INTO polymr_feature_record_map VALUES ($1, $2)'
-        )
-        with self._conn.xact():
-            if compacted is False:
-                stmt.load_rows(zip(repeat(tok_id), record_ids))
-            else:
-                for record_id in record_ids:
-                    if type(record_id) is list:
-                        ids = range(record_id[0], record_id[1]+1)
-                        stmt.load_rows(zip(repeat(tok_id), ids))
-                    else:
-                        stmt(tok_id, record_id)
+        with self._connection() as conn:
+            tok_id, freq = conn.prepare(
+                "INSERT INTO polymr_features AS a VALUES (DEFAULT, $1, $2)"
+                " ON CONFLICT (tok)"
+                " DO UPDATE SET freq = a.freq + EXCLUDED.freq"
+                " RETURNING id, freq"
+            ).first(name, record_id_len)
+            stmt = conn.prepare(
+                'INSERT INTO polymr_feature_record_map VALUES ($1, $2)'
+            )
+            with conn.xact():
+                if compacted is False:
+                    stmt.load_rows(zip(repeat(tok_id), record_ids))
+                else:
+                    for record_id in record_ids:
+                        if type(record_id) is list:
+                            ids = range(record_id[0], record_id[1]+1)
+                            stmt.load_rows(zip(repeat(tok_id), ids))
+                        else:
+                            stmt(tok_id, record_id)
+        return freq
 
     def save_tokens(self, names_ids):
-        stmt = self._conn.prepare("COPY polymr_feature_record_map FROM STDIN")
-        ids = self._conn.query.chunks("SELECT tok, id FROM polymr_features")
-        tok_cache = dict(cat(ids))
-
-        def _rows():
-            for name, record_ids in names_ids:
-                for record_id in record_ids:
-                    tok_id = tok_cache[name]
-                    if type(record_id) is list:
-                        for i in range(record_id[0], record_id[1]+1):
-                            yield '{}\t{}\n'.format(tok_id, i).encode()
-                    else:
-                        yield '{}\t{}\n'.format(tok_id, record_id).encode()
-
-        with self._conn.xact():
-            stmt.load_rows(_rows())
-
-    def _prepare_record_select(self):
-        return self._conn.prepare(
+        # The postings are staged in a temporary table so that saving a
+        # token again, as a resumed build may, replaces its postings
+        # instead of adding to them.
+        with self._connection() as conn:
+            ids = conn.query.chunks("SELECT tok, id FROM polymr_features")
+            tok_cache = dict(cat(ids))
+
+            def _rows():
+                for name, record_ids in names_ids:
+                    for record_id in record_ids:
+                        tok_id = tok_cache[name]
+                        if type(record_id) is list:
+                            for i in range(record_id[0], record_id[1]+1):
+                                yield '{}\t{}\n'.format(tok_id, i).encode()
+                        else:
+                            yield '{}\t{}\n'.format(
+                                tok_id, record_id).encode()
+
+            with conn.xact():
+                conn.execute(
+                    "CREATE TEMPORARY TABLE polymr_tokens_load"
+                    " (LIKE polymr_feature_record_map) ON COMMIT DROP"
+                )
+                conn.prepare(
+                    "COPY polymr_tokens_load FROM STDIN"
+                ).load_rows(_rows())
+                conn.execute(
+                    "DELETE FROM polymr_feature_record_map a"
+                    " USING (SELECT DISTINCT id_tok FROM polymr_tokens_load)"
+                    " b WHERE a.id_tok = b.id_tok"
+                )
+                conn.execute(
+                    "INSERT INTO polymr_feature_record_map"
+                    " SELECT * FROM polymr_tokens_load"
+                )
+
+    @staticmethod
+    def _prepare_record_select(conn):
+        return conn.prepare(
             'SELECT fields, pk, data FROM polymr_records WHERE id = $1'
         )
 
-    def _get_record(self, idx, stmt):
+    @staticmethod
+    def _fetch_record_row(idx, stmt):
         packed = stmt.first(idx)
         if packed is None:
             raise KeyError
+        return packed
+
+    @staticmethod
+    def _record_from_row(packed):
         return Record(list(map(bytes.decode, loads(packed[0]))),
                       packed[1],
                       loads(packed[2]))
 
+    @staticmethod
+    def _get_record(blob):
+        fields, pk, data = loads(blob)
+        return PostgresBackend._record_from_row((fields, pk.decode(), data))
+
+    def _load_record_blob(self, idx):
+        with self._connection() as conn:
+            stmt = self._prepare_record_select(conn)
+            fields, pk, data = self._fetch_record_row(idx, stmt)
+        return dumps((fields, pk.encode(), data))
+
     def get_record(self, idx):
-        stmt = self._prepare_record_select()
-        return self._get_record(idx, stmt)
+        with self._connection() as conn:
+            stmt = self._prepare_record_select(conn)
+            packed = self._fetch_record_row(idx, stmt)
+        return self._record_from_row(packed)
 
     def get_records(self, idxs):
-        stmt = self._prepare_record_select()
-        for idx in idxs:
-            yield self._get_record(idx, stmt)
+        with self._connection() as conn:
+            stmt = self._prepare_record_select(conn)
+            rows = [self._fetch_record_row(idx, stmt) for idx in idxs]
+        for packed in rows:
+            yield self._record_from_row(packed)
+
+    def scan_records(self, chunk_size=1000, start=0, stop=None):
+        # Ids can run past the rowcount, which counts rows, so page
+        # through them by id instead.
+        while stop is None or start < stop:
+            with self._connection() as conn:
+                rows = conn.prepare(
+                    'SELECT id, fields, pk, data FROM polymr_records'
+                    ' WHERE id >= $1 AND ($2::integer IS NULL OR id < $2)'
+                    ' ORDER BY id LIMIT $3'
+                )(start, stop, chunk_size)
+            for row in rows:
+                yield row[0], self._record_from_row(row[1:])
+            if len(rows) < chunk_size:
+                break
+            start = rows[-1][0] + 1
+
+    def get_rownum(self, pk):
+        with self._connection() as conn:
+            idx = conn.prepare(
+                'SELECT max(id) FROM polymr_records WHERE pk = $1'
+            ).first(str(pk))
+        if idx is None:
+            raise KeyError
+        return idx
+
+    def get_rownums(self, pks):
+        pks = list(map(str, pks))
+        with self._connection() as conn:
+            stmt = conn.prepare(
+                'SELECT pk, max(id) FROM polymr_records'
+                ' WHERE pk = ANY($1) GROUP BY pk'
+            )
+            idxs = dict(cat(stmt.chunks(pks)))
+        return [idxs.get(pk) for pk in pks]
 
     def update_record(self, rec, idx):
-        stmt = self._conn.prepare(
-            "update polymr_records set (fields, pk, data) "
-            "= ($1, $2, $3) where id = $4"
-        )
-        with self._conn.xact():
-            stmt.first(dumps(rec.fields), str(rec.pk), dumps(rec.data), idx)
+        with self._connection() as conn:
+            stmt = conn.prepare(
+                "update polymr_records set (fields, pk, data) "
+                "= ($1, $2, $3) where id = $4"
+            )
+            with conn.xact():
+                stmt.first(dumps(rec.fields), str(rec.pk),
+                           dumps(rec.data), idx)
+        return idx
+
+    @staticmethod
+    def _advance_ids(conn, next_idx):
+        # Records saved with their own ids don't draw them from the
+        # sequence, so move it past them for the next save_record. The
+        # lock keeps concurrent writers from moving it back.
+        conn.prepare("SELECT pg_advisory_xact_lock($1)").first(
+            _ID_SEQ_LOCK)
+        conn.prepare(
+            "SELECT setval('polymr_records_id_seq', $1, false)"
+            " FROM polymr_records_id_seq"
+            " WHERE last_value + is_called::int < $1"
+        ).first(next_idx)
 
     def save_record(self, rec, idx=None, save_rowcount=True):
-        stmt = self._conn.prepare(
-            'INSERT INTO polymr_records VALUES (DEFAULT, $1, $2, $3)'
-            ' RETURNING id'
-        )
-        with self._conn.xact():
-            idx = stmt.first(dumps(rec.fields), str(rec.pk), dumps(rec.data))
+        with self._connection() as conn:
+            with conn.xact():
+                if idx is None:
+                    stmt = conn.prepare(
+                        'INSERT INTO polymr_records'
+                        ' VALUES (DEFAULT, $1, $2, $3) RETURNING id'
+                    )
+                    idx = stmt.first(dumps(rec.fields), str(rec.pk),
+                                     dumps(rec.data))
+                else:
+                    stmt = conn.prepare(
+                        'INSERT INTO polymr_records VALUES ($1, $2, $3, $4)'
+                    )
+                    stmt.first(idx, dumps(rec.fields), str(rec.pk),
+                               dumps(rec.data))
+                    self._advance_ids(conn, idx + 1)
         return idx
 
     def save_records(self, idx_recs, record_db=None, chunk_size=5000):
-        stmt = self._conn.prepare(
-            'INSERT INTO polymr_records VALUES (DEFAULT, $1, $2, $3)'
-        )
-        rows = iter((dumps(rec.fields), str(rec.pk), dumps(rec.data))
-                    for rec in map(snd, idx_recs))
-        chunks = PartitionCounted(chunk_size, rows)
-        with self._conn.xact():
-            stmt.load_chunks(chunks)
+        # Records keep the ids they're given, so batches saved out of
+        # order or with gaps still match the ids in the postings. A
+        # batch saved again, as by a resumed build, replaces itself.
+        top = [-1]
+
+        def _rows():
+            for idx, rec in idx_recs:
+                top[0] = max(top[0], idx)
+                yield (idx, dumps(rec.fields), str(rec.pk), dumps(rec.data))
+        chunks = PartitionCounted(chunk_size, _rows())
+        with self._connection() as conn:
+            stmt = conn.prepare(
+                'INSERT INTO polymr_records VALUES ($1, $2, $3, $4)'
+                ' ON CONFLICT (id) DO UPDATE SET fields = EXCLUDED.fields,'
+                ' pk = EXCLUDED.pk, data = EXCLUDED.data'
+            )
+            with conn.xact():
+                stmt.load_chunks(chunks)
+                if top[0] >= 0:
+                    self._advance_ids(conn, top[0] + 1)
         return chunks.rows_sent
 
     def delete_record(self, idx):
-        self._conn.prepare('DELETE from polymr_records WHERE id = $1')(idx)
-        self._conn.prepare('DELETE from polymr_feature_record_map WHERE id_rec = $1')(idx)
+        with self._connection() as conn:
+            conn.prepare('DELETE from polymr_records WHERE id = $1')(idx)
+            conn.prepare('DELETE from polymr_feature_record_map'
+                         ' WHERE id_rec = $1')(idx)
 
 
 class PartitionCounted(object):
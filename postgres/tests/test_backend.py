@@ -1,6 +1,7 @@
 import os
 import sys
 import unittest
+import threading
 from unittest import skipIf
 
 from polymr.record import Record
@@ -40,7 +41,60 @@ class TestPostgresBackend(TestLevelDBBackend):
         self.assertEqual(db.get_rowcount(), 0)
         db.save_records(enumerate((r1, r2)))
         self.assertEqual(db.get_rowcount(), 2)
-        
+
+    def test_save_records_keeps_ids(self):
+        db = self._get_db()
+        recs = [Record(["abcde", str(i)], str(i), []) for i in range(6)]
+        # batches committed out of order, with a gap at 2
+        db.save_records([(3, recs[3]), (4, recs[4]), (5, recs[5])])
+        db.save_records([(0, recs[0]), (1, recs[1])])
+        self.assertEqual([r.pk for r in db.get_records([5, 0, 3])],
+                         ["5", "0", "3"])
+        self.assertRaises(KeyError, db.get_record, 2)
+        self.assertEqual(db.save_record(recs[2]), 6)
+
+    def test_tombstones(self):
+        # deleted records are taken out of the postings at once, so
+        # there are never any tombstones
+        db = self._get_db()
+        recs = [Record(["abcde"], str(i), []) for i in range(3)]
+        db.save_records(enumerate(recs))
+        db.save_token(b"abc", [0, 1, 2])
+        db.delete_record(1)
+        self.assertEqual(list(db.get_deleted()), [])
+        self.assertEqual(sorted(db.get_token(b"abc")), [0, 2])
+        self.assertRaises(KeyError, db.get_record, 1)
+
+    def test_scan_records_in_pages(self):
+        db = self._get_db()
+        saved = [i for i in range(20) if i % 3]
+        db.save_records((i, Record(["rec%i" % i], str(i), [])) for i in saved)
+        self.assertEqual([idx for idx, _ in db.scan_records(chunk_size=4)],
+                         saved)
+        self.assertEqual([rec.pk for _, rec
+                          in db.scan_records(chunk_size=2, start=4, stop=11)],
+                         ["4", "5", "7", "8", "10"])
+
+    def test_concurrent_queries(self):
+        self.db.close()
+        self.db = polymr_postgres.PostgresBackend(URL, pool_size=4)
+        db = self.db
+        db.save_token(b"abc", [1, 2, 3])
+        results = []
+
+        def _query():
+            for _ in range(20):
+                results.append(list(db.get_token(b"abc")))
+
+        threads = [threading.Thread(target=_query) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(results), 80)
+        self.assertTrue(all(r == [1, 2, 3] for r in results))
+        self.assertLessEqual(len(db._pool._all), 4)
+
 
 for methname in dir(TestPostgresBackend):
     if not methname.startswith("test_"):
@@ -50,4 +104,72 @@ for methname in dir(TestPostgresBackend):
             methname,
             skipIf(should_skip_test, ENVVAR+" not defined")(meth))
 
-        
+
+class FakeConnection(object):
+    def __init__(self):
+        self.prepared = []
+        self.closed = False
+
+    def prepare(self, sql):
+        self.prepared.append(sql)
+        return sql
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(unittest.TestCase):
+    def test_prepared_statement_cache(self):
+        pool = polymr_postgres.ConnectionPool(connection=FakeConnection())
+        with pool.connection() as conn:
+            conn.prepare("SELECT 1")
+            conn.prepare("SELECT 1")
+            conn.prepare("SELECT 2")
+            self.assertEqual(conn.conn.prepared, ["SELECT 1", "SELECT 2"])
+
+    def test_pool_bounded(self):
+        opened = []
+
+        def _connect(url):
+            opened.append(FakeConnection())
+            return opened[-1]
+
+        pool = polymr_postgres.ConnectionPool("pq://fake", size=2,
+                                              connect=_connect)
+        with pool.connection() as a:
+            with pool.connection() as b:
+                self.assertIsNot(a, b)
+        with pool.connection() as c:
+            self.assertIn(c, (a, b))
+        self.assertEqual(len(opened), 2)
+        pool.close()
+        self.assertTrue(all(conn.closed for conn in opened))
+
+    def test_close_while_checked_out(self):
+        opened = []
+
+        def _connect(url):
+            opened.append(FakeConnection())
+            return opened[-1]
+
+        pool = polymr_postgres.ConnectionPool("pq://fake", connect=_connect)
+        with pool.connection() as a:
+            pool.close()
+        self.assertTrue(a.conn.closed)
+        with pool.connection() as b:
+            self.assertIsNot(b, a)
+            self.assertFalse(b.conn.closed)
+        self.assertEqual(len(opened), 2)
+
+    def test_no_connection_after_fork(self):
+        pool = polymr_postgres.ConnectionPool(connection=FakeConnection())
+        with pool.connection():
+            pass
+        pool._pid = -1  # as if this process were a fork of another
+        with self.assertRaises(RuntimeError):
+            with pool.connection():
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
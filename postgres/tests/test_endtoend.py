@@ -1,12 +1,17 @@
 import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 from unittest import skipIf
 from io import StringIO
 
 import polymr.index
+import polymr.featurizers
 import polymr.storage
 import polymr.query
 import polymr.record
+import polymr.util
 import polymr_postgres
 
 ENVVAR = "POLYMR_POSTGRES_URL"
@@ -32,6 +37,7 @@ sample_pk = "989960D48D"
 class TestEndToEndWithPostgres(unittest.TestCase):
     def setUp(self):
         self.db = polymr_postgres.PostgresBackend(URL)
+        to_index.seek(0)
 
     def tearDown(self):
         self.db.destroy()
@@ -57,7 +63,64 @@ class TestEndToEndWithPostgres(unittest.TestCase):
         tpyo = "".join(tpyo)
         hit = index.search([tpyo]+sample_query[1:], limit=1)[0]
         self.assertEqual(hit['pk'], sample_pk,"searches should survive typos")
-        
-        
+
+
+    @skipIf(should_skip_test, ENVVAR+" not defined")
+    @mock.patch.object(polymr.index, "RECORD_BATCH_SIZE", 2)
+    def test_resume(self):
+        recs = list(polymr.record.from_csv(
+            to_index,
+            searched_fields_idxs=[0,2,4,5],
+            pk_field_idx=-1,
+            include_data=False
+        ))
+        workdir = tempfile.mkdtemp(suffix="polymrtest")
+        self.addCleanup(shutil.rmtree, workdir)
+        manifest = os.path.join(workdir, "build.manifest")
+
+        def build(**kwargs):
+            polymr.index.create(iter(recs), 2, 3, self.db, tmpdir=workdir,
+                                backend_url=URL, manifest=manifest,
+                                **kwargs)
+
+        # killed once the first record batch is committed, before it's
+        # checkpointed
+        save_records = self.db.save_records
+
+        def killed_after_commit(idxs_recs):
+            save_records(idxs_recs)
+            raise IOError("killed")
+
+        with mock.patch.object(self.db, "save_records",
+                               side_effect=killed_after_commit):
+            self.assertRaises(IOError, build)
+        # then once the first partition is saved, before it's checkpointed
+        manifest_save = polymr.util.Manifest.save
+
+        def killed_after_partition(manifest):
+            if manifest.state["saved"]:
+                raise IOError("killed")
+            manifest_save(manifest)
+
+        with mock.patch.object(polymr.util.Manifest, "save",
+                               killed_after_partition):
+            self.assertRaises(IOError, build, resume=True)
+        build(resume=True)
+
+        self.assertEqual(self.db.get_rowcount(), len(recs))
+        dfs = {}
+        for rec in recs:
+            for tok in polymr.featurizers.all['default'](rec.fields):
+                dfs[tok] = dfs.get(tok, 0) + 1
+        self.assertEqual(dict(self.db.get_freqs()), dfs)
+        for tok, freq in dfs.items():
+            self.assertEqual(sorted(self.db.get_token(tok)),
+                             sorted(set(self.db.get_token(tok))))
+            self.assertEqual(len(self.db.get_token(tok)), freq)
+        index = polymr.query.Index(self.db)
+        hit = index.search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,6 +1,11 @@
+import sys
+import zlib
 import operator
 from array import array
 from collections import defaultdict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
 
 import redis
 import polymr.storage
@@ -11,6 +16,84 @@ from toolz import valmap
 
 snd = operator.itemgetter(1)
 
+_ITEMSIZE = array("L").itemsize
+_STRUCT_FMT = ("<" if sys.byteorder == "little" else ">") + "I" + str(_ITEMSIZE)
+
+# Mirrors find_least_frequent_tokens and the vote tally in
+# AbstractBackend.search_candidates, but runs next to the data so only
+# the winning record ids (and optionally their records) cross the wire.
+TALLY_SCRIPT = """
+local r = tonumber(ARGV[1])
+local k = tonumber(ARGV[2])
+local n = tonumber(ARGV[3])
+local fmt = ARGV[4]
+local size = tonumber(ARGV[5])
+local fetch_records = ARGV[6] == '1'
+local has_deleted = redis.call('EXISTS', KEYS[2]) == 1
+local toks = {}
+for i = 7, #ARGV do
+  toks[#toks + 1] = ARGV[i]
+end
+if #toks == 0 then
+  return {{}, {}}
+end
+local freqs = redis.call('HMGET', KEYS[1], unpack(toks))
+local toks_freqs = {}
+for i, tok in ipairs(toks) do
+  if freqs[i] then
+    toks_freqs[#toks_freqs + 1] = {tok, tonumber(freqs[i]), i}
+  end
+end
+table.sort(toks_freqs, function(a, b)
+  return a[2] < b[2] or (a[2] == b[2] and a[3] < b[3])
+end)
+local total = 0
+local votes = {}
+local seen = {}
+for i, tok_freq in ipairs(toks_freqs) do
+  if total + tok_freq[2] > r then
+    break
+  end
+  total = total + tok_freq[2]
+  local blob = redis.call('GET', 'tok:' .. tok_freq[1])
+  if blob then
+    for pos = 1, #blob, size do
+      local idx = struct.unpack(fmt, blob, pos)
+      local v = votes[idx]
+      if v == nil then
+        seen[#seen + 1] = idx
+        votes[idx] = 1
+      else
+        votes[idx] = v + 1
+      end
+    end
+  end
+  if k > 0 and i - 1 >= k then
+    break
+  end
+end
+local order = {}
+for i = 1, #seen do
+  if not has_deleted or redis.call('GETBIT', KEYS[2], seen[i]) == 0 then
+    order[#order + 1] = i
+  end
+end
+table.sort(order, function(a, b)
+  local va, vb = votes[seen[a]], votes[seen[b]]
+  return va > vb or (va == vb and a < b)
+end)
+local top = {}
+local keys = {}
+for i = 1, math.min(n, #order) do
+  top[i] = seen[order[i]]
+  keys[i] = struct.pack(fmt, top[i])
+end
+if fetch_records and #keys > 0 then
+  return {top, redis.call('MGET', unpack(keys))}
+end
+return {top, {}}
+"""
+
 
 class FakeDict(object):
     def __init__(self, iterable):
@@ -22,11 +105,15 @@ class FakeDict(object):
 
 
 class RedisBackend(LevelDBBackend):
+    concurrent_writes = True
+
     def __init__(self, host='localhost', port=6379, db=0,
-                 featurizer_name=None, new=False):
+                 featurizer_name=None, new=False, server_side=False):
         self._freqs = None
         self.featurizer_name = featurizer_name
+        self.server_side = server_side
         self.r = redis.StrictRedis(host=host, port=port, db=db)
+        self._tally = self.r.register_script(TALLY_SCRIPT)
         if new is True:
             self.destroy()
         if not self.featurizer_name:
@@ -39,8 +126,10 @@ class RedisBackend(LevelDBBackend):
     @classmethod
     def from_urlparsed(cls, parsed, featurizer_name=None, read_only=None):
         path = parsed.path.strip("/") or 0
+        params = dict(parse_qsl(parsed.query))
         return cls(host=parsed.hostname, port=parsed.port, db=path,
-                   featurizer_name=featurizer_name)
+                   featurizer_name=featurizer_name,
+                   server_side=params.get('server_side') == 'true')
 
     def close(self):
         pass
@@ -69,11 +158,36 @@ class RedisBackend(LevelDBBackend):
                 break
         return ret
 
+    def _tally_votes(self, toks, r, n, k, fetch_records):
+        args = [r, k or 0, n, _STRUCT_FMT, _ITEMSIZE,
+                1 if fetch_records else 0]
+        return self._tally(keys=[b'freqs', b'deleted'],
+                           args=args + list(toks))
+
+    def search_candidates(self, toks, r, n, k=None):
+        if not self.server_side:
+            return super().search_candidates(toks, r, n, k)
+        record_ids, _ = self._tally_votes(toks, r, n, k, False)
+        return record_ids
+
+    def search_candidates_many(self, toks_list, r, n, k=None):
+        if not self.server_side:
+            return super().search_candidates_many(toks_list, r, n, k)
+        return [self.search_candidates(toks, r, n, k) for toks in toks_list]
+
+    def search_candidate_records(self, toks, r, n, k=None):
+        if not self.server_side:
+            return super().search_candidate_records(toks, r, n, k)
+        record_ids, blobs = self._tally_votes(toks, r, n, k, True)
+        if any(blob is None for blob in blobs):
+            raise KeyError
+        return record_ids, map(self._get_record, blobs)
+
     def get_freqs(self):
         return defaultdict(int, valmap(int, self.r.hgetall(b'freqs')))
 
     def update_freqs(self, toks_cnts):
-        if type(toks_cnts) is not dict:
+        if not isinstance(toks_cnts, Mapping):
             toks_cnts = FakeDict(toks_cnts)
         self.r.hmset(b"freqs", toks_cnts)
 
@@ -97,6 +211,14 @@ class RedisBackend(LevelDBBackend):
             raise KeyError
         return blob
 
+    def get_tokens(self, names, chunk_size=5000):
+        for chunk in partition_all(chunk_size, names):
+            blobs = self.r.mget([b"tok:"+name for name in chunk])
+            if any(blob is None for blob in blobs):
+                raise KeyError
+            for blob in blobs:
+                yield self._get_token(blob)
+
     def save_token(self, name, record_ids):
         self.r.set(b"tok:"+name, array("L", record_ids).tobytes())
 
@@ -124,10 +246,33 @@ class RedisBackend(LevelDBBackend):
             for blob in blobs:
                 yield self._get_record(blob)
 
+    def get_rownum(self, pk):
+        blob = self.r.get(self._pk_key(pk))
+        if blob is None:
+            raise KeyError
+        return array("L", blob)[0]
+
+    def get_rownums(self, pks):
+        blobs = self.r.mget([self._pk_key(pk) for pk in pks])
+        return [None if blob is None else array("L", blob)[0]
+                for blob in blobs]
+
+    def _delete_pk(self, pk, idx):
+        try:
+            if self.get_rownum(pk) == idx:
+                self.r.delete(self._pk_key(pk))
+        except KeyError:
+            pass
+
     def save_record(self, rec, idx=None, save_rowcount=True):
-        if not idx or save_rowcount is True:
-            idx = self.r.incr(b'rowcount')
-        self.r.set(array("L", (idx,)).tobytes(), dumps(rec))
+        if idx is None:
+            idx = self.r.incr(b'rowcount') - 1
+        key = array("L", (idx,)).tobytes()
+        pipe = self.r.pipeline()
+        pipe.set(key, dumps(rec))
+        if rec.pk:
+            pipe.set(self._pk_key(rec.pk), key)
+        pipe.execute()
         return idx
 
     def save_records(self, idx_recs, chunk_size=5000):
@@ -137,15 +282,236 @@ class RedisBackend(LevelDBBackend):
             tot += len(chunk)
             pipe = self.r.pipeline()
             for idx, rec in chunk:
-                pipe.set(array("L", (idx,)).tobytes(), dumps(rec))
+                key = array("L", (idx,)).tobytes()
+                pipe.set(key, dumps(rec))
+                if rec.pk:
+                    pipe.set(self._pk_key(rec.pk), key)
             pipe.execute()
         return tot
 
+    def _load_deleted(self):
+        return polymr.storage.Tombstones(self.r.get(b'deleted') or b"")
+
+    def _put_tombstone(self, idx):
+        self.r.setbit(b'deleted', idx, 1)
+
+    # Server side tallies return records with their ids in one round
+    # trip, so there is nothing to gain from bounding scores first.
+    get_sizes = polymr.storage.AbstractBackend.get_sizes
+    save_sizes = polymr.storage.AbstractBackend.save_sizes
+
     def delete_record(self, idx):
+        self._unlink_pk(idx)
         self.r.delete(array("L", (idx,)).tobytes())
+        self._tombstone(idx)
 
     def destroy(self):
         self.r.flushdb()
 
 
+class ShardedRedisBackend(RedisBackend):
+    """Spreads tokens, frequencies and records over several Redis
+    instances. Each token's frequency lives on the same shard as its
+    posting list. Index metadata (featurizer name, rowcount) is kept on
+    the first shard.
+
+    :param hosts_ports: The (host, port) pair of each shard
+    :type hosts_ports: list of tuple
+    """
+    def __init__(self, hosts_ports=(('localhost', 6379),), db=0,
+                 featurizer_name=None, new=False):
+        self.shards = [redis.StrictRedis(host=host, port=port, db=db)
+                       for host, port in hosts_ports]
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards))
+        host, port = hosts_ports[0]
+        super().__init__(host=host, port=port, db=db,
+                         featurizer_name=featurizer_name, new=new)
+
+    @classmethod
+    def from_urlparsed(cls, parsed, featurizer_name=None, read_only=None):
+        hosts_ports = []
+        for hostport in parsed.netloc.split(","):
+            host, _, port = hostport.partition(":")
+            hosts_ports.append((host or 'localhost', int(port or 6379)))
+        path = parsed.path.strip("/") or 0
+        return cls(hosts_ports, db=path, featurizer_name=featurizer_name)
+
+    def close(self):
+        self._executor.shutdown()
+
+    def _shard_for(self, key):
+        return zlib.crc32(key) % len(self.shards)
+
+    def _by_shard(self, keys):
+        groups = defaultdict(list)
+        for i, key in enumerate(keys):
+            groups[self._shard_for(key)].append(i)
+        return groups
+
+    def _on_shards(self, func, groups):
+        return self._executor.map(lambda shard_idxs: func(*shard_idxs),
+                                  groups.items())
+
+    def _mget(self, keys):
+        keys = list(keys)
+        ret = [None] * len(keys)
+
+        def _get(shard, idxs):
+            return idxs, self.shards[shard].mget([keys[i] for i in idxs])
+
+        for idxs, blobs in self._on_shards(_get, self._by_shard(keys)):
+            for i, blob in zip(idxs, blobs):
+                ret[i] = blob
+        return ret
+
+    def _mset(self, keys_vals):
+        keys_vals = list(keys_vals)
+
+        def _set(shard, idxs):
+            pipe = self.shards[shard].pipeline(transaction=False)
+            for i in idxs:
+                pipe.set(*keys_vals[i])
+            pipe.execute()
+
+        groups = self._by_shard(key for key, _ in keys_vals)
+        list(self._on_shards(_set, groups))
+
+    def find_least_frequent_tokens(self, toks, r, k=None):
+        toks = list(toks)
+        freqs = [None] * len(toks)
+
+        def _hmget(shard, idxs):
+            return idxs, self.shards[shard].hmget(
+                b'freqs', [toks[i] for i in idxs])
+
+        groups = self._by_shard(b"tok:"+tok for tok in toks)
+        for idxs, shard_freqs in self._on_shards(_hmget, groups):
+            for i, freq in zip(idxs, shard_freqs):
+                freqs[i] = freq
+        toks_freqs = [(tok, int(freq)) for tok, freq in zip(toks, freqs)
+                      if freq is not None]
+        total = 0
+        ret = []
+        for i, (tok, freq) in enumerate(sorted(toks_freqs, key=snd)):
+            if total + freq > r:
+                break
+            total += freq
+            ret.append(tok)
+            if k and i >= k:  # try to get k token mappings
+                break
+        return ret
+
+    def get_freqs(self):
+        freqs = defaultdict(int)
+        for shard_freqs in self._executor.map(
+                lambda shard: shard.hgetall(b'freqs'), self.shards):
+            freqs.update(valmap(int, shard_freqs))
+        return freqs
+
+    def update_freqs(self, toks_cnts, chunk_size=5000):
+        if isinstance(toks_cnts, Mapping):
+            toks_cnts = toks_cnts.items()
+
+        def _hset(shard, idxs):
+            self.shards[shard].hset(b'freqs', mapping=dict(
+                chunk[i] for i in idxs))
+
+        for chunk in partition_all(chunk_size, toks_cnts):
+            groups = self._by_shard(b"tok:"+tok for tok, _ in chunk)
+            list(self._on_shards(_hset, groups))
+
+    save_freqs = update_freqs
+
+    def _load_token_blob(self, name):
+        key = b"tok:"+name
+        blob = self.shards[self._shard_for(key)].get(key)
+        if blob is None:
+            raise KeyError
+        return blob
+
+    def get_tokens(self, names, chunk_size=5000):
+        for chunk in partition_all(chunk_size, names):
+            blobs = self._mget(b"tok:"+name for name in chunk)
+            if any(blob is None for blob in blobs):
+                raise KeyError
+            for blob in blobs:
+                yield self._get_token(blob)
+
+    def save_token(self, name, record_ids):
+        key = b"tok:"+name
+        self.shards[self._shard_for(key)].set(
+            key, array("L", record_ids).tobytes())
+
+    def save_tokens(self, names_ids, chunk_size=5000):
+        for chunk in partition_all(chunk_size, names_ids):
+            self._mset((b"tok:"+name, array("L", record_ids).tobytes())
+                       for name, record_ids in chunk)
+
+    def _load_record_blob(self, idx):
+        key = array("L", (idx,)).tobytes()
+        blob = self.shards[self._shard_for(key)].get(key)
+        if blob is None:
+            raise KeyError
+        return blob
+
+    def get_records(self, idxs, chunk_size=5000):
+        for chunk in partition_all(chunk_size, idxs):
+            blobs = self._mget(array("L", (idx,)).tobytes() for idx in chunk)
+            if any(blob is None for blob in blobs):
+                raise KeyError
+            for blob in blobs:
+                yield self._get_record(blob)
+
+    def get_rownum(self, pk):
+        key = self._pk_key(pk)
+        blob = self.shards[self._shard_for(key)].get(key)
+        if blob is None:
+            raise KeyError
+        return array("L", blob)[0]
+
+    def get_rownums(self, pks):
+        blobs = self._mget(self._pk_key(pk) for pk in pks)
+        return [None if blob is None else array("L", blob)[0]
+                for blob in blobs]
+
+    def _delete_pk(self, pk, idx):
+        try:
+            if self.get_rownum(pk) == idx:
+                key = self._pk_key(pk)
+                self.shards[self._shard_for(key)].delete(key)
+        except KeyError:
+            pass
+
+    def _record_items(self, idx_recs):
+        for idx, rec in idx_recs:
+            key = array("L", (idx,)).tobytes()
+            yield key, dumps(rec)
+            if rec.pk:
+                yield self._pk_key(rec.pk), key
+
+    def save_record(self, rec, idx=None, save_rowcount=True):
+        if idx is None:
+            idx = self.r.incr(b'rowcount') - 1
+        self._mset(self._record_items([(idx, rec)]))
+        return idx
+
+    def save_records(self, idx_recs, chunk_size=5000):
+        tot = 0
+        for chunk in partition_all(chunk_size, idx_recs):
+            tot += len(chunk)
+            self._mset(self._record_items(chunk))
+        return tot
+
+    def delete_record(self, idx):
+        self._unlink_pk(idx)
+        key = array("L", (idx,)).tobytes()
+        self.shards[self._shard_for(key)].delete(key)
+        self._tombstone(idx)
+
+    def destroy(self):
+        for shard in self.shards:
+            shard.flushdb()
+
+
 polymr.storage.backends['redis'] = RedisBackend
+polymr.storage.backends['redis-shards'] = ShardedRedisBackend
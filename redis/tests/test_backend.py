@@ -3,6 +3,7 @@ import sys
 import shutil
 import tempfile
 import unittest
+from unittest import skipIf
 
 from polymr.record import Record
 import polymr.storage
@@ -13,6 +14,11 @@ sys.path.append(os.path.join(here, "..", "..", "tests"))
 
 from test_storage import TestLevelDBBackend
 
+# e.g. redis-shards://localhost:6379,localhost:6380/1
+ENVVAR = "POLYMR_REDIS_SHARDS_URL"
+SHARDS_URL = os.environ.get(ENVVAR, False)
+should_skip_test = not bool(SHARDS_URL)
+
 
 class TestRedisBackend(TestLevelDBBackend):
 
@@ -24,5 +30,38 @@ class TestRedisBackend(TestLevelDBBackend):
         self.db = polymr_redis.RedisBackend(db=1, new=True)
         return self.db
 
+    def test_get_tokens(self):
+        db = self._get_db()
+        db.save_tokens([(b"abc", [1, 2, 3]), (b"bcd", [4])])
+        rngs = db.get_tokens([b"bcd", b"abc"])
+        self.assertEqual([[4], [1, 2, 3]], list(map(list, rngs)))
+        with self.assertRaises(KeyError):
+            list(db.get_tokens([b"abc", b"missing"]))
+
+@skipIf(should_skip_test, ENVVAR+" not defined")
+class TestShardedRedisBackend(TestLevelDBBackend):
+
+    def _get_db(self, new=False):
+        if self.db and not new:
+            return self.db
+        if self.db:
+            self.db.close()
+        self.db = polymr.storage.parse_url(SHARDS_URL)
+        self.db.destroy()
+        self.db._check_dbstats()
+        return self.db
+
+    def test_keys_spread_over_shards(self):
+        db = self._get_db()
+        db.save_tokens((str(i).encode(), [i]) for i in range(100))
+        db.save_freqs({str(i).encode(): 1 for i in range(100)})
+        self.assertTrue(all(shard.dbsize() > 1 for shard in db.shards))
+        toks = [str(i).encode() for i in range(100)]
+        self.assertEqual(len(db.find_least_frequent_tokens(toks, 1000)), 100)
+        rngs = db.get_tokens(toks)
+        self.assertEqual([[i] for i in range(100)], list(map(list, rngs)))
+        self.assertEqual(len(db.get_freqs()), 100)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,12 +2,16 @@ import os
 import shutil
 import tempfile
 import unittest
+from io import BytesIO
 from io import StringIO
 
 import polymr.index
+import polymr.dedup
+import polymr.featurizers
 import polymr.storage
 import polymr.query
 import polymr.record
+import polymr.snapshot
 import polymr_redis
 
 
@@ -27,6 +31,15 @@ sample_query = ["01030","MELANI","PICKETT","18 PAUL REVERE DR"]
 sample_pk = "989960D48D"
 
 
+def _records():
+    return list(polymr.record.from_csv(
+        to_index,
+        searched_fields_idxs=[0,2,4,5],
+        pk_field_idx=-1,
+        include_data=False
+    ))
+
+
 class TestEndToEndWithRedis(unittest.TestCase):
     def setUp(self):
         self.workdir = tempfile.mkdtemp(suffix="polymrtest")
@@ -58,7 +71,88 @@ class TestEndToEndWithRedis(unittest.TestCase):
         tpyo = "".join(tpyo)
         hit = index.search([tpyo]+sample_query[1:], limit=1)[0]
         self.assertEqual(hit['pk'], sample_pk,"searches should survive typos")
-        
+
+    def test_server_side_tally(self):
+        recs = _records()
+        polymr.index.create(recs, 1, 10, self.db)
+        server_side = polymr_redis.RedisBackend(server_side=True)
+        toks = polymr.featurizers.all['default'](sample_query)
+        for r, n, k in [(100, 5, None), (10, 3, None), (100, 10, 4)]:
+            self.assertEqual(
+                self.db.search_candidates(toks, r, n, k),
+                server_side.search_candidates(toks, r, n, k))
+        index = polymr.query.Index(server_side)
+        hit = index.search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+        self.assertEqual(index.search([], limit=1), [])
+
+    def test_parallel_partition_saving(self):
+        recs = _records()
+        polymr.index.create(recs, 3, 3, self.db,
+                            backend_url="redis://localhost:6379/0")
+        for tok, freq in self.db.get_freqs().items():
+            self.assertEqual(len(self.db.get_token(tok)), freq)
+        index = polymr.query.Index(self.db)
+        hit = index.search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+
+    def test_hashed_tokens(self):
+        recs = _records()
+        self.db.destroy()
+        polymr.index.create(recs, 1, 10, self.db,
+                            featurizer_name="default:h16")
+        for tok, freq in self.db.get_freqs().items():
+            self.assertEqual(len(tok), 4)
+            self.assertEqual(len(self.db.get_token(tok)), freq)
+        index = polymr.query.Index(self.db)
+        hit = index.search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+        self.db.destroy()
+
+    def test_parallel_dedup(self):
+        recs = _records()
+        self.db.destroy()
+        polymr.index.create(recs + recs[:2], 1, 10, self.db)
+        out = StringIO()
+        n = polymr.dedup.dedup("redis://localhost:6379/0", out, 0.1,
+                               processes=2, chunk_size=3)
+        self.assertEqual(n, 2)
+        rows = [row.split(",")[:4] for row in out.getvalue().split()[1:]]
+        self.assertEqual(rows, [["0", recs[0].pk, "10", recs[0].pk],
+                                ["1", recs[1].pk, "11", recs[1].pk]])
+
+    def test_parallel_copy_from_leveldb(self):
+        recs = _records()
+        src = polymr.storage.parse_url("leveldb://localhost"+self.workdir)
+        polymr.index.create(recs, 1, 10, src)
+        dst = polymr_redis.RedisBackend(db=2, new=True)
+        polymr.storage.copy(src, dst, readers=3, writers=3, batch_size=4)
+        self.assertEqual(dst.get_rowcount(), src.get_rowcount())
+        self.assertEqual(dict(dst.get_freqs()), dict(src.get_freqs()))
+        for tok in src.get_freqs():
+            self.assertEqual(list(dst.get_token(tok)),
+                             list(src.get_token(tok)))
+        hit = polymr.query.Index(dst).search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+        src.close()
+        dst.destroy()
+
+    def test_snapshot_from_leveldb(self):
+        recs = _records()
+        src = polymr.storage.parse_url("leveldb://localhost"+self.workdir)
+        polymr.index.create(recs, 1, 10, src)
+        snap = BytesIO()
+        polymr.snapshot.export(src, snap)
+        snap.seek(0)
+        dst = polymr_redis.RedisBackend(db=2, new=True)
+        polymr.snapshot.import_(dst, snap)
+        self.assertEqual(dst.get_rowcount(), src.get_rowcount())
+        self.assertEqual(dict(dst.get_freqs()), dict(src.get_freqs()))
+        hit = polymr.query.Index(dst).search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+        src.close()
+        dst.destroy()
+
 
 if __name__ == '__main__':
     unittest.main()
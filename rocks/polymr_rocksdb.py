@@ -1,7 +1,8 @@
 import os
+import contextlib
 from array import array
 from itertools import count as counter
-from collections import defaultdict
+from urllib.parse import parse_qsl
 
 import rocksdb
 import polymr.storage
@@ -10,6 +11,160 @@ from polymr.storage import dumps
 from polymr.storage import LevelDBBackend
 from toolz import partition_all
 
+DEFAULT_BLOCK_CACHE_SIZE = 512 << 20
+DEFAULT_BLOOM_BITS = 10
+# Postings are read on every query, so favor decompression speed there;
+# records are larger and fetched less often, so favor ratio.
+DEFAULT_COMPRESSION = {b"features": "lz4",
+                       b"records": "zstd",
+                       b"meta": "no"}
+
+
+class ColumnFamily(object):
+    """One column family of a ``rocksdb.DB``, with the same get/put/write
+    interface as a DB of its own.
+    """
+    def __init__(self, db, name):
+        self.db = db
+        self.handle = db.get_column_family(name)
+
+    def get(self, key):
+        return self.db.get((self.handle, key))
+
+    def put(self, key, value):
+        self.db.put((self.handle, key), value)
+
+    def delete(self, key):
+        self.db.delete((self.handle, key))
+
+    def multi_get(self, keys):
+        vals = self.db.multi_get([(self.handle, key) for key in keys])
+        return {key: vals[(self.handle, key)] for key in keys}
+
+    def iterkeys(self):
+        return self.db.iterkeys(self.handle)
+
+    def iteritems(self):
+        return self.db.iteritems(self.handle)
+
+    def new_batch(self):
+        return ColumnFamilyBatch(self.handle)
+
+    def write(self, batch, **kwargs):
+        self.db.write(batch.batch, **kwargs)
+
+    def compact_range(self):
+        self.db.compact_range(column_family=self.handle)
+
+
+class ColumnFamilyBatch(object):
+    def __init__(self, handle):
+        self.handle = handle
+        self.batch = rocksdb.WriteBatch()
+
+    def put(self, key, value):
+        self.batch.put((self.handle, key), value)
+
+    def delete(self, key):
+        self.batch.delete((self.handle, key))
+
+
+def _keys_with_prefix(db, prefix):
+    it = db.iterkeys()
+    it.seek(prefix)
+    for key in it:
+        if isinstance(key, tuple):
+            # column family iterators yield (handle, key)
+            key = key[1]
+        if not key.startswith(prefix):
+            break
+        yield key
+
+
+def _items_between(db, key_from, key_to):
+    it = db.iteritems()
+    it.seek(key_from)
+    for key, value in it:
+        if isinstance(key, tuple):
+            key = key[1]
+        if key > key_to:
+            break
+        yield key, value
+
+
+def bulk_options(opts):
+    """Configure ``opts`` for loading a large, mostly sorted stream of
+    keys: no automatic compactions or write stalls while loading, and
+    big vector memtables that flush straight to sequential L0 files.
+    ``RocksDBBackend.bulk_load`` compacts everything once at the end.
+    """
+    opts.disable_auto_compactions = True
+    opts.memtable_factory = rocksdb.VectorMemtableFactory()
+    opts.write_buffer_size = 256 << 20
+    opts.max_write_buffer_number = 4
+    opts.level0_file_num_compaction_trigger = 1 << 30
+    opts.level0_slowdown_writes_trigger = 1 << 30
+    opts.level0_stop_writes_trigger = 1 << 30
+    return opts
+
+
+def _compression_type(name):
+    if not name.endswith("_compression"):
+        name += "_compression"
+    return getattr(rocksdb.CompressionType, name)
+
+
+def tuned_options(create_if_missing=True, read_only=False,
+                  block_cache_size=DEFAULT_BLOCK_CACHE_SIZE,
+                  bloom_bits=DEFAULT_BLOOM_BITS, compression=None,
+                  bulk=False):
+    """Build the DB options and per column family options for the tuned
+    profile. All column families share a single block cache and use
+    bloom filters, since most lookups are point gets.
+
+    :returns: The DB options and a dict of column family options
+    :rtype: tuple of (rocksdb.Options, dict)
+    """
+    compression = dict(DEFAULT_COMPRESSION, **(compression or {}))
+    cache = rocksdb.LRUCache(block_cache_size)
+
+    def _table_factory():
+        return rocksdb.BlockBasedTableFactory(
+            filter_policy=rocksdb.BloomFilterPolicy(bloom_bits),
+            block_cache=cache,
+            whole_key_filtering=True)
+
+    opts = rocksdb.Options(
+        create_if_missing=create_if_missing,
+        max_open_files=-1,
+        allow_mmap_reads=read_only,
+        advise_random_on_open=True,
+        max_background_compactions=os.cpu_count() or 1,
+        table_factory=_table_factory())
+    cf_opts = {
+        name: rocksdb.ColumnFamilyOptions(
+            table_factory=_table_factory(),
+            compression=_compression_type(compression[name]),
+            write_buffer_size=64 << 20,
+            target_file_size_base=64 << 20)
+        for name in DEFAULT_COMPRESSION
+    }
+    if bulk is True:
+        for copts in cf_opts.values():
+            bulk_options(copts)
+    return opts, cf_opts
+
+
+def open_tuned_db(path, create_if_missing=True, read_only=False, **kwargs):
+    opts, cf_opts = tuned_options(create_if_missing, read_only, **kwargs)
+    if os.path.exists(os.path.join(path, "CURRENT")):
+        return rocksdb.DB(path, opts, column_families=cf_opts,
+                          read_only=read_only)
+    db = rocksdb.DB(path, opts)
+    for name, copts in cf_opts.items():
+        db.create_column_family(name, copts)
+    return db
+
 
 class RocksDBBackend(LevelDBBackend):
     def __init__(self, path=None,
@@ -19,9 +174,14 @@ class RocksDBBackend(LevelDBBackend):
                  record_db=None,
                  read_only=False,
                  rocksdb_options_records=None,
-                 rocksdb_options_features=None):
+                 rocksdb_options_features=None,
+                 bulk=False,
+                 record_block=None,
+                 sorted_keys=False):
 
         self._freqs = None
+        self.bulk = bulk
+        self.durable_writes = not bulk
         if feature_db is not None or record_db is not None:
             self.feature_db = feature_db
             self.record_db = record_db
@@ -36,10 +196,14 @@ class RocksDBBackend(LevelDBBackend):
             rocksdb_options_records = rocksdb.Options(
                 create_if_missing=create_if_missing
             )
+            if bulk is True:
+                bulk_options(rocksdb_options_records)
         if rocksdb_options_features is None:
             rocksdb_options_features = rocksdb.Options(
                 create_if_missing=create_if_missing
             )
+            if bulk is True:
+                bulk_options(rocksdb_options_features)
 
         self.feature_db = rocksdb.DB(
             os.path.join(path, "features"),
@@ -57,20 +221,50 @@ class RocksDBBackend(LevelDBBackend):
                 name = 'default'
             self.featurizer_name = name
         self._check_dbstats()
+        self._init_layout(record_block=record_block, sorted_keys=sorted_keys)
 
     @classmethod
     def from_urlparsed(cls, parsed, featurizer_name=None, read_only=False):
+        params = dict(parse_qsl(parsed.query))
+        read_only = read_only or params.get('read_only') == 'true'
+        if params.get('profile') == 'tuned':
+            return TunedRocksDBBackend.from_params(
+                parsed.path, params, featurizer_name, read_only)
         return cls(parsed.path, featurizer_name=featurizer_name,
-                   read_only=read_only)
+                   read_only=read_only, bulk=params.get('bulk') == 'true',
+                   record_block=int(params.get('record_block', 0)),
+                   sorted_keys=params.get('sorted_keys') == 'true')
+
+    @staticmethod
+    def _new_batch(db):
+        if isinstance(db, ColumnFamily):
+            return db.new_batch()
+        return rocksdb.WriteBatch()
+
+    def _write(self, db, batch):
+        # A failed bulk load is rebuilt from scratch, so skip the WAL.
+        # Without it, writes aren't durable until a flush; see
+        # durable_writes.
+        db.write(batch, disable_wal=self.bulk)
+
+    def _compact(self):
+        self.feature_db.compact_range()
+        self.record_db.compact_range()
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        yield
+        if self.bulk is True:
+            self._compact()
 
     def get_freqs(self):
         s = self.feature_db.get(b"Freqs")
         if s is None:
             raise KeyError
-        return defaultdict(int, loads(s))
+        return polymr.storage.load_freqs(s)
 
     def save_freqs(self, freqs_dict):
-        self.feature_db.put(b"Freqs", dumps(freqs_dict))
+        self.feature_db.put(b"Freqs", polymr.storage.dump_freqs(freqs_dict))
 
     def get_rowcount(self):
         blob = self.record_db.get(b"Rowcount")
@@ -93,49 +287,195 @@ class RocksDBBackend(LevelDBBackend):
     def save_tokens(self, names_ids, chunk_size=5000):
         chunks = partition_all(chunk_size, names_ids)
         for chunk in chunks:
-            batch = rocksdb.WriteBatch()
+            batch = self._new_batch(self.feature_db)
             for name, record_ids in chunk:
                 batch.put(name, array("L", record_ids).tobytes())
-            self.feature_db.write(batch)
+            self._write(self.feature_db, batch)
 
-    def _load_record_blob(self, idx):
-        blob = self.record_db.get(array("L", (idx,)).tobytes())
+    def _get_blob(self, key):
+        blob = self.record_db.get(key)
         if blob is None:
             raise KeyError
         return blob
 
-    def get_records(self, idxs, chunk_size=1000):
-        keys = iter(array("L", (idx,)).tobytes() for idx in idxs)
-        chunks = partition_all(chunk_size, keys)
-        for chunk in chunks:
-            chunk = list(chunk)
-            vals = self.record_db.multi_get(chunk)
-            for key in chunk:
-                blob = vals[key]
-                if blob is None:
-                    raise KeyError
-                yield self._get_record(blob)
+    def _get_blobs(self, keys):
+        return self.record_db.multi_get(keys)
+
+    def _write_records(self, keys_blobs):
+        batch = self._new_batch(self.record_db)
+        for key, blob in keys_blobs:
+            if blob is None:
+                batch.delete(key)
+            else:
+                batch.put(key, blob)
+        self._write(self.record_db, batch)
+
+    def _iter_record_items(self, key_from, key_to):
+        return _items_between(self.record_db, key_from, key_to)
+
+    def get_rownum(self, pk):
+        blob = self.record_db.get(self._pk_key(pk))
+        if blob is None:
+            raise KeyError
+        return array("L", blob)[0]
+
+    def get_rownums(self, pks):
+        keys = [self._pk_key(pk) for pk in pks]
+        vals = self.record_db.multi_get(keys)
+        return [None if vals[key] is None else array("L", vals[key])[0]
+                for key in keys]
+
+    def _delete_pk(self, pk, idx):
+        try:
+            if self.get_rownum(pk) == idx:
+                self.record_db.delete(self._pk_key(pk))
+        except KeyError:
+            pass
 
     def save_record(self, rec, idx=None, save_rowcount=True):
-        idx = self.get_rowcount() + 1 if idx is None else idx
-        self.record_db.put(array("L", (idx,)).tobytes(), dumps(rec))
+        idx = self.get_rowcount() if idx is None else idx
+        if self.record_block:
+            self._save_block_records([(idx, rec)])
+        else:
+            batch = self._new_batch(self.record_db)
+            batch.put(self._record_key(idx), dumps(rec))
+            if rec.pk:
+                batch.put(self._pk_key(rec.pk), array("L", (idx,)).tobytes())
+            self._write(self.record_db, batch)
         if save_rowcount is True:
-            self.save_rowcount(idx)
+            self.save_rowcount(idx + 1)
         return idx
 
     def save_records(self, idx_recs, record_db=None, chunk_size=5000):
+        if self.record_block:
+            return self._save_block_records(idx_recs, chunk_size)
         chunks = partition_all(chunk_size, idx_recs)
         cnt = counter()
         for chunk in chunks:
-            batch = rocksdb.WriteBatch()
+            batch = self._new_batch(self.record_db)
             for idx, rec in chunk:
-                batch.put(array("L", (idx,)).tobytes(), dumps(rec))
+                batch.put(self._record_key(idx), dumps(rec))
+                if rec.pk:
+                    batch.put(self._pk_key(rec.pk),
+                              array("L", (idx,)).tobytes())
                 next(cnt)
-            self.record_db.write(batch)
+            self._write(self.record_db, batch)
         return next(cnt)
 
+    def _load_deleted(self):
+        deleted = polymr.storage.Tombstones()
+        for key in _keys_with_prefix(self.record_db, b"del:"):
+            deleted.add(array("L", key[4:])[0])
+        return deleted
+
+    def _put_tombstone(self, idx):
+        self.record_db.put(b"del:" + array("L", (idx,)).tobytes(), b"")
+
     def delete_record(self, idx):
-        self.record_db.delete(array("L", (idx,)).tobytes())
+        self._unlink_pk(idx)
+        if self.record_block:
+            self._delete_block_record(idx)
+        else:
+            self.record_db.delete(self._record_key(idx))
+        self._tombstone(idx)
+
+
+class TunedRocksDBBackend(RocksDBBackend):
+    """A RocksDB layout for production use: features, records and
+    metadata live in column families of a single DB that share one
+    block cache. Select it with ``?profile=tuned`` on a ``rocksdb://``
+    URL; ``block_cache_mb``, ``bloom_bits``, ``compression_features``,
+    ``compression_records``, ``bulk``, ``record_block``, ``sorted_keys``
+    and ``read_only`` are also read from the query string. Opening read
+    only enables mmap reads.
+    """
+    def __init__(self, path=None,
+                 create_if_missing=True,
+                 featurizer_name=None,
+                 read_only=False,
+                 block_cache_size=DEFAULT_BLOCK_CACHE_SIZE,
+                 bloom_bits=DEFAULT_BLOOM_BITS,
+                 compression=None,
+                 bulk=False,
+                 record_block=None,
+                 sorted_keys=False):
+        self._freqs = None
+        self.bulk = bulk
+        self.durable_writes = not bulk
+        self.path = path
+        self.read_only = read_only
+        if create_if_missing and not os.path.exists(path):
+            os.mkdir(path)
+        self.db = open_tuned_db(
+            os.path.join(path, "db"), create_if_missing, read_only,
+            block_cache_size=block_cache_size, bloom_bits=bloom_bits,
+            compression=compression, bulk=bulk)
+        self.feature_db = ColumnFamily(self.db, b"features")
+        self.record_db = ColumnFamily(self.db, b"records")
+        self.meta_db = ColumnFamily(self.db, b"meta")
+        self.featurizer_name = featurizer_name
+        if not self.featurizer_name:
+            try:
+                name = self.get_featurizer_name()
+            except OSError:
+                name = 'default'
+            self.featurizer_name = name
+        if not read_only:
+            self._check_dbstats()
+        self._init_layout(record_block=record_block, sorted_keys=sorted_keys)
+
+    @classmethod
+    def from_params(cls, path, params, featurizer_name=None, read_only=False):
+        compression = {}
+        for name in DEFAULT_COMPRESSION:
+            key = "compression_" + name.decode()
+            if key in params:
+                compression[name] = params[key]
+        block_cache_mb = int(params.get('block_cache_mb',
+                                        DEFAULT_BLOCK_CACHE_SIZE >> 20))
+        bloom_bits = int(params.get('bloom_bits', DEFAULT_BLOOM_BITS))
+        return cls(path, featurizer_name=featurizer_name, read_only=read_only,
+                   block_cache_size=block_cache_mb << 20,
+                   bloom_bits=bloom_bits, compression=compression,
+                   bulk=params.get('bulk') == 'true',
+                   record_block=int(params.get('record_block', 0)),
+                   sorted_keys=params.get('sorted_keys') == 'true')
+
+    def _compact(self):
+        super()._compact()
+        self.meta_db.compact_range()
+
+    def close(self):
+        self.feature_db = self.record_db = self.meta_db = None
+        del self.db
+        self.db = None
+
+    def get_featurizer_name(self):
+        name = self.meta_db.get(b"Featurizer")
+        if name is None:
+            raise OSError
+        return name.decode()
+
+    def save_featurizer_name(self, name):
+        self.meta_db.put(b"Featurizer", name.encode())
+
+    def get_freqs(self):
+        s = self.meta_db.get(b"Freqs")
+        if s is None:
+            raise KeyError
+        return polymr.storage.load_freqs(s)
+
+    def save_freqs(self, freqs_dict):
+        self.meta_db.put(b"Freqs", polymr.storage.dump_freqs(freqs_dict))
+
+    def get_rowcount(self):
+        blob = self.meta_db.get(b"Rowcount")
+        if blob is None:
+            raise KeyError
+        return loads(blob)
+
+    def save_rowcount(self, cnt):
+        self.meta_db.put(b"Rowcount", dumps(cnt))
 
 
 polymr.storage.backends['rocksdb'] = RocksDBBackend
@@ -27,5 +27,37 @@ class TestRocksDBBackend(TestLevelDBBackend):
             "rocksdb://localhost"+self.workdir)
         return self.db
 
+class TestTunedRocksDBBackend(TestLevelDBBackend):
+
+    def _url(self, **params):
+        query = "&".join("{}={}".format(k, v) for k, v in params.items())
+        return ("rocksdb://localhost{}?profile=tuned&block_cache_mb=8&{}"
+                .format(self.workdir, query))
+
+    def _get_db(self, new=False):
+        if self.db and not new:
+            return self.db
+        if self.db:
+            self.db.close()
+        self.db = polymr.storage.parse_url(self._url())
+        return self.db
+
+    def test_tuned_profile(self):
+        db = self._get_db()
+        self.assertIsInstance(db, polymr_rocksdb.TunedRocksDBBackend)
+        self.assertEqual(os.listdir(self.workdir), ["db"])
+
+    def test_read_only(self):
+        db = self._get_db()
+        db.save_token(b"abc", [1, 2, 3])
+        db.save_records(enumerate([Record(["abcde"], "1", [])]))
+        db.save_rowcount(1)
+        db.close()
+        self.db = polymr.storage.parse_url(self._url(read_only="true"))
+        self.assertEqual([1, 2, 3], list(self.db.get_token(b"abc")))
+        self.assertEqual(self.db.get_record(0).pk, "1")
+        self.assertEqual(self.db.get_rowcount(), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -61,7 +61,36 @@ class TestEndToEndWithRocksDB(unittest.TestCase):
         tpyo = "".join(tpyo)
         hit = index.search([tpyo]+sample_query[1:], limit=1)[0]
         self.assertEqual(hit['pk'], sample_pk,"searches should survive typos")
-        
+
+
+class TestEndToEndWithRocksDBBulk(TestEndToEndWithRocksDB):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(suffix="polymrtest")
+        self.db = polymr.storage.parse_url(
+            "rocksdb://localhost"+self.workdir+"?bulk=true")
+
+
+class TestEndToEndWithTunedRocksDBBulk(TestEndToEndWithRocksDB):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(suffix="polymrtest")
+        self.db = polymr.storage.parse_url(
+            "rocksdb://localhost"+self.workdir+"?profile=tuned&bulk=true")
+
+
+class TestEndToEndWithTunedRocksDBRecordBlocks(TestEndToEndWithRocksDB):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(suffix="polymrtest")
+        self.db = polymr.storage.parse_url(
+            "rocksdb://localhost"+self.workdir
+            + "?profile=tuned&record_block=64")
+
+
+class TestEndToEndWithRocksDBSortedKeys(TestEndToEndWithRocksDB):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(suffix="polymrtest")
+        self.db = polymr.storage.parse_url(
+            "rocksdb://localhost"+self.workdir+"?sorted_keys=true")
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -12,6 +12,7 @@ setup(
     description=("Index and search database tables"),
     packages=['polymr'],
     install_requires=requires,
+    extras_require={"numpy": ["numpy"]},
     classifiers=[
         "Development Status :: 2 - Pre-Alpha"
     ],
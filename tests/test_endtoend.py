@@ -1,14 +1,26 @@
 import os
+import csv
+import json
+import asyncio
 import shutil
 import tempfile
 import unittest
+from unittest import mock
+from io import BytesIO
 from io import StringIO
 
 import polymr.index
+import polymr.compact
+import polymr.dedup
+import polymr.link
+import polymr.serve
+import polymr.snapshot
 import polymr.storage
 import polymr.query
 import polymr.record
 import polymr.score
+import polymr.featurizers
+import polymr.util
 
 to_index = StringIO("""01001,MA,DONNA,AGAWAM,WUCHERT,PO BOX 329,9799PNOVAY
 01007,MA,BERONE,BELCHERTOWN,BOARDWAY,135 FEDERAL ST,9799JA8CB5
@@ -33,6 +45,21 @@ def custom_score(features_a, features_b):
     return polymr.score.hit(features_a, features_b) / 2
 
 
+def _records(include_data=False):
+    return list(polymr.record.from_csv(
+        to_index,
+        searched_fields_idxs=[0,2,4,5],
+        pk_field_idx=-1,
+        include_data=include_data
+    ))
+
+
+def _index_records(db, include_data=False):
+    recs = _records(include_data)
+    polymr.index.create(recs, 1, 10, db)
+    return recs
+
+
 class TestEndToEnd(unittest.TestCase):
     def setUp(self):
         self.workdir = tempfile.mkdtemp(suffix="polymrtest")
@@ -77,6 +104,411 @@ class TestEndToEnd(unittest.TestCase):
                            extract_func=custom_extract)[0]
         self.assertEqual(hit['pk'], sample_pk)
 
+    def test_partitioned_build(self):
+        polymr.index.create(_records(), 3, 3, self.db, record_writers=2)
+        self.assertEqual(self.db.get_rowcount(), 10)
+        index = polymr.query.Index(self.db)
+        freqs = self.db.get_freqs()
+        for tok, freq in freqs.items():
+            self.assertEqual(len(self.db.get_token(tok)), freq)
+        hit = index.search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+
+    @mock.patch.object(polymr.index, "RECORD_BATCH_SIZE", 2)
+    def test_resume(self):
+        recs = _records()
+        manifest = os.path.join(self.workdir, "build.manifest")
+
+        def interrupted():
+            yield from recs
+            raise IOError("preempted")
+
+        with self.assertRaises(IOError):
+            polymr.index.create(interrupted(), 1, 3, self.db,
+                                tmpdir=self.workdir, manifest=manifest)
+        with open(manifest) as f:
+            state = json.load(f)
+        self.assertFalse(state["done"])
+        self.assertIn("0", state["chunks"])
+        self.assertIn(0, state["record_batches"])
+        self.assertRaises(ValueError, polymr.index.create, iter(recs), 1,
+                          2, self.db, tmpdir=self.workdir,
+                          manifest=manifest, resume=True)
+        with mock.patch.object(self.db, "durable_writes", False):
+            self.assertRaises(ValueError, polymr.index.create, iter(recs),
+                              1, 3, self.db, tmpdir=self.workdir,
+                              manifest=manifest, resume=True)
+        polymr.index.create(iter(recs), 1, 3, self.db, tmpdir=self.workdir,
+                            manifest=manifest, resume=True)
+        self.assertEqual(self.db.get_rowcount(), 10)
+        dfs = {}
+        for rec in recs:
+            for tok in polymr.featurizers.all['default'](rec.fields):
+                dfs[tok] = dfs.get(tok, 0) + 1
+        self.assertEqual(dict(self.db.get_freqs()), dfs)
+        sizes = self.db.get_sizes()
+        for idx, rec in enumerate(recs):
+            toks = set(polymr.featurizers.all['default'](rec.fields))
+            self.assertEqual(sizes.tokens(idx), len(toks))
+            self.assertEqual(list(sizes.attrs(idx)),
+                             polymr.score.sizes(rec.fields))
+        index = polymr.query.Index(self.db)
+        hit = index.search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+        leftovers = [f for f in os.listdir(self.workdir)
+                     if f.endswith(".run")]
+        self.assertEqual(leftovers, [])
+
+    def test_get_by_pk_and_upsert(self):
+        _index_records(self.db)
+        index = polymr.query.Index(self.db)
+        hit = index.get_by_pk(sample_pk)
+        self.assertEqual(list(hit['fields']), sample_query)
+        self.assertRaises(KeyError, index.get_by_pk, "nope")
+
+        moved = polymr.record.Record(
+            ("01030", "MELANI", "PICKETT", "77 MASSACHUSETTS AVE"),
+            sample_pk, ())
+        new = polymr.record.Record(
+            ("02139", "JOHN", "HARVARD", "1 OXFORD ST"), "NEWPK", ())
+        idxs = index.upsert([moved, new])
+        self.assertEqual(idxs, [hit['rownum'], 10])
+        self.assertEqual(self.db.get_rowcount(), 11)
+        self.assertEqual(index.get_by_pk(sample_pk)['fields'][-1],
+                         "77 MASSACHUSETTS AVE")
+        self.assertEqual(index.get_by_pk("NEWPK")['rownum'], 10)
+        for tok, freq in self.db.get_freqs().items():
+            self.assertEqual(len(self.db.get_token(tok)), freq)
+        old_toks = set(polymr.featurizers.all['default'](sample_query))
+        new_toks = set(polymr.featurizers.all['default'](moved.fields))
+        for tok in old_toks - new_toks:
+            self.assertNotIn(hit['rownum'], self.db.get_token(tok))
+        for tok in new_toks:
+            self.assertIn(hit['rownum'], self.db.get_token(tok))
+        hit = index.search(list(new.fields), limit=1)[0]
+        self.assertEqual(hit['pk'], "NEWPK")
+
+        anon = [polymr.record.Record(("02139", name, "DOE", "1 MAIN ST"),
+                                     "", ()) for name in ("JANE", "JOHN")]
+        self.assertEqual(index.upsert(anon + [new]), [10, 11, 12])
+        self.assertEqual(self.db.get_rowcount(), 13)
+
+    def test_delete_and_compact(self):
+        recs = _index_records(self.db)
+        index = polymr.query.Index(self.db)
+        hit = index.search(sample_query, limit=1)[0]
+        self.db.delete_record(0)
+        self.db.delete_record(hit['rownum'])
+        hits = index.search(sample_query, limit=10)
+        self.assertNotIn(sample_pk, [h['pk'] for h in hits])
+
+        compacted = polymr.storage.parse_url(
+            "leveldb://localhost"+os.path.join(self.workdir, "compacted"))
+        polymr.compact.compact(self.db, compacted)
+        self.assertEqual(compacted.get_rowcount(), 8)
+        self.assertEqual(list(compacted.get_deleted()), [])
+        live = [r for i, r in enumerate(recs) if i not in (0, hit['rownum'])]
+        self.assertEqual([r.pk for r in compacted.get_records(range(8))],
+                         [r.pk for r in live])
+        freqs = compacted.get_freqs()
+        for tok, freq in freqs.items():
+            ids = compacted.get_token(tok)
+            self.assertEqual(len(ids), freq)
+            self.assertLess(max(ids), 8)
+        self.assertNotIn(sample_pk, [
+            h['pk'] for h in
+            polymr.query.Index(compacted).search(sample_query, limit=10)])
+        for i, rec in enumerate(live):
+            self.assertEqual(compacted.get_rownum(rec.pk), i)
+            hit = polymr.query.Index(compacted).search(
+                list(rec.fields), limit=1)[0]
+            self.assertEqual(hit['pk'], rec.pk)
+        compacted.close()
+
+    def test_copy_to_sorted_keys(self):
+        recs = _index_records(self.db)
+        self.db.delete_record(3)
+        copied = polymr.storage.parse_url(
+            "leveldb://localhost"+os.path.join(self.workdir, "copied")
+            + "?sorted_keys=true")
+        polymr.storage.copy(self.db, copied)
+        self.assertTrue(copied.sorted_keys)
+        self.assertEqual(list(copied.get_deleted()), [3])
+        self.assertEqual(
+            [(idx, rec.pk) for idx, rec in copied.scan_records()],
+            [(idx, rec.pk) for idx, rec in enumerate(recs) if idx != 3])
+        hits = polymr.query.Index(copied).search(sample_query, limit=3)
+        self.assertEqual(hits[0]['pk'], sample_pk)
+        self.assertEqual(
+            hits, polymr.query.Index(self.db).search(sample_query, limit=3))
+        copied.close()
+
+    def _assert_same_index(self, a, b):
+        self.assertEqual(a.get_rowcount(), b.get_rowcount())
+        self.assertEqual(
+            [(idx, rec.pk) for idx, rec in a.scan_records()],
+            [(idx, rec.pk) for idx, rec in b.scan_records()])
+        self.assertEqual(dict(a.get_freqs()), dict(b.get_freqs()))
+        for tok in a.get_freqs():
+            self.assertEqual(list(a.get_token(tok)), list(b.get_token(tok)))
+
+    def test_parallel_copy(self):
+        _index_records(self.db)
+        copied = polymr.storage.parse_url(
+            "leveldb://localhost"+os.path.join(self.workdir, "copied"))
+        polymr.storage.copy(self.db, copied, readers=3, writers=2,
+                            batch_size=3)
+        self._assert_same_index(self.db, copied)
+        copied.close()
+
+    def test_copy_resume(self):
+        _index_records(self.db)
+        from_url = "leveldb://localhost"+self.workdir
+        to_url = "leveldb://localhost"+os.path.join(self.workdir, "copied")
+        copied = polymr.storage.parse_url(to_url)
+        manifest = os.path.join(self.workdir, "copy.json")
+        urls = {"backend_from_url": from_url, "backend_to_url": to_url}
+        n_batches = -(-len(self.db.get_freqs()) // 20)
+        calls = []
+        save_tokens = copied.save_tokens
+
+        def _flaky(names_ids):
+            calls.append(names_ids)
+            if len(calls) == 2:
+                raise IOError("disk full")
+            return save_tokens(names_ids)
+
+        with mock.patch.object(copied, "save_tokens", _flaky):
+            with self.assertRaises(IOError):
+                polymr.storage.copy(self.db, copied, batch_size=20,
+                                    manifest=manifest, **urls)
+        with open(manifest) as f:
+            state = json.load(f)
+        self.assertEqual(len(state["record_batches"]), 1)
+        self.assertEqual(state["token_batches"], [0])
+        self.assertRaises(ValueError, polymr.storage.copy, self.db, copied,
+                          batch_size=20, manifest=manifest, resume=True)
+        self.assertRaises(ValueError, polymr.storage.copy, self.db, copied,
+                          batch_size=20, manifest=manifest, resume=True,
+                          backend_from_url=from_url,
+                          backend_to_url=to_url+"?sorted_keys=true")
+        with mock.patch.object(copied, "durable_writes", False):
+            self.assertRaises(ValueError, polymr.storage.copy, self.db,
+                              copied, batch_size=20, manifest=manifest,
+                              resume=True, **urls)
+        with mock.patch.object(copied, "save_tokens",
+                               side_effect=save_tokens) as resumed:
+            polymr.storage.copy(self.db, copied, batch_size=20,
+                                manifest=manifest, resume=True, **urls)
+        self.assertEqual(resumed.call_count, n_batches - 1)
+        self._assert_same_index(self.db, copied)
+        copied.close()
+
+    def test_snapshot(self):
+        _index_records(self.db)
+        self.db.delete_record(2)
+        snap = BytesIO()
+        polymr.snapshot.export(self.db, snap, batch_size=4)
+        snap.seek(0)
+        restored = polymr.storage.parse_url(
+            "leveldb://localhost"+os.path.join(self.workdir, "restored")
+            + "?sorted_keys=true")
+        polymr.snapshot.import_(restored, snap)
+        self._assert_same_index(self.db, restored)
+        self.assertEqual(list(restored.get_deleted()), [2])
+        self.assertEqual(restored.get_featurizer_name(),
+                         self.db.get_featurizer_name())
+        hit = polymr.query.Index(restored).search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+        restored.close()
+
+        blob = snap.getvalue()
+        corrupt = bytearray(blob)
+        corrupt[len(blob) // 2] ^= 0xff
+        for bad in (blob[:-3], bytes(corrupt), b"not a snapshot"):
+            dst = polymr.storage.parse_url(
+                "leveldb://localhost"+os.path.join(self.workdir, "bad"))
+            with self.assertRaises(ValueError):
+                polymr.snapshot.import_(dst, BytesIO(bad))
+            dst.close()
+
+    def test_hashed_tokens(self):
+        recs = _records()
+        polymr.index.create(recs, 2, 4, self.db,
+                            featurizer_name="default:h16")
+        freqs = self.db.get_freqs()
+        self.assertIsInstance(freqs, polymr.storage.FlatFreqs)
+        for tok, freq in freqs.items():
+            self.assertEqual(len(tok), 4)
+            self.assertEqual(len(self.db.get_token(tok)), freq)
+        index = polymr.query.Index(self.db)
+        hit = index.search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+
+    def test_size_bounds(self):
+        recs = _index_records(self.db)
+        index = polymr.query.Index(self.db)
+        self.assertEqual(list(index.sizes.attrs(6)),
+                         polymr.score.sizes(recs[6].fields))
+        self.assertEqual(index.sizes.tokens(6), len(polymr.featurizers.get(
+            "default")(recs[6].fields)))
+        unbounded = polymr.query.Index(self.db)
+        unbounded.sizes = None
+        queries = [rec.fields for rec in recs]
+        queries.append(["01030", "MELANIE", "PICKET", "18 PAUL REVERE"])
+        for query in queries:
+            for limit in (1, 3):
+                self.assertEqual(index.search(query, limit=limit),
+                                 unbounded.search(query, limit=limit))
+        for a in recs:
+            for b in recs:
+                self.assertLessEqual(
+                    polymr.score.hit_bound(polymr.score.sizes(a.fields),
+                                           polymr.score.sizes(b.fields)),
+                    polymr.score.hit(polymr.score.features(a.fields),
+                                     polymr.score.features(b.fields)))
+        with mock.patch.object(polymr.query, "BOUND_BATCH_SIZE", 1), \
+                mock.patch.object(self.db, "get_records",
+                                  wraps=self.db.get_records) as fetch:
+            hit = index.search(sample_query, limit=1)[0]
+        self.assertEqual(hit['pk'], sample_pk)
+        self.assertLess(fetch.call_count, 10)
+
+        new = polymr.record.Record(["01030", "MELANI", "PICKETT", "18"],
+                                   "NEWPK", [])
+        [idx] = index.add([new])
+        self.assertEqual(list(polymr.query.Index(self.db).sizes.attrs(idx)),
+                         polymr.score.sizes(new.fields))
+        compacted = polymr.storage.parse_url(
+            "leveldb://localhost"+os.path.join(self.workdir, "compacted"))
+        self.db.delete_record(0)
+        polymr.compact.compact(self.db, compacted)
+        self.assertEqual(list(compacted.get_sizes().attrs(idx - 1)),
+                         polymr.score.sizes(new.fields))
+        compacted.close()
+
+    def test_search_threshold(self):
+        recs = _index_records(self.db)
+        self.db.delete_record(3)
+        featurize = polymr.featurizers.all['default']
+        queries = [rec.fields for rec in recs]
+        queries.append(["01030", "MELANIE", "PICKET", "18 PAUL REVERE"])
+        queries.append(["01030", "MELANIE", "PICKETT", "9 PAUL REVERE DR"])
+        index = polymr.query.Index(self.db)
+        unsized = polymr.query.Index(self.db)
+        unsized.sizes = None
+        for query in queries:
+            q = featurize(query)
+            distances = {}
+            for idx, rec in enumerate(recs):
+                r = featurize(rec.fields)
+                if idx != 3:
+                    distances[idx] = 1 - len(q & r) / len(q | r)
+            for max_distance in (0, 0.2, 0.5, 0.8):
+                expected = sorted((d, idx) for idx, d in distances.items()
+                                  if d <= max_distance)
+                for searcher in (index, unsized):
+                    got = searcher.search_threshold(query, max_distance)
+                    self.assertEqual(
+                        [(h['rownum'], h['pk']) for h in got],
+                        [(idx, recs[idx].pk) for _, idx in expected])
+                    for h, (d, _) in zip(got, expected):
+                        self.assertAlmostEqual(h['score'], d)
+        with mock.patch.object(self.db, "get_tokens",
+                               wraps=self.db.get_tokens) as get_tokens:
+            got = index.search_threshold(sample_query, 0.2)
+        self.assertEqual([h['pk'] for h in got], [sample_pk])
+        [(names,), _] = get_tokens.call_args
+        self.assertLess(len(names), len(featurize(sample_query)) / 4)
+        self.assertRaises(ValueError, index.search_threshold, queries[0], 1)
+
+    def test_searchbatch(self):
+        recs = _index_records(self.db)
+        self.db.delete_record(3)
+        index = polymr.query.Index(self.db)
+        queries = [rec.fields for rec in recs] + [sample_query, []]
+        with mock.patch.object(self.db, "get_tokens",
+                               wraps=self.db.get_tokens) as get_tokens:
+            results = index.searchbatch(queries, limit=3)
+        self.assertEqual(get_tokens.call_count, 1)
+        self.assertEqual(results,
+                         [index.search(q, limit=3) for q in queries])
+        self.assertNotIn(recs[3].pk, [hit['pk'] for hit in results[3]])
+        self.assertEqual(results[-1], [])
+
+    def _brute_force_pairs(self, recs, others=None):
+        featurize = polymr.featurizers.all['default']
+        pairs = []
+        for i, a in enumerate(recs):
+            for j, b in enumerate(recs if others is None else others):
+                if others is None and j <= i:
+                    continue
+                d = polymr.util.jaccard(featurize(a.fields),
+                                        featurize(b.fields))
+                if d <= 0.5:
+                    pairs.append((i, j, round(d, 6)))
+        return pairs
+
+    def _read_pairs(self, f):
+        rows = list(csv.reader(StringIO(f.getvalue())))
+        self.assertEqual(rows[0], polymr.dedup.FIELDS)
+        return [(int(a), int(b), round(float(d), 6))
+                for a, _, b, _, d in rows[1:]]
+
+    def test_dedup(self):
+        recs = _records()
+        dupes = [polymr.record.Record(
+                     list(rec.fields[:3]) + [rec.fields[3][1:]],
+                     rec.pk + "X", [])
+                 for rec in recs[::3]]
+        polymr.index.create(recs + dupes, 1, 10, self.db)
+        url = "leveldb://localhost" + self.workdir
+        self.db.close()
+        out = StringIO()
+        n = polymr.dedup.dedup(url, out, 0.5, processes=2, chunk_size=4)
+        expected = self._brute_force_pairs(recs + dupes)
+        self.assertEqual(self._read_pairs(out), expected)
+        self.assertEqual(n, len(expected))
+        self.assertGreater(n, len(dupes) - 1)
+
+        other_dir = os.path.join(self.workdir, "other")
+        other = polymr.storage.parse_url("leveldb://localhost" + other_dir)
+        polymr.index.create(dupes, 1, 10, other)
+        other.close()
+        out = StringIO()
+        polymr.dedup.dedup(url, out, 0.5,
+                           other_url="leveldb://localhost" + other_dir)
+        self.assertEqual(self._read_pairs(out),
+                         self._brute_force_pairs(recs + dupes, dupes))
+        self.db = polymr.storage.parse_url(url)
+
+    def test_max_df(self):
+        recs = _records()
+        dfs = {}
+        for rec in recs:
+            for tok in polymr.featurizers.all['default'](rec.fields):
+                dfs[tok] = dfs.get(tok, 0) + 1
+        expected = {tok: df for tok, df in dfs.items() if df <= 2}
+        self.assertLess(len(expected), len(dfs))
+        # workers prune early when the input has a length; an iterator
+        # is only pruned at the final merge
+        for max_df, inp in [(2, recs), (0.25, recs), (0.25, iter(recs))]:
+            self.tearDown()
+            self.setUp()
+            polymr.index.create(inp, 2, 3, self.db, max_df=max_df)
+            self.assertEqual(dict(self.db.get_freqs()), expected)
+            for tok in dfs:
+                if tok not in expected:
+                    self.assertRaises(KeyError, self.db.get_token, tok)
+
+
+class TestEndToEndRecordBlocks(TestEndToEnd):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(suffix="polymrtest")
+        self.db = polymr.storage.parse_url(
+            "leveldb://localhost"+self.workdir+"?record_block=4")
+        to_index.seek(0)
+
 
 class TestEndToEndParallel(unittest.TestCase):
     def setUp(self):
@@ -149,6 +581,139 @@ class TestEndToEndParallel(unittest.TestCase):
             self.assertEqual(hit['pk'], sample_pk)
             self.assertEqual(hit['score'] * 2, extract_scores[i])
 
+    def test_link(self):
+        db = polymr.storage.parse_url(self.url)
+        recs = _index_records(db, include_data=True)
+        db.close()
+        index = polymr.query.ParallelIndex(self.url, 2)
+        # more queries than the workers are given at once
+        queries = recs * 3
+        out = StringIO()
+        n, n_failed = polymr.link.link(index, iter(queries), out, limit=2)
+        self.assertEqual((n, n_failed), (len(queries), 0))
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([line['pk'] for line in lines],
+                         [rec.pk for rec in queries])
+        for line in lines:
+            self.assertEqual(len(line['results']), 2)
+            self.assertEqual(line['results'][0]['pk'], line['pk'])
+            self.assertEqual(line['results'][0]['data'][0], 'MA')
+        index.backend.close()
+
+        index = polymr.query.ParallelIndex(self.url, 2)
+        out = StringIO()
+        polymr.link.link(index, recs, out, fmt="csv", limit=1)
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(rows[0], polymr.link.FIELDS)
+        self.assertEqual([(q, rank, pk) for q, rank, pk, _, _ in rows[1:]],
+                         [(rec.pk, "1", rec.pk) for rec in recs])
+        index.backend.close()
+
+    def test_searchmany_first_query_last(self):
+        db = polymr.storage.parse_url(self.url)
+        _index_records(db)
+        db.close()
+        index = polymr.query.ParallelIndex(self.url, 2)
+        index.workers = [None] * 2
+        # as many queries as the workers are given at once, the first
+        # of them finishing last
+        n_queries = len(index.workers) * 3
+        results = [(i, 'score_records', []) for i in range(1, n_queries)]
+        results.append((0, 'score_records', []))
+
+        def get():
+            if not results:
+                self.fail("waited for a result with no query in progress")
+            return results.pop(0)
+
+        index.result_q = mock.Mock(get=get)
+        with mock.patch.object(index, "_search"), \
+                mock.patch.object(index, "_scored_records"):
+            found = list(index._searchmany(
+                [sample_query] * n_queries, 1, polymr.query.defaults.r,
+                polymr.query.defaults.n, polymr.query.defaults.k,
+                polymr.score.features, polymr.score.hit))
+        self.assertEqual(found, [[]] * n_queries)
+        index.backend.close()
+
+class TestServe(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(suffix="polymrtest")
+        to_index.seek(0)
+        self.db = polymr.storage.parse_url(
+            "leveldb://localhost"+self.workdir)
+        recs = _index_records(self.db, include_data=True)
+        self.index = polymr.query.Index(self.db)
+        self.queries = [rec.fields for rec in recs]
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.db.close()
+        if os.path.exists(self.workdir):
+            shutil.rmtree(self.workdir)
+        to_index.seek(0)
+
+    def test_batches_concurrent_searches(self):
+        expected = [self.index.search(q, limit=2) for q in self.queries]
+        batcher = polymr.serve.Batcher(self.index, window=0.05)
+        results = self.loop.run_until_complete(asyncio.gather(
+            *(batcher.search(q, limit=2) for q in self.queries)))
+        self.assertEqual(results, expected)
+        self.assertEqual(batcher.stats()['batches'], 1)
+
+        # searches queue up behind a running batch
+        batcher = polymr.serve.Batcher(self.index, max_batch=4)
+        results = self.loop.run_until_complete(asyncio.gather(
+            *(batcher.search(q, limit=2) for q in self.queries)))
+        self.assertEqual(results, expected)
+        self.assertEqual(batcher.stats(),
+                         {'queries': len(self.queries), 'batches': 3,
+                          'rowcount': len(self.queries)})
+
+    def test_server(self):
+        expected = [json.loads(json.dumps(self.index.search(q, limit=2),
+                                      default=polymr.util.json_default))
+                    for q in self.queries]
+        address = os.path.join(self.workdir, "polymr.sock")
+
+        def _search(query):
+            client = polymr.serve.Client(address)
+            try:
+                return client.search(query, limit=2)
+            finally:
+                client.close()
+
+        def in_thread(func, *args):
+            return self.loop.run_in_executor(None, func, *args)
+
+        server = self.loop.run_until_complete(
+            polymr.serve.start(self.index, address))
+        client = polymr.serve.Client(address)
+        try:
+            results = self.loop.run_until_complete(asyncio.gather(
+                *(in_thread(_search, q) for q in self.queries)))
+            self.assertEqual(results, expected)
+
+            hits = self.loop.run_until_complete(
+                in_thread(client.search_threshold, sample_query, 0.5))
+            self.assertEqual(hits[0]['pk'], sample_pk)
+            with self.assertRaises(ValueError):
+                self.loop.run_until_complete(
+                    in_thread(client.search_threshold, sample_query, 1))
+            with self.assertRaises(ValueError):
+                self.loop.run_until_complete(
+                    in_thread(client.search, [1, 2]))
+            stats = self.loop.run_until_complete(in_thread(client.stats))
+        finally:
+            client.close()
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        self.assertEqual(stats['queries'], len(self.queries))
+        self.assertLessEqual(stats['batches'], len(self.queries))
+
 
 if __name__ == '__main__':
     unittest.main()
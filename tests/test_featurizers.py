@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+from unittest import skipIf
+from collections import defaultdict
+
+from polymr import featurizers
+
+records = [
+    ["01030", "MELANI", "PICKETT", "18 PAUL REVERE DR"],
+    ["01030", "", "AB", "été à PARIS"],
+    ["X", "MELANIE", "PICKET", "18 PAUL REVERE DR"],
+]
+
+
+def _by_record(name, idxs_fields):
+    ret = defaultdict(list)
+    for i, fields in idxs_fields:
+        for tok in featurizers.get(name)(fields):
+            ret[tok].append(i)
+    return dict(ret)
+
+
+@skipIf(featurizers.np is None, "numpy is not installed")
+class TestPackedFeaturizers(unittest.TestCase):
+
+    def test_tokmap_matches_featurizers(self):
+        idxs_fields = list(zip([3, 7, 8], records))
+        for name in featurizers.packable:
+            self.assertEqual(dict(featurizers.tokmap(name, idxs_fields)),
+                             _by_record(name, idxs_fields), name)
+
+    def test_short_tokens_are_distinct(self):
+        blobs = [b"\x00a", b"a", b"", b"\x00\x00a"]
+        owners = featurizers.np.arange(4)
+        toks, ids = featurizers.pack_ngrams(blobs, owners, 3)
+        self.assertEqual(len(set(toks.tolist())), 4)
+        self.assertEqual(sorted(featurizers.unpack_token(t, 3)
+                                for t in toks),
+                         sorted(blobs))
+
+    def test_repeated_values(self):
+        idxs_fields = list(enumerate(records * 5 + [["X", "X", "X"]]))
+        for name in ("default", "k2"):
+            self.assertEqual(dict(featurizers.tokmap(name, idxs_fields)),
+                             _by_record(name, idxs_fields), name)
+
+    def test_empty_batch(self):
+        self.assertEqual(dict(featurizers.tokmap("default", [])), {})
+
+    def test_falls_back_without_numpy(self):
+        idxs_fields = list(enumerate(records))
+        with mock.patch.object(featurizers, "np", None):
+            got = featurizers.tokmap("default", idxs_fields)
+        self.assertEqual(dict(got), _by_record("default", idxs_fields))
+
+
+class TestFeaturizeMany(unittest.TestCase):
+
+    def test_matches_featurizers(self):
+        for name in list(featurizers.all) + ["k3:h12"]:
+            self.assertEqual(featurizers.featurize_many(name, records),
+                             [featurizers.get(name)(rec) for rec in records],
+                             name)
+        self.assertEqual(featurizers.featurize_many("k3", [[]]),
+                         [frozenset()])
+
+    def test_memoizes_values(self):
+        features_of = featurizers.attr_features("compress_k4")
+        features_of.cache_clear()
+        featurizers.featurize_many("compress_k4", records)
+        info = features_of.cache_info()
+        self.assertEqual(info.misses, 10)
+        self.assertEqual(info.hits, 2)
+
+
+class TestHashedFeaturizers(unittest.TestCase):
+
+    def test_parse_name(self):
+        self.assertEqual(featurizers.parse_name("k3"), ("k3", None))
+        self.assertEqual(featurizers.parse_name("k3:h20"), ("k3", 20))
+        for bad in ("k9", "k3:h", "k3:20", "k3:h4", "k3:h64", "k9:h20"):
+            self.assertRaises(KeyError, featurizers.parse_name, bad)
+
+    def test_token_ids(self):
+        toks = featurizers.get("k3:h10")(records[0])
+        self.assertEqual(
+            toks, {featurizers.token_id(tok, 10)
+                   for tok in featurizers.all["k3"](records[0])})
+        for tok in toks:
+            self.assertEqual(len(tok), 4)
+            self.assertLess(int.from_bytes(tok, "big"), 1 << 10)
+
+    def test_tokmap_merges_collisions(self):
+        idxs_fields = list(zip([3, 7, 8], records))
+        # 8 bits is few enough that some tokens collide
+        got = featurizers.tokmap("k2:h8", idxs_fields)
+        self.assertLess(len(got),
+                        len(featurizers.tokmap("k2", idxs_fields)))
+        self.assertEqual(dict(got), _by_record("k2:h8", idxs_fields))
+
+
+if __name__ == '__main__':
+    unittest.main()
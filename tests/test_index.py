@@ -0,0 +1,162 @@
+import os
+import random
+import string
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from collections import Counter
+
+import polymr.index
+import polymr.featurizers
+
+
+class TestRunFiles(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(suffix="polymrtest")
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def _write(self, kmer_ids, codec):
+        fname = polymr.index._tmpname()
+        with polymr.index._open_run(fname, 'wb', codec) as f:
+            for kmer, ids in kmer_ids:
+                polymr.index._write_run_entry(f, kmer, ids)
+        return fname
+
+    def _read(self, fname, codec):
+        with polymr.index._open_run(fname, 'rb', codec) as f:
+            return [(kmer, list(ids))
+                    for kmer, ids in polymr.index._read_run(f)]
+
+    def test_roundtrip(self):
+        kmer_ids = [(b"ab", [1, 2, 3]), (b"b|c\n", [7]),
+                    (b"zz", [5, 1 << 40])]
+        for codec in polymr.index.run_codecs:
+            fname = self._write(kmer_ids, codec)
+            self.assertEqual(self._read(fname, codec), kmer_ids)
+
+    def test_merge_tmpfiles(self):
+        a = self._write([(b"ab", [1, 3]), (b"cd", [1])], "none")
+        b = self._write([(b"ab", [2]), (b"ef", [2])], "none")
+        merged, freqs = polymr.index._merge_tmpfiles([a, b])
+        self.assertEqual(freqs, {b"ab": 3, b"cd": 1, b"ef": 1})
+        self.assertEqual(self._read(merged, "none"),
+                         [(b"ab", [1, 2, 3]), (b"cd", [1]), (b"ef", [2])])
+        self.assertFalse(os.path.exists(a) or os.path.exists(b))
+
+    @mock.patch.object(polymr.index, "MERGE_FANIN", 2)
+    def test_merge_partition(self):
+        runs = [self._write([(b"ab", [1, 3]), (b"cd", [1])], "none"),
+                self._write([(b"ab", [2]), (b"ef", [2])], "none"),
+                self._write([(b"cd", [4]), (b"ef", [5])], "none")]
+        part, merged, freqs, n_toobig = polymr.index._merge_partition(
+            (3, runs, {b"cd"}))
+        self.assertEqual((part, n_toobig), (3, 1))
+        self.assertEqual(freqs, {b"ab": 3, b"ef": 2})
+        # the partition's own runs are left for the caller to remove
+        self.assertTrue(all(map(os.path.exists, runs)))
+        toks = polymr.index._readfeatures([merged], {b"ef"})
+        self.assertEqual([(kmer, list(ids)) for kmer, ids in toks],
+                         [(b"ab", [1, 2, 3])])
+        # but the intermediate merges are gone
+        self.assertEqual(len(os.listdir(self.workdir)), len(runs) + 1)
+
+
+class TestHeavyHitters(unittest.TestCase):
+    def test_counts_are_lower_bounds(self):
+        sketch = polymr.index._HeavyHitters(size=4)
+        truth = {}
+        for i in range(50):
+            batch = [(bytes([i % 7]), 1), (bytes([100 + i]), 1), (b"x", 3)]
+            for tok, cnt in batch:
+                truth[tok] = truth.get(tok, 0) + cnt
+            sketch.update(batch)
+            self.assertLessEqual(len(sketch.counts), 4)
+            for tok, cnt in sketch.counts.items():
+                self.assertLessEqual(cnt, truth[tok])
+        self.assertEqual(sketch.over(100), {b"x"})
+
+
+class FakeBackend:
+    def __init__(self, fail_at=None):
+        self.saved = {}
+        self.fail_at = fail_at
+
+    def save_records(self, idxs_recs):
+        for idx, rec in idxs_recs:
+            if idx == self.fail_at:
+                raise IOError("disk full")
+            self.saved[idx] = rec
+        return len(idxs_recs)
+
+
+class TestRecordWriter(unittest.TestCase):
+    def test_saves_all_batches(self):
+        backend = FakeBackend()
+        writer = polymr.index._RecordWriter(backend, nthreads=3, maxsize=2)
+        for i in range(0, 100, 10):
+            writer.put([(j, str(j)) for j in range(i, i + 10)])
+        writer.close()
+        self.assertEqual(writer.rowcount, 100)
+        self.assertEqual(backend.saved, {j: str(j) for j in range(100)})
+
+    def test_errors_are_raised(self):
+        writer = polymr.index._RecordWriter(FakeBackend(fail_at=5),
+                                            maxsize=1)
+        with self.assertRaises(IOError):
+            for i in range(0, 1000, 10):
+                writer.put([(j, str(j)) for j in range(i, i + 10)])
+            writer.close()
+
+
+def _ascii_records(n, seed=0):
+    rng = random.Random(seed)
+    words = ["".join(rng.choice(string.ascii_uppercase)
+                     for _ in range(rng.randint(3, 9)))
+             for _ in range(500)]
+    return [[str(rng.randint(1000, 99999)),
+             rng.choice(words), rng.choice(words),
+             "%i %s ST" % (rng.randint(1, 999), rng.choice(words))]
+            for _ in range(n)]
+
+
+class TestPartitioning(unittest.TestCase):
+    def test_partitions_are_ordered_ranges(self):
+        kmers = sorted(bytes([i, j]) for i in range(256) for j in (0, 255))
+        for nparts in (1, 2, 3, 8):
+            splits = polymr.index._split_points(kmers, nparts)
+            parts = [polymr.index._partition_of(kmer, splits)
+                     for kmer in kmers]
+            self.assertEqual(parts, sorted(parts))
+            self.assertEqual(set(parts), set(range(nparts)))
+
+    def _assert_balanced(self, featurizer_name):
+        recs = _ascii_records(2000)
+        sample = polymr.featurizers.tokmap(featurizer_name,
+                                           enumerate(recs[:200]))
+        kmers = polymr.featurizers.tokmap(featurizer_name, enumerate(recs))
+        for nparts in (2, 4, 8):
+            splits = polymr.index._split_points(sample, nparts)
+            sizes = Counter(polymr.index._partition_of(kmer, splits)
+                            for kmer in kmers)
+            self.assertEqual(set(sizes), set(range(nparts)))
+            for size in sizes.values():
+                self.assertLess(abs(size * nparts / len(kmers) - 1), 0.5,
+                                (featurizer_name, nparts, sizes))
+
+    def test_ascii_ngrams_are_balanced(self):
+        self._assert_balanced("k3")
+
+    def test_hashed_ids_are_balanced(self):
+        # below 25 bits the first byte of every id is zero
+        self._assert_balanced("default:h20")
+        self._assert_balanced("k3:h12")
+
+
+if __name__ == '__main__':
+    unittest.main()
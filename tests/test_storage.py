@@ -1,14 +1,103 @@
 import os
+import zlib
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
 from polymr.record import Record
+import polymr.score
 import polymr.storage
 
 
+class TestTombstones(unittest.TestCase):
+
+    def test_bitmap(self):
+        t = polymr.storage.Tombstones()
+        self.assertFalse(t)
+        for idx in (9, 0, 17):
+            t.add(idx)
+        self.assertEqual(list(t), [0, 9, 17])
+        self.assertEqual(len(t), 3)
+        self.assertNotIn(1, t)
+        self.assertNotIn(1000, t)
+        # most significant bit first, like redis SETBIT
+        self.assertEqual(t.tobytes(), b"\x80\x40\x40")
+        self.assertEqual(list(polymr.storage.Tombstones(t.tobytes())),
+                         [0, 9, 17])
+
+
+class TestFlatFreqs(unittest.TestCase):
+
+    def test_mapping(self):
+        f = polymr.storage.FlatFreqs(8)
+        self.assertEqual(len(f), 0)
+        f.update({b"\x00\x00\x00\x07": 3, b"\x00\x00\x00\x01": 2})
+        f[b"\x00\x00\x00\x07"] = 4
+        self.assertEqual(dict(f), {b"\x00\x00\x00\x01": 2,
+                                   b"\x00\x00\x00\x07": 4})
+        self.assertEqual(len(f), 2)
+        f[b"\x00\x00\x00\x01"] = 0
+        self.assertNotIn(b"\x00\x00\x00\x01", f)
+        self.assertEqual(len(f), 1)
+        for tok in (b"\x00\x00\x00\x01", b"\x00\x00\x01\x00", b"abc"):
+            self.assertRaises(KeyError, f.__getitem__, tok)
+        blob = polymr.storage.dump_freqs(f)
+        self.assertLess(len(blob), 100)
+        g = polymr.storage.load_freqs(blob)
+        self.assertEqual((g.bits, dict(g)), (8, dict(f)))
+
+
+class TestRecordSizes(unittest.TestCase):
+
+    def test_sizes(self):
+        sizes = polymr.storage.RecordSizes()
+        self.assertEqual(list(sizes.attrs(0)), [])
+        self.assertEqual(sizes.tokens(0), 0)
+        sizes.set(2, 9, [3, 1, 70000])
+        sizes.set(0, 4, [5])
+        sizes.set(1, 7, [1, 2, 3, 4])
+        self.assertEqual(list(sizes.attrs(0)), [5, 0, 0])
+        self.assertEqual(list(sizes.attrs(1)), [0, 0, 0])
+        self.assertEqual(list(sizes.attrs(2)), [3, 1, 0xffff])
+        self.assertEqual(list(sizes.attrs(3)), [])
+        self.assertEqual([sizes.tokens(i) for i in range(4)], [4, 7, 9, 0])
+
+    def test_capped_sizes_dont_bound(self):
+        sizes = polymr.storage.RecordSizes()
+        sizes.set(0, 1, [70000, 10])
+        self.assertEqual(
+            polymr.score.hit_bound([70000, 10], sizes.attrs(0)), 0)
+        self.assertEqual(
+            polymr.score.hit_bound([100, 20], sizes.attrs(0)), 0.25)
+
+    @mock.patch.object(polymr.storage, "SIZES_CHUNK", 2)
+    def test_chunks(self):
+        sizes = polymr.storage.RecordSizes()
+        for idx in range(5):
+            sizes.set(idx, 3, [idx, 1])
+        self.assertEqual([n for n, _ in sizes.chunks([4, 0, 1])], [0, 2])
+        loaded = polymr.storage.RecordSizes.fromchunks(
+            blob for _, blob in sizes.chunks())
+        self.assertEqual((loaded.width, loaded.counts),
+                         (sizes.width, sizes.counts))
+
+
+class TestRecordBlocks(unittest.TestCase):
+
+    def test_pack_unpack(self):
+        blobs = [b"abc", None, b"de", None]
+        data = zlib.decompress(polymr.storage._pack_block(blobs))
+        self.assertEqual(polymr.storage._unpack_block(data, 4), blobs)
+        self.assertEqual(polymr.storage._block_slot(data, 4, 2), b"de")
+        with self.assertRaises(KeyError):
+            polymr.storage._block_slot(data, 4, 1)
+
+
 class TestLevelDBBackend(unittest.TestCase):
 
+    params = ""
+
     def setUp(self):
         self.workdir = tempfile.mkdtemp(suffix="polymrtest")
         self.db = None
@@ -23,7 +112,7 @@ class TestLevelDBBackend(unittest.TestCase):
         if self.db:
             self.db.close()
         self.db = polymr.storage.parse_url(
-            "leveldb://localhost"+self.workdir)
+            "leveldb://localhost"+self.workdir+self.params)
         return self.db
 
     def test_get_set_featurizer_name(self):
@@ -43,7 +132,17 @@ class TestLevelDBBackend(unittest.TestCase):
         db.update_freqs(new_x.items())
         y = db.get_freqs()
         self.assertEqual(new_x, dict(y))
-        
+
+    def test_flat_freqs(self):
+        db = self._get_db()
+        freqs = polymr.storage.empty_freqs("default:h12")
+        freqs[b"\x00\x00\x0f\xff"] = 3
+        db.save_freqs(freqs)
+        db.update_freqs([(b"\x00\x00\x00\x00", 1)])
+        y = db.get_freqs()
+        self.assertEqual(dict(y), {b"\x00\x00\x0f\xff": 3,
+                                   b"\x00\x00\x00\x00": 1})
+
     def test_get_set_increment_rowcount(self):
         db = self._get_db()
         x = 222
@@ -63,12 +162,15 @@ class TestLevelDBBackend(unittest.TestCase):
         rng = db.get_token(tok)
         self.assertEqual(records_simple, list(rng))
         add = [4]
-        db.update_token(tok, add)
+        self.assertEqual(db.update_token(tok, add), 4)
         rng = db.get_token(tok)
         self.assertEqual(list(set(records_simple+add)), list(rng))
-        db.drop_records_from_token(tok, add)
+        self.assertEqual(db.drop_records_from_token(tok, add), 3)
         rng = db.get_token(tok)
         self.assertEqual([1,2,3], list(rng))
+        self.assertEqual(db.update_token(b"new", [5, 6]), 2)
+        self.assertEqual(db.drop_records_from_token(b"new", [5, 6]), 0)
+        self.assertEqual(list(db.get_token(b"new")), [])
 
     def test_get_set_del_records(self):
         db = self._get_db()
@@ -85,3 +187,107 @@ class TestLevelDBBackend(unittest.TestCase):
         with self.assertRaises(KeyError):
             db.get_record(0)
         db.get_record(1)
+
+    def test_pk_index(self):
+        db = self._get_db()
+        r1 = Record(["abcde", "foo"], "1", ['dogsays'])
+        r2 = Record(["qwert", "bar"], "2", ['barque'])
+        db.save_records(enumerate((r1, r2)))
+        db.save_rowcount(2)
+        self.assertEqual(db.get_rownum("1"), 0)
+        self.assertEqual(db.get_rownums(["2", "nope", "1"]), [1, None, 0])
+        idx = db.save_record(Record(["zxcvb", "baz"], "3", []))
+        self.assertEqual(idx, 2)
+        self.assertEqual(db.get_rownum("3"), 2)
+        db.update_record(Record(["qwert", "bar"], "4", []), 1)
+        self.assertEqual(db.get_rownum("4"), 1)
+        with self.assertRaises(KeyError):
+            db.get_rownum("2")
+        db.delete_record(0)
+        with self.assertRaises(KeyError):
+            db.get_rownum("1")
+
+    def test_tombstones(self):
+        db = self._get_db()
+        recs = [Record(["abcde"], str(i), []) for i in range(3)]
+        db.save_records(enumerate(recs))
+        db.save_rowcount(3)
+        db.save_token(b"abc", [0, 1, 2])
+        db.save_freqs({b"abc": 3})
+        self.assertEqual(list(db.get_deleted()), [])
+        db.delete_record(1)
+        self.assertEqual(list(db.get_deleted()), [1])
+        self.assertIn(1, db.get_deleted())
+        self.assertNotIn(0, db.get_deleted())
+        hits = db.search_candidates([b"abc"], 3, 10)
+        self.assertEqual(sorted(hits), [0, 2])
+
+    def test_scan_records(self):
+        db = self._get_db()
+        saved = [i for i in range(30) if i != 5]
+        db.save_records((i, Record(["rec%i" % i], str(i), [])) for i in saved)
+        db.save_rowcount(30)
+        db.delete_record(7)
+        live = [i for i in saved if i != 7]
+        self.assertEqual([(idx, rec.pk) for idx, rec in db.scan_records()],
+                         [(i, str(i)) for i in live])
+        wanted = [29, 0, 1, 2, 3, 4, 6, 8, 9, 10, 11, 12, 20, 13]
+        self.assertEqual([rec.pk for rec in db.get_records(wanted)],
+                         list(map(str, wanted)))
+        with self.assertRaises(KeyError):
+            list(db.get_records([4, 5, 6]))
+
+
+class TestLevelDBBackendSortedKeys(TestLevelDBBackend):
+
+    params = "?sorted_keys=true"
+
+    def test_keys_sort_by_id(self):
+        db = self._get_db()
+        db.save_records((i, Record(["x"], str(i), [])) for i in (1, 256, 2))
+        keys = [bytes(k) for k in db.record_db.RangeIter(include_value=False)
+                if len(k) == polymr.storage._ID_SIZE and k[0] == 0]
+        self.assertEqual([int.from_bytes(k, "big") for k in keys],
+                         [1, 2, 256])
+
+
+class TestLevelDBBackendRecordBlocks(TestLevelDBBackend):
+
+    params = "?record_block=4"
+
+    def test_blocks_fill_across_saves(self):
+        db = self._get_db()
+        recs = [Record(["rec%i" % i], str(i), []) for i in range(10)]
+        db.save_records(list(enumerate(recs))[:3])
+        db.save_records(list(enumerate(recs))[3:7])
+        for i in range(7, 10):
+            db.save_record(recs[i], i, save_rowcount=False)
+        db = self._get_db(new=True)
+        self.assertEqual(db.record_block, 4)
+        self.assertEqual([r.pk for r in db.get_records([9, 0, 5, 4, 1])],
+                         ["9", "0", "5", "4", "1"])
+        self.assertEqual(db.get_rownum("6"), 6)
+        for i in range(4, 8):
+            db.delete_record(i)
+        with self.assertRaises(KeyError):
+            db.get_record(5)
+        with self.assertRaises(KeyError):
+            list(db.get_records([3, 4]))
+        self.assertEqual(db.get_record(8).pk, "8")
+
+    def test_layout_is_fixed_once_records_exist(self):
+        db = self._get_db()
+        db.save_records([(0, Record(["abc"], "0", []))])
+        db.save_rowcount(1)
+        db.close()
+        with self.assertRaises(ValueError):
+            polymr.storage.parse_url(
+                "leveldb://localhost"+self.workdir+"?record_block=8")
+        self.db = polymr.storage.parse_url("leveldb://localhost"+self.workdir)
+        self.assertEqual(self.db.record_block, 4)
+        self.assertEqual(self.db.get_record(0).pk, "0")
+
+
+class TestLevelDBBackendSortedRecordBlocks(TestLevelDBBackendRecordBlocks):
+
+    params = "?record_block=4&sorted_keys=true"